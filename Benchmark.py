@@ -0,0 +1,604 @@
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from LLMs.ApiRuntimeClient import ContentGenerator
+from LLMs.BedrockRuntimeClient import BedrockRuntimeClient
+from LLMs.ConnectionPool import ConnectionPool
+from LLMs.Hedging import HedgePolicy
+from LLMs.Metrics import Metrics
+from LLMs.RateLimiter import RateLimiterRegistry
+from ModelPromotProcessor import ModelPromptProcessor
+from DBInference import DBInference
+from PromptPlanner import PromptPlanner
+from StorageBackends import open_storage
+from DedupFilter import DedupFilter
+from ModelScheduler import ModelScheduler
+
+# Two sentences, so streamed runs stop reading after the first one
+SAMPLE_RESPONSES = [
+    "The quiet forest glowed with a calm and hopeful light after the storm. Nobody noticed the time passing.",
+    "Despite the long commute, the new recipe turned the evening into a small celebration. The kitchen smelled of basil.",
+    "The delayed train left everyone tired and frustrated before the meeting even began. Coffee did not help."
+]
+
+PACKED_REQUEST = re.compile(r'lines numbered 1 to (\d+)')
+
+def fake_latency(rng, latency, jitter, tail_rate=0.0, tail_latency=1.0):
+    """Gaussian call latency, except for a tail_rate share of calls that take tail_latency, like a stuck backend."""
+    if rng.random() < tail_rate:
+        return tail_latency
+    return max(0.0, rng.gauss(latency, jitter))
+
+
+def fake_completion(prompt):
+    """A canned answer; packed prompts get one numbered sentence per item."""
+    match = PACKED_REQUEST.search(prompt or '')
+    if match is None:
+        return random.choice(SAMPLE_RESPONSES)
+    return "\n".join(f"{number}. {random.choice(SAMPLE_RESPONSES).split('. ')[0]}." for number in range(1, int(match.group(1)) + 1))
+
+def split_pieces(text):
+    """Word-sized stream pieces that join back into text."""
+    words = text.split(' ')
+    return [word + ' ' for word in words[:-1]] + [words[-1]]
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    """Answers OpenAI chat-completions and Gemini generateContent/streamGenerateContent/countTokens requests."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real APIs
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        settings = self.server.settings
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        # The stand-in serves one Gemini and one OpenAI model
+        model_id = 'gemini-pro' if '/models/gemini' in self.path else 'gpt-4'
+        latency = settings['model_latency'].get(model_id, settings['latency'])
+        time.sleep(fake_latency(random, latency, settings['jitter'], settings['tail_rate'], settings['tail_latency']))
+
+        if random.random() < settings['throttle_rate']:
+            return self.send_json(429, {"error": {"message": "Rate limit reached"}}, {'Retry-After': str(settings['retry_after'])})
+        if random.random() < settings['model_error_rate'].get(model_id, settings['error_rate']):
+            return self.send_json(500, {"error": {"message": "Internal error"}})
+
+        if ':countTokens' in self.path:
+            return self.send_json(200, {"totalTokens": len(json.dumps(body)) // 4})
+        text = fake_completion(self.prompt_of(body))
+        if ':streamGenerateContent' in self.path:
+            return self.send_events([{"candidates": [{"content": {"parts": [{"text": piece}]}}]} for piece in split_pieces(text)])
+        if ':generateContent' in self.path:
+            return self.send_json(200, {
+                "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}],
+                "usageMetadata": {"promptTokenCount": len(json.dumps(body)) // 4, "candidatesTokenCount": len(text) // 4}
+            })
+        if self.path.endswith('/chat/completions'):
+            if body.get('stream'):
+                return self.send_events([{"choices": [{"delta": {"content": piece}}]} for piece in split_pieces(text)], done=True)
+            return self.send_json(200, {
+                "id": "chatcmpl-offline",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(json.dumps(body)) // 4, "completion_tokens": len(text) // 4}
+            })
+        return self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def prompt_of(self, body):
+        if 'messages' in body:
+            return body['messages'][-1].get('content', '')
+        contents = body.get('contents') or [{}]
+        return (contents[0].get('parts') or [{}])[0].get('text', '')
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_events(self, events, done=False):
+        lines = [f"data: {json.dumps(event)}\n\n".encode('utf-8') for event in events]
+        if done:
+            lines.append(b"data: [DONE]\n\n")
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Content-Length', str(sum(len(line) for line in lines)))
+        self.end_headers()
+        try:
+            for line in lines:
+                self.wfile.write(line)
+                self.wfile.flush()
+                time.sleep(self.server.settings['token_delay'])
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading after its first sentence
+            self.close_connection = True
+
+
+def serve_fake_provider(settings, port_queue):
+    random.seed(settings['seed'])
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeProviderHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    server.settings = settings
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeProviderServer:
+    """Local stand-in for the OpenAI and Gemini APIs, served from a child process so it does not skew RSS or thread counts."""
+
+    def __init__(self, latency=0.05, jitter=0.01, error_rate=0.0, throttle_rate=0.0, retry_after=0.05, token_delay=0.002, seed=0,
+                 tail_rate=0.0, tail_latency=1.0, model_latency=None, model_error_rate=None):
+        self.settings = {
+            'latency': latency, 'jitter': jitter, 'error_rate': error_rate, 'throttle_rate': throttle_rate,
+            'retry_after': retry_after, 'token_delay': token_delay, 'seed': seed, 'tail_rate': tail_rate, 'tail_latency': tail_latency,
+            'model_latency': model_latency or {}, 'model_error_rate': model_error_rate or {}
+        }
+        self.process = None
+        self.url = None
+
+    def start(self):
+        port_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve_fake_provider, args=(self.settings, port_queue), daemon=True)
+        self.process.start()
+        self.url = f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def base_urls(self):
+        return {
+            "gemini-pro": f"{self.url}/v1beta/models/gemini-pro:generateContent?key=",
+            "gpt-4": f"{self.url}/v1/chat/completions"
+        }
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def fake_bedrock_body(model_id, text):
+    if model_id == 'ai21.j2-ultra-v1':
+        return {"completions": [{"data": {"text": text}}]}
+    if model_id == 'amazon.titan-text-express-v1':
+        return {"results": [{"outputText": text}]}
+    if model_id == 'meta.llama2-70b-chat-v1':
+        return {"generation": text}
+    return {"completion": text}
+
+
+# Key of the text in one invoke_model_with_response_stream chunk
+STREAM_KEYS = {
+    'amazon.titan-text-express-v1': 'outputText',
+    'meta.llama2-70b-chat-v1': 'generation',
+    'anthropic.claude-v2': 'completion'
+}
+
+class FakeEventStream:
+    def __init__(self, model_id, text, token_delay):
+        self.events = [{'chunk': {'bytes': json.dumps({STREAM_KEYS[model_id]: piece}).encode('utf-8')}} for piece in split_pieces(text)]
+        self.token_delay = token_delay
+
+    def __iter__(self):
+        for event in self.events:
+            time.sleep(self.token_delay)
+            yield event
+
+    async def __aiter__(self):
+        for event in self.events:
+            await asyncio.sleep(self.token_delay)
+            yield event
+
+    def close(self):
+        pass
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class AsyncFakeBody(FakeBody):
+    async def read(self):
+        return self.data
+
+
+class FakeBedrockRuntime:
+    """Stand-in for the bedrock-runtime client with configurable latency, error and throttle rates."""
+
+    def __init__(self, latency=0.05, jitter=0.01, error_rate=0.0, throttle_rate=0.0, token_delay=0.002, seed=0, tail_rate=0.0, tail_latency=1.0,
+                 model_latency=None, model_error_rate=None):
+        self.latency = latency
+        # Per model overrides of latency and error_rate, e.g. one slow or failing model
+        self.model_latency = model_latency or {}
+        self.model_error_rate = model_error_rate or {}
+        self.jitter = jitter
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.token_delay = token_delay
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self, body, model_id):
+        request = json.loads(body)
+        latency = self.model_latency.get(model_id, self.latency)
+        with self._lock:
+            return fake_latency(self.random, latency, self.jitter, self.tail_rate, self.tail_latency), self.random.random(), fake_completion(request.get('prompt') or request.get('inputText'))
+
+    def check(self, roll, operation, model_id):
+        if roll < self.throttle_rate:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Too many requests'}}, operation)
+        if roll < self.throttle_rate + self.model_error_rate.get(model_id, self.error_rate):
+            raise ClientError({'Error': {'Code': 'InternalServerException', 'Message': 'Internal error'}}, operation)
+
+    def response(self, body):
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}, 'contentType': 'application/json', 'body': body}
+
+    def invoke_model(self, body, modelId, accept=None, contentType=None):
+        delay, roll, text = self.draw(body, modelId)
+        time.sleep(delay)
+        self.check(roll, 'InvokeModel', modelId)
+        return self.response(FakeBody(json.dumps(fake_bedrock_body(modelId, text)).encode('utf-8')))
+
+    def invoke_model_with_response_stream(self, body, modelId, accept=None, contentType=None):
+        delay, roll, text = self.draw(body, modelId)
+        time.sleep(delay)
+        self.check(roll, 'InvokeModelWithResponseStream', modelId)
+        return self.response(FakeEventStream(modelId, text, self.token_delay))
+
+
+class AsyncFakeBedrockRuntime(FakeBedrockRuntime):
+    async def invoke_model(self, body, modelId, accept=None, contentType=None):
+        delay, roll, text = self.draw(body, modelId)
+        await asyncio.sleep(delay)
+        self.check(roll, 'InvokeModel', modelId)
+        return self.response(AsyncFakeBody(json.dumps(fake_bedrock_body(modelId, text)).encode('utf-8')))
+
+    async def invoke_model_with_response_stream(self, body, modelId, accept=None, contentType=None):
+        delay, roll, text = self.draw(body, modelId)
+        await asyncio.sleep(delay)
+        self.check(roll, 'InvokeModelWithResponseStream', modelId)
+        return self.response(FakeEventStream(modelId, text, self.token_delay))
+
+
+class FakeTable:
+    def __init__(self, dynamodb):
+        self.dynamodb = dynamodb
+        self.meta = self
+
+    @property
+    def client(self):
+        return self.dynamodb
+
+    def put_item(self, Item):
+        self.dynamodb.store([Item])
+
+
+def item_size(item):
+    """Approximate DynamoDB item size: attribute names plus UTF-8 strings, raw binary and about 8 bytes per number."""
+    size = 0
+    for name, value in item.items():
+        size += len(name.encode('utf-8'))
+        if isinstance(value, str):
+            size += len(value.encode('utf-8'))
+        elif isinstance(value, (bytes, bytearray)):
+            size += len(value)
+        else:
+            size += 8
+    return size
+
+
+class FakeDynamoDB:
+    """Stand-in for the DynamoDB resource: put_item and batch_write_item with latency and unprocessed items."""
+
+    def __init__(self, latency=0.005, unprocessed_rate=0.0, seed=0):
+        self.latency = latency
+        self.unprocessed_rate = unprocessed_rate
+        self.random = random.Random(seed)
+        self.items = 0
+        self.bytes_written = 0
+        self.write_units = 0
+        self._lock = threading.Lock()
+
+    def Table(self, name):
+        return FakeTable(self)
+
+    def store(self, items):
+        time.sleep(self.latency)
+        sizes = [item_size(item) for item in items]
+        with self._lock:
+            self.items += len(items)
+            self.bytes_written += sum(sizes)
+            # DynamoDB bills one write unit per started kilobyte of each item
+            self.write_units += sum(-(-size // 1024) for size in sizes)
+
+    def batch_write_item(self, RequestItems):
+        unprocessed, stored = {}, []
+        with self._lock:
+            for table_name, requests in RequestItems.items():
+                for request in requests:
+                    if self.random.random() < self.unprocessed_rate:
+                        unprocessed.setdefault(table_name, []).append(request)
+                    else:
+                        stored.append(request['PutRequest']['Item'])
+        self.store(stored)
+        return {'UnprocessedItems': unprocessed}
+
+
+class OfflinePool(ConnectionPool):
+    """ConnectionPool whose boto3 clients and resources are the local stand-ins; HTTP still goes over real sockets."""
+
+    def __init__(self, bedrock, dynamodb, max_connections=64):
+        super().__init__(max_connections=max_connections)
+        self.bedrock = bedrock
+        self.dynamodb = dynamodb
+
+    def client(self, service_name, region_name=None):
+        return self.bedrock
+
+    def resource(self, service_name, region_name=None):
+        return self.dynamodb
+
+
+class OfflineBedrockRuntimeClient(BedrockRuntimeClient):
+    def __init__(self, async_bedrock, **kwargs):
+        super().__init__(**kwargs)
+        self.async_bedrock = async_bedrock
+
+    async def get_async_client(self, region=None):
+        return self.async_bedrock
+
+
+class ResourceSampler:
+    """Samples RSS and the thread count in the background while a run is going."""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak_rss_mb = 0.0
+        self.peak_threads = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def rss_mb(self):
+        try:
+            with open('/proc/self/statm') as file:
+                return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+        except (OSError, ValueError):
+            # Lifetime peak only; ru_maxrss is in KB on Linux and bytes on macOS
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss / 2 ** 20 if platform.system() == 'Darwin' else maxrss / 2 ** 10
+
+    def sample(self):
+        self.peak_rss_mb = max(self.peak_rss_mb, self.rss_mb())
+        # Not counting the sampler itself
+        self.peak_threads = max(self.peak_threads, threading.active_count() - 1)
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread = threading.Thread(target=self.run, name="ResourceSampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def run_benchmark(categories, server, concurrency, n_prompts, use_async=False, stream=False, write_behind=False,
+                  bedrock_settings=None, dynamodb_settings=None, verbose=False, pack_size=1, layout='flat', storage='dynamodb', dedup=False, hedge=False,
+                  target_rows=None, model_mix=None, sentiment_mix=None):
+    """Runs one batch against the stand-ins and returns its throughput, latency and resource figures.
+
+    With target_rows a ModelScheduler runs the batch toward that many rows in model_mix and sentiment_mix instead of
+    sending all n_prompts prompts to every model.
+    """
+    bedrock_settings = bedrock_settings or {}
+    metrics = Metrics()
+    # Short backoffs so injected throttles cost milliseconds, as with the fake Retry-After
+    rate_limiter = RateLimiterRegistry(default_limits={"base_backoff": 0.05, "max_backoff": 1.0})
+    pool = OfflinePool(FakeBedrockRuntime(**bedrock_settings), FakeDynamoDB(**(dynamodb_settings or {})), max_connections=concurrency)
+    if storage == 'dynamodb':
+        db_instance = DBInference(pool=pool, write_behind=write_behind, metrics=metrics, layout=layout)
+    else:
+        # A fresh local store per run, removed once the run is measured
+        storage_dir = tempfile.TemporaryDirectory()
+        db_instance = open_storage(storage, os.path.join(storage_dir.name, 'rows'), metrics=metrics)
+    # Hedges go to the same stand-ins, which draw a fresh latency for the repeated call like another region would
+    hedging = HedgePolicy(min_samples=20, metrics=metrics) if hedge else None
+    brt_client = OfflineBedrockRuntimeClient(AsyncFakeBedrockRuntime(**bedrock_settings), pool=pool, rate_limiter=rate_limiter, metrics=metrics,
+                                             hedge_regions=["us-west-2"] if hedge else (), hedging=hedging)
+    content_generators = {
+        model_id: ContentGenerator("offline-key", pool=pool, rate_limiter=rate_limiter, metrics=metrics, base_url=server.base_urls(),
+                                   hedge_urls=server.base_urls() if hedge else None, hedging=hedging)
+        for model_id in ("gemini-pro", "gpt-4")
+    }
+    processor = ModelPromptProcessor(categories, brt_client, db_instance, content_generators,
+                                     planner=PromptPlanner(categories, seed=0), stream=stream, metrics=metrics,
+                                     dedup=DedupFilter(capacity=100_000, metrics=metrics) if dedup else None)
+
+    scheduler = ModelScheduler(target_rows, model_mix=model_mix, sentiment_mix=sentiment_mix) if target_rows else None
+
+    async def run_async_batch():
+        try:
+            if scheduler is not None:
+                return await processor.arun_scheduled(scheduler, max_in_flight=concurrency)
+            return await processor.arun_batch(n_prompts, max_in_flight=concurrency, pack_size=pack_size)
+        finally:
+            await brt_client.aclose()
+            await pool.aclose()
+
+    # The pipeline logs every row; keep that out of the terminal unless asked for
+    with open(os.devnull, 'w') as devnull, redirect_stdout(sys.stdout if verbose else devnull), ResourceSampler() as sampler:
+        if use_async:
+            summary = asyncio.run(run_async_batch())
+        elif scheduler is not None:
+            summary = processor.run_scheduled(scheduler, max_in_flight=concurrency)
+        else:
+            summary = processor.run_batch(n_prompts, max_in_flight=concurrency, pack_size=pack_size)
+        db_instance.close()
+        if hedging is not None:
+            hedging.close()
+    if storage != 'dynamodb':
+        storage_dir.cleanup()
+
+    # Per call latency: one row, or one pack of pack_size rows
+    latency = metrics.merged('row' if pack_size <= 1 else 'pack').summary()
+    snapshot = metrics.snapshot()
+    return {
+        "mode": ("async" if use_async else "threads") + ("+stream" if stream else "") + (f"+pack{pack_size}" if pack_size > 1 else "") + (f"+{layout}" if layout != 'flat' else "") + (f"+{storage}" if storage != 'dynamodb' else "") + ("+dedup" if dedup else "") + ("+hedge" if hedge else "") + ("+schedule" if scheduler is not None else ""),
+        "concurrency": concurrency,
+        "prompts": n_prompts,
+        "rows": summary["rows"],
+        "dropped": summary["dropped"],
+        "failed_writes": summary["failed_writes"],
+        "errors": sum(model_stats["error"] for model_stats in summary["models"].values()),
+        "elapsed": round(summary["elapsed"], 3),
+        "rows_per_sec": round(summary["rows_per_sec"], 2),
+        "latency": {key: latency[key] for key in ("p50", "p95", "p99", "max", "mean")},
+        "stages": {name: metrics.merged(name).summary()["mean"] for name in snapshot["spans"]},
+        "requests": sum(snapshot["counters"].get("requests", {}).values()),
+        "duplicates": sum(snapshot["counters"].get("duplicates", {}).values()),
+        "hedges": hedging.stats() if hedging is not None else None,
+        "rows_by_model": {model: model_stats["success"] for model, model_stats in summary["models"].items()},
+        "schedule": summary.get("schedule"),
+        "stored_items": pool.dynamodb.items if storage == 'dynamodb' else db_instance.write_counters["written"],
+        "stored_mb": round(pool.dynamodb.bytes_written / 1e6, 3),
+        "write_units": pool.dynamodb.write_units,
+        "peak_rss_mb": round(sampler.peak_rss_mb, 1),
+        "peak_threads": sampler.peak_threads
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Returns a message for every run whose rows/sec fell more than tolerance below the matching baseline run."""
+    previous = {(run["mode"], run["concurrency"]): run for run in baseline.get("runs", [])}
+    regressions = []
+    for run in results["runs"]:
+        before = previous.get((run["mode"], run["concurrency"]))
+        if before is None or not before["rows_per_sec"]:
+            continue
+        change = run["rows_per_sec"] / before["rows_per_sec"] - 1
+        if change < -tolerance:
+            regressions.append(f"{run['mode']} x{run['concurrency']}: {before['rows_per_sec']} -> {run['rows_per_sec']} rows/sec ({change:+.1%})")
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the generation pipeline against local stand-ins.")
+    parser.add_argument("--prompts", type=int, default=100)
+    parser.add_argument("--concurrency", type=str, default="4,16,64", help="comma separated in-flight limits to run")
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--write_behind", action="store_true")
+    parser.add_argument("--pack_size", type=int, default=1, help="sentences requested per call")
+    parser.add_argument("--storage", type=str, default="dynamodb", choices=["dynamodb", "sqlite", "parquet"], help="where rows are stored")
+    parser.add_argument("--dedup", action="store_true", help="drop near-duplicate responses before storing")
+    parser.add_argument("--layout", type=str, default="flat", choices=["flat", "normalized"], help="DynamoDB storage layout")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean provider latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--throttle_rate", type=float, default=0.0)
+    parser.add_argument("--tail_rate", type=float, default=0.0, help="share of provider calls that hang for --tail_latency")
+    parser.add_argument("--tail_latency", type=float, default=1.0)
+    parser.add_argument("--hedge", action="store_true", help="repeat calls slower than the observed p95 on a second endpoint")
+    parser.add_argument("--model_latency", type=json.loads, default={}, help='JSON of model ID to its mean latency, e.g. {"gpt-4": 0.2}')
+    parser.add_argument("--model_error_rate", type=json.loads, default={}, help="JSON of model ID to its error rate")
+    parser.add_argument("--target_rows", type=int, default=None, help="schedule toward this many rows instead of every prompt for every model")
+    parser.add_argument("--model_mix", type=json.loads, default=None, help="JSON of model ID to its share of --target_rows")
+    parser.add_argument("--sentiment_mix", type=json.loads, default=None, help="JSON of sentiment to its share of each model's rows")
+    parser.add_argument("--db_latency", type=float, default=0.005)
+    parser.add_argument("--topics", type=str, default="topics.json")
+    parser.add_argument("--output", type=str, default="benchmarks/latest.json")
+    parser.add_argument("--baseline", type=str, default=None, help="earlier results file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed rows/sec drop against the baseline")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    with open(args.topics, 'r', encoding='utf-8') as file:
+        categories_data = json.load(file)
+
+    random.seed(args.seed)
+    provider_settings = {"latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate, "throttle_rate": args.throttle_rate, "seed": args.seed,
+                         "tail_rate": args.tail_rate, "tail_latency": args.tail_latency, "model_latency": args.model_latency, "model_error_rate": args.model_error_rate}
+    results = {
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "settings": dict(vars(args)),
+        "runs": []
+    }
+    with FakeProviderServer(**provider_settings) as server:
+        for concurrency in [int(value) for value in args.concurrency.split(',')]:
+            run = run_benchmark(categories_data, server, concurrency, args.prompts, use_async=args.use_async, stream=args.stream,
+                                write_behind=args.write_behind, bedrock_settings=provider_settings,
+                                dynamodb_settings={"latency": args.db_latency, "seed": args.seed}, verbose=args.verbose,
+                                pack_size=args.pack_size, layout=args.layout, storage=args.storage, dedup=args.dedup, hedge=args.hedge,
+                                target_rows=args.target_rows, model_mix=args.model_mix, sentiment_mix=args.sentiment_mix)
+            results["runs"].append(run)
+            print(f"{run['mode']} x{concurrency}: {run['rows']} rows, {run['errors']} errors, {run['rows_per_sec']} rows/sec, "
+                  f"p50 {run['latency']['p50']:.3f}s p95 {run['latency']['p95']:.3f}s p99 {run['latency']['p99']:.3f}s, "
+                  f"{run['write_units']} write units, peak RSS {run['peak_rss_mb']} MB, {run['peak_threads']} threads")
+
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            regressions = compare_to_baseline(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,102 +1,418 @@
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
-import pytz
-from datetime import datetime
-from decimal import Decimal
-from faker import Faker
+from collections import OrderedDict
+import hashlib
+import queue
 import random
-import json
+import threading
+import time
+import zlib
 
-class DBInference:
-    def __init__(self, table_name='ModelExecutionMetadata'):
-        self.dynamodb = boto3.resource('dynamodb', region_name='us-east-1')  # Adjust the region as necessary
+from LLMs.ConnectionPool import get_default_pool
+from LLMs.Metrics import get_default_metrics
+from StorageBackends import StorageBackend
+
+def get_codec(name):
+    """Returns (compress, decompress) for 'zstd' or 'zlib'; zstandard is optional and falls back to zlib."""
+    if name == 'zstd':
+        try:
+            import zstandard
+            return (lambda data: zstandard.compress(data, 3)), zstandard.decompress
+        except ImportError:
+            print("zstandard is not installed, compressing with zlib")
+            name = 'zlib'
+    if name == 'zlib':
+        return (lambda data: zlib.compress(data, 6)), zlib.decompress
+    raise ValueError(f"Unknown compression {name}")
+
+
+class DBInference(StorageBackend):
+    BATCH_SIZE = 25  # BatchWriteItem limit
+    BATCH_GET_SIZE = 100  # BatchGetItem limit
+    # Attributes stored as compressed Binary in the normalized layout
+    COMPRESSED_ATTRIBUTES = ('request_body', 'full_response')
+
+    def __init__(self, table_name='ModelExecutionMetadata', pool=None, write_behind=False, buffer_size=1000, flush_interval=1.0, max_retries=8, metrics=None,
+                 layout='flat', compression='zstd'):
+        """layout='normalized' writes each prompt and categories once to <table_name>Prompts under a content hash,
+        stores that hash on the model rows, and compresses request_body and full_response into Binary attributes.
+        Reads put the prompt and categories back, so both layouts read the same. Filters on prompt or categories
+        only match flat rows.
+        """
+        super().__init__()
+        self.pool = pool or get_default_pool()
+        self.metrics = metrics or get_default_metrics()
+        self.dynamodb = self.pool.resource('dynamodb', region_name='us-east-1')  # Adjust the region as necessary
         self.table_name = table_name
         self.table = self.dynamodb.Table(table_name)
-        self.faker = Faker()
 
-    def create_table(self):
-        try:
-            self.dynamodb.create_table(
-                TableName=self.table_name,
-                KeySchema=[
-                    {'AttributeName': 'model', 'KeyType': 'HASH'},  # Partition key
-                    {'AttributeName': 'timestamp', 'KeyType': 'RANGE'},  # Sort key
-                ],
-                AttributeDefinitions=[
-                    {'AttributeName': 'model', 'AttributeType': 'S'},
-                    {'AttributeName': 'timestamp', 'AttributeType': 'S'},
+        self.layout = layout
+        self.prompts_table_name = f"{table_name}Prompts"
+        self.prompts_table = self.dynamodb.Table(self.prompts_table_name) if layout == 'normalized' else None
+        self.key_attributes = {table_name: ('model', 'timestamp'), self.prompts_table_name: ('prompt_hash',)}
+        self.compression = compression
+        self.compress = get_codec(compression)[0] if layout == 'normalized' else None
+        self._decompressors = {}
+        # Prompt hashes already stored by this process, and prompts already fetched for reads
+        self._stored_prompts = OrderedDict()
+        self._prompt_cache = OrderedDict()
+        self._prompt_cache_size = 10000
+        self._prompts_lock = threading.Lock()
+
+        # Write-behind mode: write_item only enqueues, a background thread drains the queue in batches
+        self._indexes = None  # GSI partition attribute -> index name, loaded on first query
+
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.write_counters = {"written": 0, "failed": 0, "batches": 0, "retries": 0}
+        self._queue = None
+        self._flusher = None
+        self._stop = threading.Event()
+        if write_behind:
+            # Bounded so producers block (backpressure) instead of buffering unboundedly
+            self._queue = queue.Queue(maxsize=buffer_size)
+            self._flusher = threading.Thread(target=self._flush_loop, name="DBInferenceFlusher", daemon=True)
+            self._flusher.start()
+
+    def index_name(self, attribute):
+        return f"{attribute}-timestamp-index"
+
+    def create_table(self, gsi_attributes=()):
+        attribute_definitions = [
+            {'AttributeName': 'model', 'AttributeType': 'S'},
+            {'AttributeName': 'timestamp', 'AttributeType': 'S'},
+        ]
+        # Each GSI is partitioned on the attribute and sorted by timestamp, like the base table
+        global_secondary_indexes = []
+        for attribute in gsi_attributes:
+            attribute_definitions.append({'AttributeName': attribute, 'AttributeType': 'S'})
+            global_secondary_indexes.append({
+                'IndexName': self.index_name(attribute),
+                'KeySchema': [
+                    {'AttributeName': attribute, 'KeyType': 'HASH'},
+                    {'AttributeName': 'timestamp', 'KeyType': 'RANGE'},
                 ],
-                BillingMode='PAY_PER_REQUEST'  # On-Demand mode
-            )
+                'Projection': {'ProjectionType': 'ALL'}
+            })
+
+        table_parameters = {
+            'TableName': self.table_name,
+            'KeySchema': [
+                {'AttributeName': 'model', 'KeyType': 'HASH'},  # Partition key
+                {'AttributeName': 'timestamp', 'KeyType': 'RANGE'},  # Sort key
+            ],
+            'AttributeDefinitions': attribute_definitions,
+            'BillingMode': 'PAY_PER_REQUEST'  # On-Demand mode
+        }
+        if global_secondary_indexes:
+            table_parameters['GlobalSecondaryIndexes'] = global_secondary_indexes
+
+        try:
+            self.dynamodb.create_table(**table_parameters)
             self.table.meta.client.get_waiter('table_exists').wait(TableName=self.table_name)
+            self._indexes = None
             print(f"Table {self.table_name} created successfully.")
         except Exception as e:
             print(f"Error creating table: {e}")
 
-    def write_item(self, model, sentiment, categories, prompt, run_time, response, request_body, full_response):
-        timestamp = datetime.now(pytz.timezone('Asia/Jerusalem')).isoformat()
-
-        item = {
-            'model': model,
-            'timestamp': timestamp,
-            'sentiment': sentiment,
-            'categories': categories,
-            'prompt': prompt,
-            'run_time': Decimal(str(run_time)),
-            'response': response,
-            'request_body': json.dumps(request_body),
-            'full_response': json.dumps(full_response)
-        }
+    def create_prompts_table(self):
+        try:
+            self.dynamodb.create_table(
+                TableName=self.prompts_table_name,
+                KeySchema=[{'AttributeName': 'prompt_hash', 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': 'prompt_hash', 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST'
+            )
+            self.prompts_table.meta.client.get_waiter('table_exists').wait(TableName=self.prompts_table_name)
+            print(f"Table {self.prompts_table_name} created successfully.")
+        except Exception as e:
+            print(f"Error creating table: {e}")
+
+    def prompt_hash(self, prompt, categories):
+        return hashlib.sha256(f"{categories}\0{prompt}".encode('utf-8')).hexdigest()[:32]
+
+    def normalize_item(self, item):
+        """Splits a flat item into (row, prompt item); the prompt item is None once this process has stored or queued it."""
+        prompt_hash = self.prompt_hash(item['prompt'], item['categories'])
+        row = {key: value for key, value in item.items() if key not in ('prompt', 'categories')}
+        row['prompt_hash'] = prompt_hash
+        for attribute in self.COMPRESSED_ATTRIBUTES:
+            row[attribute] = self.compress(row[attribute].encode('utf-8'))
+        row['compression'] = self.compression
+
+        with self._prompts_lock:
+            if prompt_hash in self._stored_prompts:
+                return row, None
+            # Claimed now so the other models' rows for this prompt do not queue it again; released if the write fails
+            self._stored_prompts[prompt_hash] = True
+            if len(self._stored_prompts) > self._prompt_cache_size:
+                self._stored_prompts.popitem(last=False)
+        return row, {'prompt_hash': prompt_hash, 'prompt': item['prompt'], 'categories': item['categories']}
+
+    def forget_prompt(self, prompt_hash):
+        with self._prompts_lock:
+            self._stored_prompts.pop(prompt_hash, None)
+
+    def write_item(self, model, sentiment, categories, prompt, run_time, response, request_body, full_response, ttft=None, on_written=None):
+        """Stores one row; on_written() is called once the row is confirmed in the table. Returns False on a failed synchronous write.
+
+        Write-behind rows that run out of BatchWriteItem retries are reported by take_failed_rows after flush().
+        """
+        item = self.build_item(model, sentiment, categories, prompt, run_time, response, request_body, full_response, ttft)
+        prompt_item = None
+        if self.layout == 'normalized':
+            item, prompt_item = self.normalize_item(item)
+
+        if self.write_behind:
+            # Blocks while the buffer is full; the prompt goes first so rows never reference a missing prompt for long
+            if prompt_item is not None:
+                self._queue.put((self.prompts_table_name, prompt_item, None))
+            self._queue.put((self.table_name, item, on_written))
+            return True
+
         try:
             # Each item can store approximately 68,267 words (400 KB)
-            self.table.put_item(Item=item)
+            with self.metrics.span('db_write', model):
+                if prompt_item is not None:
+                    try:
+                        self.prompts_table.put_item(Item=prompt_item)
+                    except Exception:
+                        self.forget_prompt(prompt_item['prompt_hash'])
+                        raise
+                self.table.put_item(Item=item)
+            self.metrics.increment('db_items', model)
             print(f"Item saved successfully: {model}")
         except Exception as e:
             print(f"Error saving item for {model}: {e}")
+            return False
+        if on_written is not None:
+            on_written()
+        return True
 
-    def get_items(self, **kwargs):
-        try:
-            filter_expression = None
-            for key, value in kwargs.items():
-                if filter_expression:
-                    filter_expression = filter_expression & Attr(key).eq(value)
-                else:
-                    filter_expression = Attr(key).eq(value)
-            
-            items = []
-            last_evaluated_key = None
-
-            # Continue scanning until all pages have been retrieved
-            while True:
-                if filter_expression:
-                    if last_evaluated_key:
-                        response = self.table.scan(
-                            FilterExpression=filter_expression,
-                            ExclusiveStartKey=last_evaluated_key
-                        )
-                    else:
-                        response = self.table.scan(
-                            FilterExpression=filter_expression
-                        )
-                else:
-                    if last_evaluated_key:
-                        response = self.table.scan(
-                            ExclusiveStartKey=last_evaluated_key
-                        )
+    def _flush_loop(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            batch = [first]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._write_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def item_key(self, table_name, item):
+        return (table_name,) + tuple(item[attribute] for attribute in self.key_attributes[table_name])
+
+    def _write_batch(self, entries):
+        """Writes (table name, item, on_written) entries with BatchWriteItem, retrying unprocessed items."""
+        # BatchWriteItem rejects a request holding the same key twice, so split on duplicate keys
+        chunks, current, keys = [], [], set()
+        for table_name, item, on_written in entries:
+            key = self.item_key(table_name, item)
+            if key in keys:
+                chunks.append(current)
+                current, keys = [], set()
+            current.append((table_name, item, on_written))
+            keys.add(key)
+        chunks.append(current)
+
+        for chunk in chunks:
+            request_items = {}
+            for table_name, item, _ in chunk:
+                request_items.setdefault(table_name, []).append({'PutRequest': {'Item': item}})
+            pending = len(chunk)
+            for attempt in range(self.max_retries + 1):
+                try:
+                    with self.metrics.span('db_write'):
+                        response = self.dynamodb.batch_write_item(RequestItems=request_items)
+                    request_items = response.get('UnprocessedItems') or {}
+                except Exception as e:
+                    print(f"Error writing batch to {self.table_name}: {e}")
+
+                remaining = sum(len(requests) for requests in request_items.values())
+                self.write_counters["written"] += pending - remaining
+                self.metrics.increment('db_items', value=pending - remaining)
+                pending = remaining
+                if not request_items:
+                    break
+                if attempt < self.max_retries:
+                    self.write_counters["retries"] += 1
+                    # Exponential backoff with full jitter, capped at 20 seconds
+                    time.sleep(random.uniform(0, min(20.0, 0.05 * (2 ** attempt))))
+
+            self.write_counters["batches"] += 1
+            if pending:
+                self.write_counters["failed"] += pending
+                print(f"Error saving {pending} items to {self.table_name} after {self.max_retries} retries")
+
+            unwritten = {
+                self.item_key(table_name, request['PutRequest']['Item'])
+                for table_name, requests in request_items.items() for request in requests
+            }
+            for table_name, item, on_written in chunk:
+                if self.item_key(table_name, item) in unwritten:
+                    if table_name == self.prompts_table_name:
+                        self.forget_prompt(item['prompt_hash'])
                     else:
-                        response = self.table.scan()
-                
-                items.extend(response['Items'])
+                        # write_item already reported this row as stored; the batch summary takes it back
+                        self.record_failed_rows([item['model']])
+                    continue
+                if on_written is not None:
+                    try:
+                        on_written()
+                    except Exception as e:
+                        print(f"Error confirming write for {item['model']}: {e}")
+
+    def flush(self):
+        """Blocks until every buffered item has been written (or given up on)."""
+        if self.write_behind:
+            self._queue.join()
+
+    def close(self):
+        if self.write_behind and self._flusher is not None:
+            self.flush()
+            self._stop.set()
+            self._flusher.join()
+            self._flusher = None
+        print(f"DBInference closed: {self.write_counters}")
+
+    def get_indexes(self):
+        if self._indexes is None:
+            indexes = {}
+            # Describes the table once; tables created without GSIs simply have none
+            for index in self.table.global_secondary_indexes or []:
+                for key in index['KeySchema']:
+                    if key['KeyType'] == 'HASH':
+                        indexes[key['AttributeName']] = index['IndexName']
+            self._indexes = indexes
+        return self._indexes
 
-                last_evaluated_key = response.get('LastEvaluatedKey')
-                if not last_evaluated_key:
+    def plan_query(self, timestamp_from=None, timestamp_to=None, **kwargs):
+        """Chooses Query on the table or a GSI when a partition key is filtered on, Scan otherwise."""
+        # Only readers need the condition builders
+        from boto3.dynamodb.conditions import Key, Attr
+        conditions = dict(kwargs)
+        parameters = {}
+
+        partition_key, index_name = None, None
+        if 'model' in conditions:
+            partition_key = 'model'
+        else:
+            indexes = self.get_indexes()
+            for attribute in conditions:
+                if attribute in indexes:
+                    partition_key, index_name = attribute, indexes[attribute]
                     break
 
-            return items
-        except Exception as e:
-            print(f"Error retrieving items: {e}")
-            return []
-        
+        if partition_key is not None:
+            key_condition = Key(partition_key).eq(conditions.pop(partition_key))
+            if 'timestamp' in conditions:
+                key_condition = key_condition & Key('timestamp').eq(conditions.pop('timestamp'))
+            elif timestamp_from is not None and timestamp_to is not None:
+                key_condition = key_condition & Key('timestamp').between(timestamp_from, timestamp_to)
+            elif timestamp_from is not None:
+                key_condition = key_condition & Key('timestamp').gte(timestamp_from)
+            elif timestamp_to is not None:
+                key_condition = key_condition & Key('timestamp').lte(timestamp_to)
+            parameters['KeyConditionExpression'] = key_condition
+            if index_name:
+                parameters['IndexName'] = index_name
+            operation = 'query'
+        else:
+            operation = 'scan'
+            if timestamp_from is not None:
+                parameters['FilterExpression'] = Attr('timestamp').gte(timestamp_from)
+            if timestamp_to is not None:
+                condition_to = Attr('timestamp').lte(timestamp_to)
+                parameters['FilterExpression'] = parameters['FilterExpression'] & condition_to if 'FilterExpression' in parameters else condition_to
+
+        for key, value in conditions.items():
+            condition = Attr(key).eq(value)
+            parameters['FilterExpression'] = parameters['FilterExpression'] & condition if 'FilterExpression' in parameters else condition
+
+        return operation, parameters
+
+    def get_pages(self, timestamp_from=None, timestamp_to=None, **kwargs):
+        operation, parameters = self.plan_query(timestamp_from=timestamp_from, timestamp_to=timestamp_to, **kwargs)
+        read_page = self.table.query if operation == 'query' else self.table.scan
+        return self.paginate(read_page, parameters)
+
+    def get_segment_pages(self, segment, total_segments, with_prompts=True, **kwargs):
+        """Pages of one parallel-scan segment; run one per worker with the same total_segments.
+
+        with_prompts=False skips fetching normalized prompts for readers that do not need them.
+        """
+        from boto3.dynamodb.conditions import Attr
+        parameters = {'Segment': segment, 'TotalSegments': total_segments}
+        for key, value in kwargs.items():
+            condition = Attr(key).eq(value)
+            parameters['FilterExpression'] = parameters['FilterExpression'] & condition if 'FilterExpression' in parameters else condition
+        return self.paginate(self.table.scan, parameters, with_prompts)
+
+    def decompress(self, codec, value):
+        if codec not in self._decompressors:
+            self._decompressors[codec] = get_codec(codec)[1]
+        # boto3 returns Binary attributes wrapped in boto3.dynamodb.types.Binary
+        return self._decompressors[codec](bytes(getattr(value, 'value', value))).decode('utf-8')
+
+    def fetch_prompts(self, prompt_hashes):
+        """Loads prompt items by hash with BatchGetItem into the prompt cache."""
+        prompt_hashes = list(prompt_hashes)
+        for start in range(0, len(prompt_hashes), self.BATCH_GET_SIZE):
+            request_items = {self.prompts_table_name: {'Keys': [{'prompt_hash': prompt_hash} for prompt_hash in prompt_hashes[start:start + self.BATCH_GET_SIZE]]}}
+            for attempt in range(self.max_retries + 1):
+                response = self.dynamodb.batch_get_item(RequestItems=request_items)
+                with self._prompts_lock:
+                    for prompt_item in response.get('Responses', {}).get(self.prompts_table_name, []):
+                        self._prompt_cache[prompt_item['prompt_hash']] = prompt_item
+                        if len(self._prompt_cache) > self._prompt_cache_size:
+                            self._prompt_cache.popitem(last=False)
+                request_items = response.get('UnprocessedKeys') or {}
+                if not request_items:
+                    break
+                time.sleep(random.uniform(0, min(20.0, 0.05 * (2 ** attempt))))
+
+    def rehydrate(self, items, with_prompts=True):
+        """Turns normalized rows back into the flat layout in place; flat rows pass through unchanged."""
+        missing = set()
+        for item in items:
+            codec = item.pop('compression', None)
+            if codec is not None:
+                for attribute in self.COMPRESSED_ATTRIBUTES:
+                    if attribute in item:
+                        item[attribute] = self.decompress(codec, item[attribute])
+            if with_prompts and 'prompt_hash' in item and item['prompt_hash'] not in self._prompt_cache:
+                missing.add(item['prompt_hash'])
+
+        if missing:
+            self.fetch_prompts(missing)
+        if with_prompts:
+            for item in items:
+                prompt_item = self._prompt_cache.get(item.get('prompt_hash'))
+                if prompt_item is not None:
+                    item['prompt'] = prompt_item['prompt']
+                    item['categories'] = prompt_item['categories']
+        return items
+
+    def paginate(self, read_page, parameters, with_prompts=True):
+        # Continue until all pages have been retrieved, one page in memory at a time
+        while True:
+            response = read_page(**parameters)
+            yield self.rehydrate(response['Items'], with_prompts)
+
+            last_evaluated_key = response.get('LastEvaluatedKey')
+            if not last_evaluated_key:
+                break
+            parameters['ExclusiveStartKey'] = last_evaluated_key
+
 #     def _generate_fake_item(self):
 #         categories = {
 #             "Intensity Modifiers": self.faker.sentence(),
@@ -0,0 +1,193 @@
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import hashlib
+import json
+import os
+
+import pyarrow as pa
+
+class ShardWriter:
+    """Streams rows into one Arrow (load_from_disk layout) or Parquet file, a record batch at a time."""
+
+    def __init__(self, path, schema, file_format='arrow', batch_rows=1000):
+        self.path = path
+        self.schema = schema
+        self.file_format = file_format
+        self.batch_rows = batch_rows
+        self.columns = {name: [] for name in schema.names}
+        self.num_rows = 0
+        if file_format == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, schema)
+        else:
+            # datasets memory-maps Arrow IPC stream files written this way
+            self.sink = pa.OSFile(path, 'wb')
+            self.writer = pa.ipc.new_stream(self.sink, schema)
+
+    def write(self, row):
+        for name, values in self.columns.items():
+            values.append(row[name])
+        self.num_rows += 1
+        if len(self.columns[self.schema.names[0]]) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.columns[self.schema.names[0]]:
+            return
+        batch = pa.record_batch([pa.array(self.columns[name], type=self.schema.field(name).type) for name in self.schema.names], schema=self.schema)
+        if self.file_format == 'parquet':
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+        self.columns = {name: [] for name in self.schema.names}
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.file_format != 'parquet':
+            self.sink.close()
+
+
+class DatasetExporter:
+    LABELS = ['negative', 'positive']
+
+    def __init__(self, db_instance, output_dir, total_segments=8, max_workers=None, test_fraction=0.2, seed=42, batch_rows=1000, file_format='arrow',
+                 skip_mismatched=True):
+        self.db = db_instance
+        self.output_dir = output_dir
+        self.total_segments = total_segments
+        self.max_workers = max_workers or total_segments
+        self.test_fraction = test_fraction
+        self.seed = seed
+        self.batch_rows = batch_rows
+        self.file_format = file_format
+        # Rows SentimentVerifier tagged as not carrying their sentiment are left out of the training data
+        self.skip_mismatched = skip_mismatched
+        self.label_ids = {label: i for i, label in enumerate(self.LABELS)}
+        self.features = {
+            "text": {"dtype": "string", "_type": "Value"},
+            "label": {"names": self.LABELS, "_type": "ClassLabel"},
+            "model": {"dtype": "string", "_type": "Value"}
+        }
+        # datasets reads the feature types (ClassLabel names included) back from the schema metadata
+        self.schema = pa.schema(
+            [('text', pa.string()), ('label', pa.int64()), ('model', pa.string())],
+            metadata={"huggingface": json.dumps({"info": {"features": self.features}})}
+        )
+
+    def split_for(self, item):
+        # Hash of the row key, so the split is stable across runs and independent of scan order
+        key = f"{self.seed}:{item.get('model')}:{item.get('timestamp')}".encode('utf-8')
+        bucket = int.from_bytes(hashlib.sha1(key).digest()[:8], 'big') / 2 ** 64
+        return 'test' if bucket < self.test_fraction else 'train'
+
+    def is_mismatched(self, item):
+        # Rows tagged by SentimentVerifier carry its verdict in full_response; untagged rows are kept
+        full_response = item.get('full_response')
+        if not isinstance(full_response, str) or '"verification"' not in full_response:
+            return False
+        return json.loads(full_response).get('verification', {}).get('match') is False
+
+    def row_for(self, item):
+        label = self.label_ids.get(str(item.get('sentiment', '')).lower())
+        text = item.get('response')
+        if label is None or not isinstance(text, str) or not text.strip():
+            return None
+        if self.skip_mismatched and self.is_mismatched(item):
+            return None
+        return {'text': text.strip(), 'label': label, 'model': item.get('model', '')}
+
+    def shard_path(self, split, segment):
+        extension = 'parquet' if self.file_format == 'parquet' else 'arrow'
+        return os.path.join(self.output_dir, split, f"data-{segment:05d}-of-{self.total_segments:05d}.{extension}")
+
+    def export_segment(self, segment, **filters):
+        writers = {split: ShardWriter(self.shard_path(split, segment), self.schema, self.file_format, self.batch_rows) for split in ('train', 'test')}
+        counts = {'train': 0, 'test': 0, 'skipped': 0}
+        try:
+            # Rows only need response, sentiment and model, so normalized prompts are not fetched
+            for page in self.db.get_segment_pages(segment, self.total_segments, with_prompts=False, **filters):
+                for item in page:
+                    row = self.row_for(item)
+                    if row is None:
+                        counts['skipped'] += 1
+                        continue
+                    split = self.split_for(item)
+                    writers[split].write(row)
+                    counts[split] += 1
+        finally:
+            for writer in writers.values():
+                writer.close()
+        print(f"Segment {segment}/{self.total_segments} exported: {counts}")
+        return counts
+
+    def write_dataset_metadata(self, split, segment_counts):
+        split_dir = os.path.join(self.output_dir, split)
+        data_files = []
+        for segment, counts in enumerate(segment_counts):
+            path = self.shard_path(split, segment)
+            if counts[split]:
+                data_files.append({"filename": os.path.basename(path)})
+            else:
+                os.remove(path)
+
+        if self.file_format == 'parquet':
+            return
+
+        # Same layout Dataset.save_to_disk produces, so load_from_disk memory-maps the shards directly
+        fingerprint = hashlib.sha1(json.dumps([self.seed, self.test_fraction, split, data_files]).encode('utf-8')).hexdigest()[:16]
+        state = {
+            "_data_files": data_files,
+            "_fingerprint": fingerprint,
+            "_format_columns": None,
+            "_format_kwargs": {},
+            "_format_type": None,
+            "_output_all_columns": False,
+            "_split": split
+        }
+        with open(os.path.join(split_dir, "state.json"), 'w', encoding='utf-8') as file:
+            json.dump(state, file, indent=2)
+        with open(os.path.join(split_dir, "dataset_info.json"), 'w', encoding='utf-8') as file:
+            json.dump({"citation": "", "description": "", "features": self.features, "homepage": "", "license": ""}, file, indent=2)
+
+    def export(self, **filters):
+        for split in ('train', 'test'):
+            os.makedirs(os.path.join(self.output_dir, split), exist_ok=True)
+
+        print(f"Exporting {self.db.table_name} to {self.output_dir} with {self.total_segments} segments...")
+        totals = {'train': 0, 'test': 0, 'skipped': 0}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            segment_counts = list(executor.map(lambda segment: self.export_segment(segment, **filters), range(self.total_segments)))
+        for counts in segment_counts:
+            for key, value in counts.items():
+                totals[key] += value
+
+        for split in ('train', 'test'):
+            self.write_dataset_metadata(split, segment_counts)
+        print(f"Export finished: {totals}")
+        return totals
+
+
+def main(argv=None):
+    from StorageBackends import open_storage
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--table_name", type=str, default='ModelExecutionMetadata')
+    parser.add_argument("--backend", type=str, choices=['dynamodb', 'sqlite', 'parquet'], default='dynamodb')
+    parser.add_argument("--path", type=str, default=None, help="SQLite file or Parquet directory of a local backend")
+    parser.add_argument("--segments", type=int, default=8)
+    parser.add_argument("--test_fraction", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--format", type=str, choices=['arrow', 'parquet'], default='arrow')
+    parser.add_argument("--keep_mismatched", action="store_true", help="keep rows the sentiment verifier tagged as mismatched")
+    args = parser.parse_args(argv)
+
+    exporter = DatasetExporter(open_storage(args.backend, args.path, args.table_name), args.output_dir, total_segments=args.segments,
+                               test_fraction=args.test_fraction, seed=args.seed, file_format=args.format,
+                               skip_mismatched=not args.keep_mismatched)
+    exporter.export()
+
+
+if __name__ == "__main__":
+    main()
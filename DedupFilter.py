@@ -0,0 +1,140 @@
+import math
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+# Largest prime below 2^32; a < 2^31 and shingle hashes < 2^32 keep a * x + b inside uint64
+PRIME = np.uint64(4294967291)
+NON_WORD = re.compile(r'[^\w]+')
+
+def choose_bands(num_perm, threshold):
+    """Number of LSH bands whose S-curve midpoint (1/bands)^(1/rows) is closest to the Jaccard threshold."""
+    divisors = [bands for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    return min(divisors, key=lambda bands: abs((1 / bands) ** (bands / num_perm) - threshold))
+
+
+class DedupFilter:
+    """Streaming near-duplicate check: MinHash over character shingles, LSH bands, and a Bloom filter of band keys.
+
+    Memory is fixed by capacity (rows) and error_rate (per band lookup), whatever the number of rows seen;
+    past capacity the false drop rate grows. A response is a duplicate when any of its bands was seen before,
+    which happens with probability about 1 - (1 - J^rows)^bands for an earlier sentence of Jaccard similarity J.
+    """
+
+    def __init__(self, path=None, threshold=0.8, num_perm=64, shingle_size=5, capacity=2_000_000, error_rate=1e-4, seed=1, metrics=None):
+        self.path = path
+        self.num_perm = num_perm
+        self.bands = choose_bands(num_perm, threshold)
+        self.rows = num_perm // self.bands
+        self.shingle_size = shingle_size
+        self.capacity = capacity
+        self.seed = seed
+        self.metrics = metrics
+
+        n_keys = capacity * self.bands
+        self.n_bits = int(math.ceil(-n_keys * math.log(error_rate) / math.log(2) ** 2 / 64)) * 64
+        self.n_hashes = max(1, round(self.n_bits / n_keys * math.log(2)))
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 2 ** 31, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 2 ** 31, size=num_perm, dtype=np.uint64)
+        # Odd multipliers folding each band's rows into one 64-bit key, salted by band index
+        self.row_weights = rng.integers(1, 2 ** 63, size=self.rows, dtype=np.uint64) | np.uint64(1)
+        self.band_salts = rng.integers(0, 2 ** 63, size=self.bands, dtype=np.uint64)
+        self.probes = np.arange(self.n_hashes, dtype=np.uint64)
+
+        self.bits = np.zeros(self.n_bits // 8, dtype=np.uint8)
+        self.items = 0
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._warned = False
+        if path and os.path.exists(path):
+            self.load()
+
+    def settings(self):
+        return np.array([self.num_perm, self.bands, self.shingle_size, self.seed, self.n_bits, self.n_hashes], dtype=np.int64)
+
+    def load(self):
+        with np.load(self.path) as saved:
+            if not np.array_equal(saved['settings'], self.settings()):
+                print(f"Dedup index {self.path} was built with other settings, starting a new one")
+                return
+            self.bits = saved['bits']
+            self.items = int(saved['items'])
+        print(f"Loaded dedup index {self.path} with {self.items} sentences")
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            # np.savez appends .npz unless the name already ends with it
+            temporary = self.path + '.tmp.npz'
+            np.savez(temporary, bits=self.bits, items=np.int64(self.items), settings=self.settings())
+            os.replace(temporary, self.path)
+
+    def shingles(self, text):
+        normalized = NON_WORD.sub(' ', text.lower()).strip()
+        if len(normalized) <= self.shingle_size:
+            return {normalized}
+        return {normalized[i:i + self.shingle_size] for i in range(len(normalized) - self.shingle_size + 1)}
+
+    def signature(self, text):
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in self.shingles(text)), dtype=np.uint64)
+        return ((hashes[:, None] * self.a + self.b) % PRIME).min(axis=0)
+
+    def bit_positions(self, signature):
+        """Bloom filter bit positions, one row of n_hashes per band, by double hashing the band keys."""
+        keys = (signature.reshape(self.bands, self.rows) * self.row_weights).sum(axis=1) ^ self.band_salts
+        # splitmix64 finalizer for the second hash; uint64 arithmetic wraps as intended
+        mixed = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        mixed = (mixed ^ (mixed >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        steps = (mixed ^ (mixed >> np.uint64(31))) | np.uint64(1)
+        return (keys[:, None] + self.probes * steps[:, None]) % np.uint64(self.n_bits)
+
+    def check(self, model, text):
+        """Checks text against every sentence remembered so far; returns (duplicate, key) and counts dropped rows per model.
+
+        Pass key to remember() once the row is stored, so a row whose write fails is not dropped when it is retried.
+        Sentences checked at the same time are not compared with each other until they are remembered.
+        """
+        if not isinstance(text, str) or not text.strip():
+            return False, None
+        positions = self.bit_positions(self.signature(text))
+        byte_index, masks = positions >> np.uint64(3), np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8))
+        with self._lock:
+            duplicate = bool(((self.bits[byte_index] & masks) != 0).all(axis=1).any())
+            if duplicate:
+                self.counters.setdefault(model, {"kept": 0, "dropped": 0})["dropped"] += 1
+        if duplicate and self.metrics is not None:
+            self.metrics.increment('duplicates', model)
+        return duplicate, (byte_index, masks)
+
+    def remember(self, model, key):
+        """Adds the sentence check() returned key for to the index; counts it as kept."""
+        if key is None:
+            return
+        byte_index, masks = key
+        with self._lock:
+            self.counters.setdefault(model, {"kept": 0, "dropped": 0})["kept"] += 1
+            np.bitwise_or.at(self.bits, byte_index.ravel(), masks.ravel())
+            self.items += 1
+            if self.items > self.capacity and not self._warned:
+                self._warned = True
+                print(f"Dedup index holds {self.items} sentences, over its capacity of {self.capacity}; false drops will grow")
+
+    def is_duplicate(self, model, text):
+        """Checks text and remembers it at once, for callers that store every sentence they keep."""
+        duplicate, key = self.check(model, text)
+        if not duplicate:
+            self.remember(model, key)
+        return duplicate
+
+    def stats(self):
+        with self._lock:
+            return {"items": self.items, "bands": self.bands, "rows": self.rows, "memory_mb": round(self.bits.nbytes / 1e6, 1),
+                    "models": {model: dict(counts) for model, counts in self.counters.items()}}
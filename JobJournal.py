@@ -0,0 +1,135 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+class JobJournal:
+    """Job manifest plus an append-only event log of planned prompts, dispatches and confirmed writes."""
+
+    def __init__(self, path='.cache/jobs.sqlite'):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY, created_at REAL, manifest TEXT
+            );
+            CREATE TABLE IF NOT EXISTS plans (
+                job_id TEXT, plan_id INTEGER, prompt TEXT, sentiment TEXT, categories TEXT, created_at REAL,
+                PRIMARY KEY (job_id, plan_id)
+            );
+            CREATE TABLE IF NOT EXISTS events (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT, plan_id INTEGER, model TEXT,
+                status TEXT, detail TEXT, created_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS events_by_pair ON events (job_id, plan_id, model, status);
+        """)
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self.connection.execute(sql, parameters)
+
+    def create_job(self, n_prompts, models, job_id=None, **settings):
+        job_id = job_id or uuid.uuid4().hex[:12]
+        manifest = dict(settings, n_prompts=n_prompts, models=list(models))
+        self._execute("INSERT INTO jobs (job_id, created_at, manifest) VALUES (?, ?, ?)", (job_id, time.time(), json.dumps(manifest)))
+        print(f"Created job {job_id} for {n_prompts} prompts over {len(manifest['models'])} models")
+        return job_id
+
+    def get_manifest(self, job_id):
+        row = self._execute("SELECT manifest FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"Job {job_id} not found in {self.path}")
+        return json.loads(row[0])
+
+    def record_plan(self, job_id, plan_id, prompt, sentiment, categories_json):
+        self._execute(
+            "INSERT OR IGNORE INTO plans (job_id, plan_id, prompt, sentiment, categories, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, plan_id, prompt, sentiment, categories_json, time.time())
+        )
+
+    def record_event(self, job_id, plan_id, model, status, detail=None):
+        self._execute(
+            "INSERT INTO events (job_id, plan_id, model, status, detail, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, plan_id, model, status, detail, time.time())
+        )
+
+    def record_dispatch(self, job_id, plan_id, model):
+        self.record_event(job_id, plan_id, model, 'dispatched')
+
+    def record_written(self, job_id, plan_id, model):
+        self.record_event(job_id, plan_id, model, 'written')
+
+    def record_failed(self, job_id, plan_id, model, error=None):
+        self.record_event(job_id, plan_id, model, 'failed', str(error) if error is not None else None)
+
+    def record_dropped(self, job_id, plan_id, model):
+        # Handled but not stored, e.g. a near-duplicate response; a resumed job does not generate it again
+        self.record_event(job_id, plan_id, model, 'dropped')
+
+    def is_written(self, job_id, plan_id, model):
+        row = self._execute(
+            "SELECT 1 FROM events WHERE job_id = ? AND plan_id = ? AND model = ? AND status = 'written' LIMIT 1",
+            (job_id, plan_id, model)
+        ).fetchone()
+        return row is not None
+
+    def is_handled(self, job_id, plan_id, model):
+        """True once the pair was written or dropped."""
+        row = self._execute(
+            "SELECT 1 FROM events WHERE job_id = ? AND plan_id = ? AND model = ? AND status IN ('written', 'dropped') LIMIT 1",
+            (job_id, plan_id, model)
+        ).fetchone()
+        return row is not None
+
+    def planned_count(self, job_id):
+        return self._execute("SELECT COUNT(*) FROM plans WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+    def iter_outstanding(self, job_id, models=None):
+        """Yields (model, prompt, sentiment, categories_json, plan_id) for planned pairs with no confirmed write or drop."""
+        models = list(models or self.get_manifest(job_id)['models'])
+        with self._lock:
+            written = set(self.connection.execute(
+                "SELECT plan_id, model FROM events WHERE job_id = ? AND status IN ('written', 'dropped')", (job_id,)
+            ).fetchall())
+            plans = self.connection.execute(
+                "SELECT plan_id, prompt, sentiment, categories FROM plans WHERE job_id = ? ORDER BY plan_id", (job_id,)
+            ).fetchall()
+        for plan_id, prompt, sentiment, categories_json in plans:
+            for model in models:
+                if (plan_id, model) not in written:
+                    yield model, prompt, sentiment, categories_json, plan_id
+
+    def progress(self, job_id):
+        manifest = self.get_manifest(job_id)
+        with self._lock:
+            written = self.connection.execute(
+                "SELECT COUNT(*) FROM (SELECT DISTINCT plan_id, model FROM events WHERE job_id = ? AND status = 'written')", (job_id,)
+            ).fetchone()[0]
+            failed = self.connection.execute(
+                "SELECT COUNT(*) FROM events WHERE job_id = ? AND status = 'failed'", (job_id,)
+            ).fetchone()[0]
+            dropped = self.connection.execute(
+                "SELECT COUNT(*) FROM (SELECT DISTINCT plan_id, model FROM events WHERE job_id = ? AND status = 'dropped')", (job_id,)
+            ).fetchone()[0]
+        planned = self.planned_count(job_id)
+        return {
+            "job_id": job_id,
+            "prompts_planned": planned,
+            "prompts_total": manifest['n_prompts'],
+            "pairs_total": manifest['n_prompts'] * len(manifest['models']),
+            "pairs_written": written,
+            "pairs_dropped": dropped,
+            "failures_logged": failed
+        }
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
@@ -1,16 +1,47 @@
-import requests
-import json
+import copy
 import time
 import os
 
+from LLMs.ConnectionPool import get_default_pool
+from LLMs.Hedging import ServerError
+from LLMs.Metrics import get_default_metrics
+from LLMs.RateLimiter import ThrottledError, get_default_rate_limiter, parse_retry_after
+from LLMs.Serialization import compile_path, dumpb, loads
+from LLMs.Streaming import SentenceCollector, build_from_path, cache_mode
+from LLMs.TokenCounter import get_default_token_counter
+
 class ContentGenerator:
-    def __init__(self, api_key):
+    def __init__(self, api_key, pool=None, token_counter=None, cache=None, rate_limiter=None, metrics=None, base_url=None, hedge_urls=None, hedging=None):
         self.api_key = api_key
+        # Keep-alive connections are shared with every other client built on the same pool
+        self.pool = pool or get_default_pool()
+        # Shared by default so a prompt sent to several models is tokenized once per family
+        self.token_counter = token_counter or get_default_token_counter()
+        # Optional ResponseCache in front of the API
+        self.cache = cache
+        # Per (provider, model) token buckets and AIMD concurrency, retried on HTTP 429
+        self.rate_limiter = rate_limiter or get_default_rate_limiter()
+        # Stage timings (request_build, network, ttfb, parse, token_count) per model
+        self.metrics = metrics or get_default_metrics()
         # Mapping model IDs to their base URLs
         self.base_url = {
             "gemini-pro": 'https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent?key=',
             "gpt-4": 'https://api.openai.com/v1/chat/completions'
         }
+        # Per-model endpoint overrides, e.g. a local stand-in server for benchmarks
+        self.base_url.update(base_url or {})
+        # Optional HedgePolicy with an equivalent endpoint per model (another region or gateway of the same API)
+        # that slow or failed calls are repeated against; both share the provider's rate limiter
+        self.hedge_urls = hedge_urls or {}
+        self.hedging = hedging
+        if hedging is not None:
+            # Threaded hedged calls open an aiohttp session on the policy's event loop
+            hedging.at_close(self.pool.aclose)
+        # Provider behind each model, used to share concurrency limits between models of one API
+        self.providers = {
+            "gemini-pro": "gemini",
+            "gpt-4": "openai"
+        }
         self.default_parameters = { 
             "gemini-pro": {
                 "safetySettings": [{"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"}],
@@ -28,12 +59,13 @@ class ContentGenerator:
             'gemini-pro': ['candidates', 0, 'content', 'parts', 0, 'text'],
             'gpt-4': ['choices', 0, 'message', 'content']
         }
+        # Paths compiled once into subscript chains instead of being walked key by key per response
+        self.extractors = {model_id: compile_path(path) for model_id, path in self.response_paths.items()}
 
-    def call_model_api(self, model_id, prompt, custom_parameters=None):
+    def build_request(self, model_id, prompt, custom_parameters=None):
         base_url = self.base_url.get(model_id, '')
         if not base_url:
-            print(f"Base URL for model {model_id} not found.")
-            return {}, 0
+            return None, None, None
 
         headers = {'Content-Type': 'application/json'}
         if model_id == "gpt-4":
@@ -53,50 +85,296 @@ class ContentGenerator:
             if custom_parameters:
                 # Directly apply the known correct structure for Gemini custom parameters
                 body.update(custom_parameters)
+        return url, headers, body
 
-        start_time = time.time()
-        response = requests.post(url, headers=headers, data=json.dumps(body))
-        end_time = time.time()
-        duration = end_time - start_time
-        
-        if response.status_code != 200:
-            print(f"Error calling {model_id} API. HTTP Status: {response.status_code}, Response Body: {response.text}")
-            return {"error": "API call failed", "details": response.text, "status_code": response.status_code}, duration
-        
-        return body, response.json(), duration
+    def handle_response(self, model_id, status_code, response_content):
+        # Successful bodies are parsed straight from the raw bytes, without decoding them to str first
+        if status_code != 200:
+            response_text = response_content.decode('utf-8', 'replace') if isinstance(response_content, bytes) else response_content
+            print(f"Error calling {model_id} API. HTTP Status: {status_code}, Response Body: {response_text}")
+            return {"error": "API call failed", "details": response_text, "status_code": status_code}
+        return loads(response_content)
 
-    def count_tokens(self, text):
+    def call_model_api(self, model_id, prompt, custom_parameters=None):
+        url, headers, body = self.build_request(model_id, prompt, custom_parameters)
+        return self.send_request(model_id, url, headers, body, self.estimate_tokens(model_id, prompt, custom_parameters))
+
+    def estimate_tokens(self, model_id, prompt, parameters):
+        # Prompt tokens plus the output budget, reserved against the tokens/min bucket before sending
+        parameters = parameters or {}
+        max_output = parameters.get('max_tokens') or parameters.get('generationConfig', {}).get('maxOutputTokens') or 0
+        with self.metrics.span('token_count', model_id):
+            return self.token_counter.count(model_id, prompt) + max_output
+
+    def get_limiter(self, model_id):
+        return self.rate_limiter.get(self.providers.get(model_id, model_id), model_id)
+
+    def raise_for_throttle(self, status_code, headers, result):
+        if status_code == 429:
+            raise ThrottledError("HTTP 429", parse_retry_after(headers.get('Retry-After')), result)
+
+    def check_status(self, model_id, status_code, headers, result):
+        self.raise_for_throttle(status_code, headers, result)
+        # A 5xx fails a hedged call over to its backup like a throttle does
+        if status_code >= 500:
+            raise ServerError(f"HTTP {status_code}", result)
+        # Timed inside the limiter slot, so the hedge delay is the provider's latency without the limiter's queueing
+        if self.hedging is not None and status_code == 200:
+            self.hedging.observe(model_id, result[2])
+
+    def hedge_url(self, model_id, url, stream=False):
+        if self.hedging is None or model_id not in self.hedge_urls:
+            return None
+        base_url, hedge_url = self.base_url[model_id], self.hedge_urls[model_id]
+        if stream:
+            base_url, hedge_url = self.stream_endpoint(model_id, base_url), self.stream_endpoint(model_id, hedge_url)
+        return url.replace(base_url, hedge_url, 1)
+
+    def send_request(self, model_id, url, headers, body, estimated_tokens=0):
+        if url is None:
+            print(f"Base URL for model {model_id} not found.")
+            return {}, {"error": f"Base URL for model {model_id} not found."}, 0
+
+        data = dumpb(body)
+
+        def post(url):
+            self.metrics.increment('requests', model_id)
+            start_time = time.time()
+            with self.metrics.span('network', model_id):
+                response = self.pool.session.post(url, headers=headers, data=data)
+            end_time = time.time()
+            duration = end_time - start_time
+            # requests measures elapsed up to the parsed response headers
+            self.metrics.observe('ttfb', response.elapsed.total_seconds(), model_id)
+            result = (response.status_code, response.content, duration)
+            self.check_status(model_id, response.status_code, response.headers, result)
+            return result
+
+        backup_url = self.hedge_url(model_id, url)
+        try:
+            if backup_url is None:
+                status_code, response_content, duration = self.get_limiter(model_id).call(lambda: post(url), estimated_tokens, self.rate_limiter.max_retries, model_id)
+            else:
+                # Raced on the hedge policy's event loop, so the waiting thread is this one
+                status_code, response_content, duration = self.hedging.run(model_id, lambda: self.acall_url(model_id, url, headers, data, estimated_tokens),
+                                                                           lambda: self.acall_url(model_id, backup_url, headers, data, estimated_tokens))
+        except (ThrottledError, ServerError) as e:
+            status_code, response_content, duration = e.result
+        return body, self.handle_response(model_id, status_code, response_content), duration
+
+    async def aclose(self):
+        await self.pool.aclose()
+
+    async def acall_model_api(self, model_id, prompt, custom_parameters=None):
+        url, headers, body = self.build_request(model_id, prompt, custom_parameters)
+        return await self.asend_request(model_id, url, headers, body, self.estimate_tokens(model_id, prompt, custom_parameters))
+
+    async def asend_request(self, model_id, url, headers, body, estimated_tokens=0):
+        if url is None:
+            print(f"Base URL for model {model_id} not found.")
+            return {}, {"error": f"Base URL for model {model_id} not found."}, 0
+
+        data = dumpb(body)
+        backup_url = self.hedge_url(model_id, url)
+        try:
+            if backup_url is None:
+                status_code, response_content, duration = await self.acall_url(model_id, url, headers, data, estimated_tokens)
+            else:
+                status_code, response_content, duration = await self.hedging.arun(model_id, lambda: self.acall_url(model_id, url, headers, data, estimated_tokens),
+                                                                                  lambda: self.acall_url(model_id, backup_url, headers, data, estimated_tokens))
+        except (ThrottledError, ServerError) as e:
+            status_code, response_content, duration = e.result
+        return body, self.handle_response(model_id, status_code, response_content), duration
+
+    async def acall_url(self, model_id, url, headers, data, estimated_tokens=0):
+        """One rate limited POST of data to url; returns (status code, response bytes, duration)."""
+        session = await self.pool.get_async_session()
+
+        async def post():
+            self.metrics.increment('requests', model_id)
+            start_time = time.time()
+            network_start = time.perf_counter()
+            async with session.post(url, headers=headers, data=data) as response:
+                self.metrics.observe('ttfb', time.perf_counter() - network_start, model_id)
+                response_content = await response.read()
+                self.metrics.observe('network', time.perf_counter() - network_start, model_id)
+                end_time = time.time()
+                duration = end_time - start_time
+                result = (response.status, response_content, duration)
+                self.check_status(model_id, response.status, response.headers, result)
+            return result
+
+        return await self.get_limiter(model_id).acall(post, estimated_tokens, self.rate_limiter.max_retries, model_id)
+
+    def stream_endpoint(self, model_id, base_url):
+        """The streaming form of a model endpoint; Gemini streams the same GenerateContentResponse chunks as server-sent events."""
+        if model_id == "gpt-4":
+            return base_url
+        path, _, query = base_url.partition('?')
+        if path.endswith(':generateContent'):
+            path = path[:-len(':generateContent')] + ':streamGenerateContent'
+        return f"{path}?alt=sse&{query or 'key='}"
+
+    def build_stream_request(self, model_id, prompt, custom_parameters=None):
+        url, headers, body = self.build_request(model_id, prompt, custom_parameters)
+        if url is None:
+            return url, headers, body
+        if model_id == "gpt-4":
+            body["stream"] = True
+        # build_request puts the configured endpoint first, so only that part changes
+        base_url = self.base_url[model_id]
+        url = self.stream_endpoint(model_id, base_url) + url[len(base_url):]
+        return url, headers, body
+
+    def parse_stream_event(self, model_id, line):
+        """Returns (text piece, done) for one SSE line."""
+        if not line or not line.startswith('data:'):
+            return "", False
+        data = line[5:].strip()
+        if data == '[DONE]':
+            return "", True
+        event = loads(data)
+        if model_id == "gpt-4":
+            choices = event.get('choices') or [{}]
+            return choices[0].get('delta', {}).get('content') or "", False
+        candidates = event.get('candidates') or [{}]
+        parts = candidates[0].get('content', {}).get('parts') or [{}]
+        return parts[0].get('text') or "", False
+
+    def build_stream_response(self, model_id, collector, duration):
+        full_response = build_from_path(self.response_paths[model_id], collector.text)
+        full_response['streaming'] = collector.summary(duration)
+        full_response['ttft'] = collector.ttft
+        return full_response
+
+    def stream_request(self, model_id, url, headers, body, estimated_tokens=0, stop_at_sentence=True):
+        if url is None:
+            print(f"Base URL for model {model_id} not found.")
+            return {}, {"error": f"Base URL for model {model_id} not found."}, 0
+
+        data = dumpb(body)
+
+        def post():
+            self.metrics.increment('requests', model_id)
+            start_time = time.time()
+            network_start = time.perf_counter()
+            response = self.pool.session.post(url, headers=headers, data=data, stream=True)
+            self.metrics.observe('ttfb', response.elapsed.total_seconds(), model_id)
+            try:
+                if response.status_code != 200:
+                    result = (response.status_code, response.content, time.time() - start_time)
+                    self.check_status(model_id, response.status_code, response.headers, result)
+                    return result
+                collector = SentenceCollector(start_time, stop_at_sentence)
+                for raw_line in response.iter_lines():
+                    piece, done = self.parse_stream_event(model_id, raw_line.decode('utf-8'))
+                    # Closing the response early stops generation and output-token billing
+                    if done or collector.add(piece):
+                        break
+                self.metrics.observe('ttft', collector.ttft, model_id)
+                result = (200, collector, time.time() - start_time)
+                self.check_status(model_id, 200, response.headers, result)
+                return result
+            finally:
+                response.close()
+                self.metrics.observe('network', time.perf_counter() - network_start, model_id)
+
+        backup_url = self.hedge_url(model_id, url, stream=True)
+        try:
+            if backup_url is None:
+                status_code, result, duration = self.get_limiter(model_id).call(post, estimated_tokens, self.rate_limiter.max_retries, model_id)
+            else:
+                # Raced on the hedge policy's event loop like send_request, failing over on a throttle or a 5xx
+                status_code, result, duration = self.hedging.run(model_id, lambda: self.acall_stream(model_id, url, headers, data, estimated_tokens, stop_at_sentence),
+                                                                 lambda: self.acall_stream(model_id, backup_url, headers, data, estimated_tokens, stop_at_sentence))
+        except (ThrottledError, ServerError) as e:
+            status_code, result, duration = e.result
+        if status_code != 200:
+            return body, self.handle_response(model_id, status_code, result), duration
+        return body, self.build_stream_response(model_id, result, duration), duration
+
+    async def astream_request(self, model_id, url, headers, body, estimated_tokens=0, stop_at_sentence=True):
+        if url is None:
+            print(f"Base URL for model {model_id} not found.")
+            return {}, {"error": f"Base URL for model {model_id} not found."}, 0
+
+        data = dumpb(body)
+        backup_url = self.hedge_url(model_id, url, stream=True)
+        try:
+            if backup_url is None:
+                status_code, result, duration = await self.acall_stream(model_id, url, headers, data, estimated_tokens, stop_at_sentence)
+            else:
+                status_code, result, duration = await self.hedging.arun(model_id, lambda: self.acall_stream(model_id, url, headers, data, estimated_tokens, stop_at_sentence),
+                                                                        lambda: self.acall_stream(model_id, backup_url, headers, data, estimated_tokens, stop_at_sentence))
+        except (ThrottledError, ServerError) as e:
+            status_code, result, duration = e.result
+        if status_code != 200:
+            return body, self.handle_response(model_id, status_code, result), duration
+        return body, self.build_stream_response(model_id, result, duration), duration
+
+    async def acall_stream(self, model_id, url, headers, data, estimated_tokens=0, stop_at_sentence=True):
+        """One rate limited streamed POST; returns (200, SentenceCollector, duration) or (status code, response bytes, duration)."""
+        session = await self.pool.get_async_session()
+
+        async def post():
+            self.metrics.increment('requests', model_id)
+            start_time = time.time()
+            network_start = time.perf_counter()
+            async with session.post(url, headers=headers, data=data) as response:
+                self.metrics.observe('ttfb', time.perf_counter() - network_start, model_id)
+                if response.status != 200:
+                    result = (response.status, await response.read(), time.time() - start_time)
+                    self.check_status(model_id, response.status, response.headers, result)
+                    return result
+                collector = SentenceCollector(start_time, stop_at_sentence)
+                async for raw_line in response.content:
+                    piece, done = self.parse_stream_event(model_id, raw_line.decode('utf-8').strip())
+                    if done or collector.add(piece):
+                        break
+                self.metrics.observe('ttft', collector.ttft, model_id)
+                self.metrics.observe('network', time.perf_counter() - network_start, model_id)
+                result = (200, collector, time.time() - start_time)
+                self.check_status(model_id, 200, response.headers, result)
+                return result
+
+        return await self.get_limiter(model_id).acall(post, estimated_tokens, self.rate_limiter.max_retries, model_id)
+
+    def build_count_tokens_request(self, text):
         gemini_api_key = os.getenv("GEMINI_API_KEY")
         url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:countTokens?key={gemini_api_key}'
         headers = {'Content-Type': 'application/json'}
         data = {"contents": [{"parts": [{"text": text}]}]}
-        response = requests.post(url, headers=headers, data=json.dumps(data))
-        if response.status_code == 200:
-            return response.json()['totalTokens']
+        return url, headers, data
+
+    def handle_count_tokens_response(self, status_code, response_text):
+        if status_code == 200:
+            return loads(response_text)['totalTokens']
         else:
-            print(f"Error in count_tokens: {response.status_code}, {response.text}")
+            print(f"Error in count_tokens: {status_code}, {response_text}")
             return None
 
-    def extract_response_text(self, model_id, response):
+    def count_tokens(self, text):
+        # Exact Gemini count over the network; the invoke path counts locally through self.token_counter
+        url, headers, data = self.build_count_tokens_request(text)
+        response = self.pool.session.post(url, headers=headers, data=dumpb(data))
+        return self.handle_count_tokens_response(response.status_code, response.text)
+
+    def extract_text(self, model_id, response):
         # Check if the model ID is supported and has a defined response path
         if model_id not in self.response_paths:
             print(f"Model ID {model_id} not supported.")
-            return "Model ID not supported.", 0  # Adjusted to return 0 as token count in case of error
-    
-        path = self.response_paths[model_id]
-        text = response  # Assuming 'response' is already a Python dictionary (decoded JSON)
-
-        # Navigate through the response using the path to extract the text
-        for key in path:
-            if isinstance(text, dict) and key in text:
-                text = text[key]
-            elif isinstance(text, list) and isinstance(key, int) and len(text) > key:
-                text = text[key]
-            else:
-                return "Path extraction error.", 0  # Adjusted to return 0 as token count in case of error
-    
-        # Calculate the token count for the extracted text
-        token_count = self.count_tokens(text)
+            return None
+
+        # 'response' is the decoded JSON; None when it does not have the expected shape
+        return self.extractors[model_id](response)
+
+    def extract_response_text(self, model_id, response):
+        text = self.extract_text(model_id, response)
+        if text is None:
+            return ("Model ID not supported." if model_id not in self.response_paths else "Path extraction error."), 0
+
+        # Calculate the token count for the extracted text locally, without a countTokens round trip
+        token_count = self.token_counter.count(model_id, text)
         return text, token_count
 
     def deep_merge_dicts(self, default_dict, custom_dict):
@@ -106,30 +384,116 @@ class ContentGenerator:
                 self.deep_merge_dicts(default_dict[key], value)
             else:
                 default_dict[key] = value
-                
-    def invoke_model(self, model_id, prompt, custom_parameters=None):
-        # Get a copy of the default parameters for the model_id
-        parameters = self.default_parameters.get(model_id, {}).copy()
+
+    def build_parameters(self, model_id, custom_parameters=None):
+        # Deep copy so merging nested sections never mutates the defaults
+        parameters = copy.deepcopy(self.default_parameters.get(model_id, {}))
         
         # Perform a deep merge if custom_parameters is not None
         if custom_parameters is not None:
             self.deep_merge_dicts(parameters, custom_parameters)
+        return parameters
 
-        # Pass parameters to call_model_api
-        body, full_response, duration = self.call_model_api(model_id, prompt, parameters)
-
-        # Extract the response and count tokens based on the full response
-        extracted_response, output_token_count = self.extract_response_text(model_id, full_response)
-
-        # Count input tokens
-        input_token_count = self.count_tokens(prompt)
-
+    def add_token_counts(self, full_response, input_token_count, output_token_count):
         # Include token count in the response
         if 'tokenCount' not in full_response:
             full_response['tokenCount'] = {}
         full_response['tokenCount']['input'] = input_token_count
         full_response['tokenCount']['output'] = output_token_count
+        return full_response
+                
+    def count_invocation_tokens(self, model_id, prompt, full_response):
+        with self.metrics.span('parse', model_id):
+            extracted_response = self.extract_text(model_id, full_response)
+        if extracted_response is None:
+            extracted_response = "Model ID not supported." if model_id not in self.response_paths else "Path extraction error."
+            with self.metrics.span('token_count', model_id):
+                input_token_count, _ = self.token_counter.count_invocation(model_id, prompt, "", full_response)
+            return extracted_response, input_token_count, 0
+
+        # Prefer the provider's usage block, otherwise count both sides with the local tokenizer
+        with self.metrics.span('token_count', model_id):
+            input_token_count, output_token_count = self.token_counter.count_invocation(model_id, prompt, extracted_response, full_response)
+        return extracted_response, input_token_count, output_token_count
+                
+    def cache_lookup(self, model_id, body, use_cache, mode=None):
+        if self.cache is None or not use_cache or body is None:
+            return None
+        return self.cache.get(model_id, body, mode)
+
+    def cache_store(self, model_id, body, extracted_response, full_response, duration, mode=None):
+        # Only successful calls are worth replaying
+        if self.cache is not None and body and 'error' not in full_response:
+            self.cache.set(model_id, body, extracted_response, full_response, duration, mode)
+
+    def invoke_model(self, model_id, prompt, custom_parameters=None, use_cache=True):
+        with self.metrics.span('request_build', model_id):
+            parameters = self.build_parameters(model_id, custom_parameters)
+            url, headers, body = self.build_request(model_id, prompt, parameters)
+
+        cached = self.cache_lookup(model_id, body, use_cache)
+        if cached is not None:
+            return cached
+
+        body, full_response, duration = self.send_request(model_id, url, headers, body, self.estimate_tokens(model_id, prompt, parameters))
+
+        # Extract the response and count input/output tokens
+        extracted_response, input_token_count, output_token_count = self.count_invocation_tokens(model_id, prompt, full_response)
+
+        self.add_token_counts(full_response, input_token_count, output_token_count)
+        self.cache_store(model_id, body, extracted_response, full_response, duration)
+        return extracted_response, body, full_response, duration
+
+    async def ainvoke_model(self, model_id, prompt, custom_parameters=None, use_cache=True):
+        with self.metrics.span('request_build', model_id):
+            parameters = self.build_parameters(model_id, custom_parameters)
+            url, headers, body = self.build_request(model_id, prompt, parameters)
+
+        cached = self.cache_lookup(model_id, body, use_cache)
+        if cached is not None:
+            return cached
+
+        body, full_response, duration = await self.asend_request(model_id, url, headers, body, self.estimate_tokens(model_id, prompt, parameters))
+
+        extracted_response, input_token_count, output_token_count = self.count_invocation_tokens(model_id, prompt, full_response)
+
+        self.add_token_counts(full_response, input_token_count, output_token_count)
+        self.cache_store(model_id, body, extracted_response, full_response, duration)
+        return extracted_response, body, full_response, duration
+
+    def invoke_model_stream(self, model_id, prompt, custom_parameters=None, use_cache=True, stop_at_sentence=True):
+        """Like invoke_model, but streams the completion and stops at the end of the first sentence."""
+        with self.metrics.span('request_build', model_id):
+            parameters = self.build_parameters(model_id, custom_parameters)
+            url, headers, body = self.build_stream_request(model_id, prompt, parameters)
+
+        cached = self.cache_lookup(model_id, body, use_cache, cache_mode(stop_at_sentence))
+        if cached is not None:
+            return cached
+
+        body, full_response, duration = self.stream_request(model_id, url, headers, body, self.estimate_tokens(model_id, prompt, parameters), stop_at_sentence)
+
+        extracted_response, input_token_count, output_token_count = self.count_invocation_tokens(model_id, prompt, full_response)
+
+        self.add_token_counts(full_response, input_token_count, output_token_count)
+        self.cache_store(model_id, body, extracted_response, full_response, duration, cache_mode(stop_at_sentence))
+        return extracted_response, body, full_response, duration
+
+    async def ainvoke_model_stream(self, model_id, prompt, custom_parameters=None, use_cache=True, stop_at_sentence=True):
+        with self.metrics.span('request_build', model_id):
+            parameters = self.build_parameters(model_id, custom_parameters)
+            url, headers, body = self.build_stream_request(model_id, prompt, parameters)
+
+        cached = self.cache_lookup(model_id, body, use_cache, cache_mode(stop_at_sentence))
+        if cached is not None:
+            return cached
+
+        body, full_response, duration = await self.astream_request(model_id, url, headers, body, self.estimate_tokens(model_id, prompt, parameters), stop_at_sentence)
+
+        extracted_response, input_token_count, output_token_count = self.count_invocation_tokens(model_id, prompt, full_response)
 
+        self.add_token_counts(full_response, input_token_count, output_token_count)
+        self.cache_store(model_id, body, extracted_response, full_response, duration, cache_mode(stop_at_sentence))
         return extracted_response, body, full_response, duration
 
 # # Example usage
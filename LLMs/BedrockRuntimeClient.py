@@ -1,10 +1,39 @@
-import boto3
-import json
+import asyncio
+import contextlib
 import time
+from botocore.exceptions import ClientError
+
+from LLMs.ConnectionPool import get_default_pool
+from LLMs.Metrics import get_default_metrics
+from LLMs.RateLimiter import ThrottledError, get_default_rate_limiter
+from LLMs.Serialization import compile_path, dumpb, loads
+from LLMs.Streaming import SentenceCollector, build_from_path, cache_mode
+from LLMs.TokenCounter import get_default_token_counter
 
 class BedrockRuntimeClient:
-    def __init__(self):
-        self.brt_client = boto3.client(service_name='bedrock-runtime')
+    THROTTLING_ERRORS = ('ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException')
+
+    def __init__(self, pool=None, token_counter=None, cache=None, rate_limiter=None, metrics=None, region_name=None, hedge_regions=(), hedging=None):
+        self.pool = pool or get_default_pool()
+        # Prompt tokens for the rate limiter; shared by default, or any object with the TokenCounter.count interface
+        self.token_counter = token_counter or get_default_token_counter()
+        # region_name=None is the pool's (or the AWS configuration's) default region
+        self.region_name = region_name
+        self.brt_client = self.pool.client('bedrock-runtime', region_name=region_name)
+        # Optional HedgePolicy: slow or failed calls are repeated in the next of hedge_regions
+        self.hedge_regions = list(hedge_regions)
+        self.hedge_clients = {region: self.pool.client('bedrock-runtime', region_name=region) for region in self.hedge_regions}
+        self.hedging = hedging
+        if hedging is not None and self.hedge_regions:
+            # Threaded hedged calls open aiobotocore clients on the policy's event loop
+            hedging.at_close(self.aclose)
+        self._next_hedge_region = 0
+        # Optional ResponseCache in front of invoke_model
+        self.cache = cache
+        # Per-model token buckets and AIMD concurrency, retried on ThrottlingException
+        self.rate_limiter = rate_limiter or get_default_rate_limiter()
+        # Stage timings (request_build, network, parse, token_count) per model
+        self.metrics = metrics or get_default_metrics()
         self.default_parameters = {
             'ai21.j2-ultra-v1': {
                 'maxTokens': 200,
@@ -38,13 +67,197 @@ class BedrockRuntimeClient:
             'meta.llama2-70b-chat-v1': ['generation'],
             'anthropic.claude-v2': ['completion']
         }
+        # Text of one invoke_model_with_response_stream chunk; AI21 Jurassic-2 has no streaming API
+        self.stream_paths = {
+            'amazon.titan-text-express-v1': ['outputText'],
+            'meta.llama2-70b-chat-v1': ['generation'],
+            'anthropic.claude-v2': ['completion']
+        }
+        # Paths compiled once into subscript chains instead of being walked key by key per response
+        self.extractors = {model_id: compile_path(path) for model_id, path in self.response_paths.items()}
+        self.stream_extractors = {model_id: compile_path(path) for model_id, path in self.stream_paths.items()}
+        self._async_clients = {}
+        self._async_exit_stack = None
+
+    def is_throttle(self, error):
+        # Errors raised from inside an event stream use camelCase codes such as throttlingException
+        code = error.response.get('Error', {}).get('Code', '') if isinstance(error, ClientError) else ''
+        return code.lower() in {name.lower() for name in self.THROTTLING_ERRORS}
+
+    @contextlib.contextmanager
+    def translate_throttle(self):
+        try:
+            yield
+        except ClientError as e:
+            if self.is_throttle(e):
+                raise ThrottledError(e.response['Error']['Code']) from e
+            raise
+
+    def get_limiter(self, model_id, region=None):
+        # Bedrock quotas are per region, so every hedge region has its own limiter
+        return self.rate_limiter.get('bedrock' if region is None else f'bedrock:{region}', model_id)
+
+    def get_client(self, region=None):
+        return self.brt_client if region is None else self.hedge_clients[region]
+
+    def next_hedge_region(self):
+        region = self.hedge_regions[self._next_hedge_region % len(self.hedge_regions)]
+        self._next_hedge_region += 1
+        return region
+
+    def hedged(self):
+        return self.hedging is not None and bool(self.hedge_regions)
+
+    def call_model_api(self, body, model_id, estimated_tokens=0):
+        """Returns (response, response body or None when it is still unread, duration)."""
+        if not self.hedged():
+            response, duration = self.call_region(None, body, model_id, estimated_tokens)
+            return response, None, duration
+        # Raced on the hedge policy's event loop, so the waiting thread is this one
+        backup_region = self.next_hedge_region()
+        return self.hedging.run(model_id,
+                                lambda: self.acall_region(None, body, model_id, estimated_tokens),
+                                lambda: self.acall_region(backup_region, body, model_id, estimated_tokens))
+
+    def observe_latency(self, model_id, duration):
+        # Timed inside the limiter slot, so the hedge delay is Bedrock's latency without the limiter's queueing
+        if self.hedging is not None:
+            self.hedging.observe(model_id, duration)
+
+    def call_region(self, region, body, model_id, estimated_tokens=0):
+        client = self.get_client(region)
+
+        def invoke():
+            self.metrics.increment('requests', model_id)
+            start_time = time.time()
+            # The body is read while parsing, so this span ends once the response headers arrive
+            with self.translate_throttle(), self.metrics.span('network', model_id):
+                response = client.invoke_model(body=body, modelId=model_id, accept='application/json', contentType='application/json')
+            end_time = time.time()
+            duration = end_time - start_time
+            self.observe_latency(model_id, duration)
+            return response, duration
+
+        return self.get_limiter(model_id, region).call(invoke, estimated_tokens, self.rate_limiter.max_retries, model_id)
+
+    def extract_stream_piece(self, model_id, chunk_bytes):
+        return self.stream_extractors[model_id](loads(chunk_bytes)) or ""
+
+    def call_model_stream(self, body, model_id, estimated_tokens=0, stop_at_sentence=True):
+        def invoke():
+            self.metrics.increment('requests', model_id)
+            start_time = time.time()
+            with self.translate_throttle(), self.metrics.span('network', model_id):
+                response = self.brt_client.invoke_model_with_response_stream(body=body, modelId=model_id, accept='application/json', contentType='application/json')
+                collector = SentenceCollector(start_time, stop_at_sentence)
+                stream = response['body']
+                try:
+                    for event in stream:
+                        # Closing the stream early stops generation and output-token billing
+                        if 'chunk' in event and collector.add(self.extract_stream_piece(model_id, event['chunk']['bytes'])):
+                            break
+                finally:
+                    stream.close()
+            self.metrics.observe('ttft', collector.ttft, model_id)
+            end_time = time.time()
+            duration = end_time - start_time
+            return response, collector, duration
+
+        return self.get_limiter(model_id).call(invoke, estimated_tokens, self.rate_limiter.max_retries, model_id)
+
+    async def get_async_client(self, region=None):
+        # aiobotocore is optional; without it the async path falls back to the thread pool
+        if region not in self._async_clients:
+            try:
+                from aiobotocore.config import AioConfig
+                from aiobotocore.session import get_session
+            except ImportError:
+                return None
+            if self._async_exit_stack is None:
+                self._async_exit_stack = contextlib.AsyncExitStack()
+            self._async_clients[region] = await self._async_exit_stack.enter_async_context(
+                get_session().create_client(
+                    'bedrock-runtime',
+                    region_name=self.get_client(region).meta.region_name,
+                    config=AioConfig(max_pool_connections=self.pool.max_connections)
+                )
+            )
+        return self._async_clients[region]
+
+    async def aclose(self):
+        if self._async_exit_stack is not None:
+            await self._async_exit_stack.aclose()
+        self._async_clients = {}
+        self._async_exit_stack = None
+
+    async def acall_model_api(self, body, model_id, estimated_tokens=0):
+        if not self.hedged():
+            return await self.acall_region(None, body, model_id, estimated_tokens)
+        backup_region = self.next_hedge_region()
+        return await self.hedging.arun(model_id,
+                                       lambda: self.acall_region(None, body, model_id, estimated_tokens),
+                                       lambda: self.acall_region(backup_region, body, model_id, estimated_tokens))
+
+    async def acall_region(self, region, body, model_id, estimated_tokens=0):
+        async_client = await self.get_async_client(region)
+        if async_client is None:
+            loop = asyncio.get_running_loop()
+            response, duration = await loop.run_in_executor(None, self.call_region, region, body, model_id, estimated_tokens)
+            return response, self.decode_response_body(response), duration
+
+        async def invoke():
+            self.metrics.increment('requests', model_id)
+            start_time = time.time()
+            with self.translate_throttle(), self.metrics.span('network', model_id):
+                response = await async_client.invoke_model(body=body, modelId=model_id, accept='application/json', contentType='application/json')
+                response_body = loads(await response['body'].read())
+            end_time = time.time()
+            duration = end_time - start_time
+            self.observe_latency(model_id, duration)
+            return response, response_body, duration
+
+        return await self.get_limiter(model_id, region).acall(invoke, estimated_tokens, self.rate_limiter.max_retries, model_id)
+
+    async def acall_model_stream(self, body, model_id, estimated_tokens=0, stop_at_sentence=True):
+        async_client = await self.get_async_client()
+        if async_client is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.call_model_stream, body, model_id, estimated_tokens, stop_at_sentence)
 
-    def call_model_api(self, body, model_id):
-        start_time = time.time()
-        response = self.brt_client.invoke_model(body=body, modelId=model_id, accept='application/json', contentType='application/json')
-        end_time = time.time()
-        duration = end_time - start_time
-        return response, duration
+        async def invoke():
+            self.metrics.increment('requests', model_id)
+            start_time = time.time()
+            with self.translate_throttle(), self.metrics.span('network', model_id):
+                response = await async_client.invoke_model_with_response_stream(body=body, modelId=model_id, accept='application/json', contentType='application/json')
+                collector = SentenceCollector(start_time, stop_at_sentence)
+                stream = response['body']
+                try:
+                    async for event in stream:
+                        if 'chunk' in event and collector.add(self.extract_stream_piece(model_id, event['chunk']['bytes'])):
+                            break
+                finally:
+                    stream.close()
+            self.metrics.observe('ttft', collector.ttft, model_id)
+            end_time = time.time()
+            duration = end_time - start_time
+            return response, collector, duration
+
+        return await self.get_limiter(model_id).acall(invoke, estimated_tokens, self.rate_limiter.max_retries, model_id)
+
+    def decode_response_body(self, response):
+        return loads(response['body'].read())
+
+    def extract_text(self, model_id, response_body):
+        if model_id not in self.response_paths:
+            print(f"Model ID {model_id} not supported.")
+            return "Model ID not supported."
+
+        text = self.extractors[model_id](response_body)
+        if not isinstance(text, str):
+            error_message = f"Response structure unknown or changed for {model_id} model"
+            print(error_message)
+            return error_message
+        return text.strip()
 
     def extract_response_text(self, model_id, response):
         if model_id not in self.response_paths:
@@ -53,31 +266,106 @@ class BedrockRuntimeClient:
 
         try:
             # Decode the response here
-            response_body = json.loads(response['body'].read().decode('utf-8'))
-
-            text = response_body
-            for key in self.response_paths[model_id]:
-                if isinstance(key, int) or key in text:
-                    text = text[key]
-                else:
-                    raise KeyError
-            return text.strip()
-        except (KeyError, TypeError, IndexError):
+            response_body = self.decode_response_body(response)
+        except (KeyError, TypeError, ValueError):
             error_message = f"Response structure unknown or changed for {model_id} model"
             print(error_message)
             return error_message
-        
-    def invoke_model(self, model_id, prompt, custom_parameters={}):
+        return self.extract_text(model_id, response_body)
+
+    def build_request_body(self, model_id, prompt, custom_parameters=None):
         parameters = self.default_parameters.get(model_id, {}).copy()
-        parameters.update(custom_parameters)
+        parameters.update(custom_parameters or {})
 
         if model_id == 'amazon.titan-text-express-v1':
             parameters['inputText'] = prompt  # Specific case for Titan Text Express
-            body = json.dumps({"inputText": parameters.pop('inputText'), "textGenerationConfig": parameters})
-        else:
-            parameters['prompt'] = prompt
-            body = json.dumps(parameters)
-
-        full_response, duration = self.call_model_api(body, model_id)
-        body = json.loads(body)
-        return self.extract_response_text(model_id, full_response), body, full_response, duration
\ No newline at end of file
+            return {"inputText": parameters.pop('inputText'), "textGenerationConfig": parameters}
+        parameters['prompt'] = prompt
+        return parameters
+        
+    def estimate_tokens(self, model_id, prompt, body):
+        # Prompt tokens plus the output budget, whichever parameter name this model family uses for it
+        parameters = body.get('textGenerationConfig', body)
+        max_output = parameters.get('maxTokens') or parameters.get('maxTokenCount') or parameters.get('max_gen_len') or parameters.get('max_tokens_to_sample') or 0
+        with self.metrics.span('token_count', model_id):
+            return self.token_counter.count(model_id, prompt) + max_output
+
+    def cache_lookup(self, model_id, body, use_cache, mode=None):
+        if self.cache is None or not use_cache:
+            return None
+        return self.cache.get(model_id, body, mode)
+
+    def cache_store(self, model_id, body, extracted_text, full_response, duration, mode=None):
+        # Extraction failures are returned as messages, so only cache texts that came from the response path
+        if self.cache is not None and not extracted_text.startswith(("Response structure unknown", "Model ID not supported")):
+            self.cache.set(model_id, body, extracted_text, full_response, duration, mode)
+        
+    def invoke_model(self, model_id, prompt, custom_parameters={}, use_cache=True):
+        with self.metrics.span('request_build', model_id):
+            body = self.build_request_body(model_id, prompt, custom_parameters)
+        cached = self.cache_lookup(model_id, body, use_cache)
+        if cached is not None:
+            return cached
+
+        full_response, response_body, duration = self.call_model_api(dumpb(body), model_id, self.estimate_tokens(model_id, prompt, body))
+        with self.metrics.span('parse', model_id):
+            if response_body is None:
+                extracted_text = self.extract_response_text(model_id, full_response)
+            else:
+                extracted_text = self.extract_text(model_id, response_body)
+        self.cache_store(model_id, body, extracted_text, full_response, duration)
+        return extracted_text, body, full_response, duration
+
+    async def ainvoke_model(self, model_id, prompt, custom_parameters={}, use_cache=True):
+        with self.metrics.span('request_build', model_id):
+            body = self.build_request_body(model_id, prompt, custom_parameters)
+        cached = self.cache_lookup(model_id, body, use_cache)
+        if cached is not None:
+            return cached
+
+        full_response, response_body, duration = await self.acall_model_api(dumpb(body), model_id, self.estimate_tokens(model_id, prompt, body))
+        with self.metrics.span('parse', model_id):
+            extracted_text = self.extract_text(model_id, response_body)
+        self.cache_store(model_id, body, extracted_text, full_response, duration)
+        return extracted_text, body, full_response, duration
+
+    def build_stream_response(self, model_id, response, collector, duration):
+        full_response = {k: v for k, v in response.items() if k != 'body'}
+        full_response['streaming'] = collector.summary(duration)
+        full_response['ttft'] = collector.ttft
+        return full_response, build_from_path(self.response_paths[model_id], collector.text)
+
+    def invoke_model_stream(self, model_id, prompt, custom_parameters={}, use_cache=True, stop_at_sentence=True):
+        """Like invoke_model, but streams the completion and stops at the end of the first sentence."""
+        if model_id not in self.stream_paths:
+            return self.invoke_model(model_id, prompt, custom_parameters, use_cache)
+
+        with self.metrics.span('request_build', model_id):
+            body = self.build_request_body(model_id, prompt, custom_parameters)
+        cached = self.cache_lookup(model_id, body, use_cache, cache_mode(stop_at_sentence))
+        if cached is not None:
+            return cached
+
+        response, collector, duration = self.call_model_stream(dumpb(body), model_id, self.estimate_tokens(model_id, prompt, body), stop_at_sentence)
+        full_response, response_body = self.build_stream_response(model_id, response, collector, duration)
+        with self.metrics.span('parse', model_id):
+            extracted_text = self.extract_text(model_id, response_body)
+        self.cache_store(model_id, body, extracted_text, full_response, duration, cache_mode(stop_at_sentence))
+        return extracted_text, body, full_response, duration
+
+    async def ainvoke_model_stream(self, model_id, prompt, custom_parameters={}, use_cache=True, stop_at_sentence=True):
+        if model_id not in self.stream_paths:
+            return await self.ainvoke_model(model_id, prompt, custom_parameters, use_cache)
+
+        with self.metrics.span('request_build', model_id):
+            body = self.build_request_body(model_id, prompt, custom_parameters)
+        cached = self.cache_lookup(model_id, body, use_cache, cache_mode(stop_at_sentence))
+        if cached is not None:
+            return cached
+
+        response, collector, duration = await self.acall_model_stream(dumpb(body), model_id, self.estimate_tokens(model_id, prompt, body), stop_at_sentence)
+        full_response, response_body = self.build_stream_response(model_id, response, collector, duration)
+        with self.metrics.span('parse', model_id):
+            extracted_text = self.extract_text(model_id, response_body)
+        self.cache_store(model_id, body, extracted_text, full_response, duration, cache_mode(stop_at_sentence))
+        return extracted_text, body, full_response, duration
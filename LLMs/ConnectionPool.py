@@ -0,0 +1,136 @@
+import asyncio
+import threading
+
+class ConnectionPool:
+    """Keep-alive HTTP session and boto3 clients shared by every model client and the DB writer.
+
+    requests and boto3 are imported and their sessions built on first use, so a process that never calls out pays nothing.
+    """
+
+    def __init__(self, max_connections=64, region_name=None):
+        # Size the pools to the number of calls we keep in flight so no request waits for a socket
+        self.max_connections = max_connections
+        self.region_name = region_name
+        self._lock = threading.Lock()
+        self._session = None
+        self._boto_session = None
+        self._clients = {}
+        self._resources = {}
+        # aiohttp sessions belong to one event loop: the run's own, or a HedgePolicy's for threaded hedged calls
+        self._async_sessions = {}
+        self.async_counters = {"new_connections": 0, "reused_connections": 0}
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=self.max_connections)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    @property
+    def boto_config(self):
+        from botocore.config import Config
+        return Config(max_pool_connections=self.max_connections)
+
+    @property
+    def boto_session(self):
+        # Called with self._lock held by client() and resource()
+        if self._boto_session is None:
+            import boto3
+            self._boto_session = boto3.Session(region_name=self.region_name)
+        return self._boto_session
+
+    def client(self, service_name, region_name=None):
+        key = (service_name, region_name or self.region_name)
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = self.boto_session.client(service_name, region_name=key[1], config=self.boto_config)
+            return self._clients[key]
+
+    def resource(self, service_name, region_name=None):
+        key = (service_name, region_name or self.region_name)
+        with self._lock:
+            if key not in self._resources:
+                self._resources[key] = self.boto_session.resource(service_name, region_name=key[1], config=self.boto_config)
+            return self._resources[key]
+
+    async def get_async_session(self):
+        # aiohttp is only needed by the async path
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        session = self._async_sessions.get(loop)
+        if session is None or session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self._on_async_connection_created)
+            trace_config.on_connection_reuseconn.append(self._on_async_connection_reused)
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            session = self._async_sessions[loop] = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+        return session
+
+    async def _on_async_connection_created(self, session, context, params):
+        self.async_counters["new_connections"] += 1
+
+    async def _on_async_connection_reused(self, session, context, params):
+        self.async_counters["reused_connections"] += 1
+
+    async def aclose(self):
+        """Closes the aiohttp session of the running event loop."""
+        session = self._async_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    def _pool_manager_counters(self, pool_manager):
+        requests_made = 0
+        new_connections = 0
+        # urllib3 keeps one HTTPConnectionPool per host, each counting its own connections and requests
+        for key in list(pool_manager.pools.keys()):
+            host_pool = pool_manager.pools.get(key)
+            if host_pool is None:
+                continue
+            requests_made += host_pool.num_requests
+            new_connections += host_pool.num_connections
+        return requests_made, new_connections
+
+    def stats(self):
+        counters = {}
+
+        if self._session is not None:
+            adapters = {id(adapter): adapter for adapter in self._session.adapters.values()}
+            requests_made, new_connections = 0, 0
+            for adapter in adapters.values():
+                made, created = self._pool_manager_counters(adapter.poolmanager)
+                requests_made += made
+                new_connections += created
+            counters["http"] = {"requests": requests_made, "new_connections": new_connections, "pool_hits": max(requests_made - new_connections, 0)}
+
+        with self._lock:
+            boto_clients = dict(self._clients)
+            boto_clients.update({key: resource.meta.client for key, resource in self._resources.items()})
+        for (service_name, region_name), client in boto_clients.items():
+            try:
+                pool_manager = client._endpoint.http_session._manager
+            except AttributeError:
+                continue
+            made, created = self._pool_manager_counters(pool_manager)
+            counters[f"{service_name}:{region_name or 'default'}"] = {"requests": made, "new_connections": created, "pool_hits": max(made - created, 0)}
+
+        counters["async_http"] = dict(self.async_counters)
+        return counters
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def get_default_pool(max_connections=64):
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool(max_connections=max_connections)
+        return _default_pool
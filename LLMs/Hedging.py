@@ -0,0 +1,136 @@
+import asyncio
+import threading
+
+from LLMs.Metrics import Histogram, get_default_metrics
+
+class ServerError(Exception):
+    """Raised by a call that got an HTTP 5xx, so a hedged call fails over like on a throttle; result holds what to return."""
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+class HedgePolicy:
+    """Sends a backup call (another region or endpoint) once the first one is slower than the observed latency percentile.
+
+    The first successful result wins and the other call is cancelled. A primary that fails (an error, a throttle or a
+    5xx) is retried on the backup straight away. Hedges are capped at max_hedge_rate of all calls plus a small burst,
+    so a slow provider cannot double the load on it. Latencies are recorded by the clients once a call holds its
+    rate limiter slot (observe), so time spent waiting for the limiter does not raise the hedge delay.
+
+    Both calls are coroutines: async callers race them on their own event loop (arun), threaded callers block on one
+    event loop thread the policy shares between them (run), so a hedged call holds no thread besides its caller.
+    """
+
+    def __init__(self, percentile=0.95, min_samples=50, min_delay=0.05, max_hedge_rate=0.05, burst=5, metrics=None):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_hedge_rate = max_hedge_rate
+        self.burst = burst
+        self.metrics = metrics or get_default_metrics()
+        self.histograms = {}
+        self.counters = {"calls": 0, "hedged": 0, "hedge_won": 0, "failover": 0, "over_budget": 0}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._loop_thread = None
+        # Coroutine functions closing what clients opened on the policy's loop, run by close()
+        self._cleanups = []
+
+    def observe(self, key, seconds):
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def delay(self, key):
+        """Seconds to wait before hedging a call for key, or None until enough latencies were observed."""
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None or histogram.count < self.min_samples:
+                return None
+            return max(self.min_delay, histogram.quantile(self.percentile))
+
+    def start_call(self):
+        with self._lock:
+            self.counters["calls"] += 1
+
+    def take_hedge(self, key):
+        with self._lock:
+            if self.counters["hedged"] + 1 > self.max_hedge_rate * self.counters["calls"] + self.burst:
+                self.counters["over_budget"] += 1
+                return False
+            self.counters["hedged"] += 1
+        self.metrics.increment('hedges', key)
+        return True
+
+    def count(self, name, key):
+        with self._lock:
+            self.counters[name] += 1
+        self.metrics.increment('hedge_wins' if name == 'hedge_won' else 'failovers', key)
+
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, name="Hedge", daemon=True)
+                self._loop_thread.start()
+            return self._loop
+
+    def at_close(self, coroutine_func):
+        with self._lock:
+            self._cleanups.append(coroutine_func)
+
+    def run(self, key, primary, backup):
+        """Blocking arun for threaded callers, raced on the policy's event loop thread."""
+        return asyncio.run_coroutine_threadsafe(self.arun(key, primary, backup), self.loop()).result()
+
+    async def arun(self, key, primary, backup):
+        """Returns the first successful result of primary() and, if it is slow or fails, backup()."""
+        self.start_call()
+        tasks = [asyncio.ensure_future(primary())]
+        done, _ = await asyncio.wait(tasks, timeout=self.delay(key))
+        if not done and self.take_hedge(key):
+            tasks.append(asyncio.ensure_future(backup()))
+
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.count("hedge_won", key)
+                        return task.result()
+                if len(tasks) == 1:
+                    self.count("failover", key)
+                    tasks.append(asyncio.ensure_future(backup()))
+                    pending = {tasks[1]}
+            raise tasks[-1].exception()
+        finally:
+            # The losing call is cancelled, which closes its connection instead of reading the response
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, delays={key: round(histogram.quantile(self.percentile), 4) for key, histogram in self.histograms.items()})
+
+    async def _aclose(self):
+        for cleanup in self._cleanups:
+            try:
+                await cleanup()
+            except Exception as e:
+                print(f"Error closing hedge connections: {e}")
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._loop_thread.join()
+        loop.close()
@@ -0,0 +1,166 @@
+import bisect
+import contextlib
+import json
+import threading
+import time
+
+# Latency bucket upper bounds in seconds: 1ms growing by 25% per bucket up to about 2 minutes
+DEFAULT_BUCKETS = tuple(round(0.001 * 1.25 ** i, 6) for i in range(53))
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimates the q-quantile by linear interpolation inside its bucket, like Prometheus histogram_quantile."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - cumulative) / count)
+            cumulative += count
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50": round(self.quantile(0.5), 6),
+            "p95": round(self.quantile(0.95), 6),
+            "p99": round(self.quantile(0.99), 6),
+            "max": round(self.max, 6)
+        }
+
+
+class Metrics:
+    """perf_counter spans and counters per (name, model), exported as a JSON snapshot or Prometheus text.
+
+    Spans used by the pipeline: plan, request_build, network, ttfb, ttft, parse, token_count, db_write, row
+    (one full prompt/model round trip) and pack (one packed call of several rows).
+    Counters: requests, rows (stored), dropped (filtered out before storage), errors, db_items,
+    duplicates (rows dropped by the near-duplicate filter), mismatches (rows whose sentiment the verifier disagreed with),
+    hedges, hedge_wins and failovers (see HedgePolicy).
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, enabled=True):
+        self.buckets = buckets
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.started_at = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, model=''):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, model)
+
+    def observe(self, name, seconds, model=''):
+        if not self.enabled or seconds is None:
+            return
+        with self._lock:
+            histogram = self.histograms.get((name, model))
+            if histogram is None:
+                histogram = self.histograms[(name, model)] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def increment(self, name, model='', value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[(name, model)] = self.counters.get((name, model), 0) + value
+
+    def merged(self, name):
+        """One histogram of span name across every model."""
+        merged = Histogram(self.buckets)
+        with self._lock:
+            for (span_name, _), histogram in self.histograms.items():
+                if span_name != name:
+                    continue
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+                merged.count += histogram.count
+                merged.sum += histogram.sum
+                merged.max = max(merged.max, histogram.max)
+        return merged
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self.started_at = time.perf_counter()
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = time.perf_counter() - self.started_at
+            spans, counters = {}, {}
+            for (name, model), histogram in sorted(self.histograms.items()):
+                spans.setdefault(name, {})[model or "all"] = histogram.summary()
+            for (name, model), value in sorted(self.counters.items()):
+                counters.setdefault(name, {})[model or "all"] = value
+        rows = counters.get("rows", {})
+        throughput = {model: round(value / elapsed, 4) for model, value in rows.items()} if elapsed > 0 else {}
+        return {"elapsed": round(elapsed, 3), "spans": spans, "counters": counters, "rows_per_sec": throughput}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix='llm_pipeline'):
+        def labels(**values):
+            return ",".join(f'{key}="{value}"' for key, value in values.items())
+
+        lines = [
+            f"# HELP {prefix}_span_seconds Time spent per pipeline stage and model.",
+            f"# TYPE {prefix}_span_seconds histogram"
+        ]
+        with self._lock:
+            for (name, model), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_span_seconds_bucket{{{labels(span=name, model=model, le=bound)}}} {cumulative}')
+                lines.append(f'{prefix}_span_seconds_sum{{{labels(span=name, model=model)}}} {histogram.sum}')
+                lines.append(f'{prefix}_span_seconds_count{{{labels(span=name, model=model)}}} {histogram.count}')
+
+            lines.append(f"# HELP {prefix}_events_total Pipeline events per model.")
+            lines.append(f"# TYPE {prefix}_events_total counter")
+            for (name, model), value in sorted(self.counters.items()):
+                lines.append(f'{prefix}_events_total{{{labels(event=name, model=model)}}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes Prometheus text for *.prom files (node_exporter textfile format), a JSON snapshot otherwise."""
+        content = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+
+
+_default_metrics = None
+_default_metrics_lock = threading.Lock()
+
+def get_default_metrics():
+    global _default_metrics
+    with _default_metrics_lock:
+        if _default_metrics is None:
+            _default_metrics = Metrics()
+        return _default_metrics
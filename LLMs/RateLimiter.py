@@ -0,0 +1,268 @@
+from collections import deque
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+class ThrottledError(Exception):
+    """Raised by a limited call when the provider throttled it; result holds what to return if retries run out."""
+
+    def __init__(self, message, retry_after=None, result=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.result = result
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        # Requests larger than the bucket are allowed once it is full, instead of waiting forever
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class AdaptiveLimiter:
+    """Token buckets for requests/min and tokens/min plus an AIMD concurrency limit driven by throttles."""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrency=256, min_concurrency=1,
+                 initial_concurrency=None, increase=1.0, decrease_factor=0.5, base_backoff=0.5, max_backoff=60.0):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency_limit = float(initial_concurrency or max_concurrency)
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.consecutive_throttles = 0
+        self.counters = {"requests": 0, "throttled": 0, "waited_seconds": 0.0}
+        self._condition = threading.Condition()
+        # (event loop, future, tokens) of each aacquire waiting for a slot; the limiter is shared across threads and loops
+        self._async_waiters = deque()
+        self._grant_retry_at = None
+
+    def try_acquire(self, tokens=0):
+        """Takes a slot and reserves rate budget if possible; otherwise returns how long to wait."""
+        with self._condition:
+            return self._try_acquire(tokens)
+
+    def _try_acquire(self, tokens):
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= int(self.concurrency_limit):
+            return None  # wait for a release
+        wait = 0.0
+        for bucket, amount in ((self.request_bucket, 1), (self.token_bucket, tokens)):
+            if bucket is not None:
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time(amount))
+        if wait > 0:
+            return wait
+        if self.request_bucket is not None:
+            self.request_bucket.tokens -= 1
+        if self.token_bucket is not None:
+            self.token_bucket.tokens -= min(tokens, self.token_bucket.capacity)
+        self.in_flight += 1
+        self.counters["requests"] += 1
+        return 0.0
+
+    def acquire(self, tokens=0):
+        start_time = time.monotonic()
+        with self._condition:
+            while True:
+                wait = self._try_acquire(tokens)
+                if wait == 0.0:
+                    break
+                self._condition.wait(timeout=wait if wait is not None else 1.0)
+            self.counters["waited_seconds"] += time.monotonic() - start_time
+
+    async def aacquire(self, tokens=0):
+        start_time = time.monotonic()
+        loop = asyncio.get_running_loop()
+        while True:
+            # Checked and queued under one lock, so a release in between cannot be missed
+            with self._condition:
+                wait = self._try_acquire(tokens)
+                if wait == 0.0:
+                    break
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter, tokens))
+            try:
+                # release() hands a freed slot straight to the longest waiting task; the timeout covers refills and backoffs
+                await asyncio.wait_for(waiter, timeout=wait if wait is not None else 1.0)
+                break
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.give_back()
+                raise
+        with self._condition:
+            self.counters["waited_seconds"] += time.monotonic() - start_time
+
+    def grant_async_waiters(self):
+        # Called with the lock held: takes slots for the longest waiting tasks, in order, while the limits allow
+        while self._async_waiters:
+            loop, waiter, tokens = self._async_waiters[0]
+            if waiter.done():
+                self._async_waiters.popleft()
+                continue
+            wait = self._try_acquire(tokens)
+            if wait is not None and wait > 0 and self._grant_retry_at is None:
+                # A backoff or the rate budget holds the queue; take the slot once that wait is over
+                self._grant_retry_at = time.monotonic() + wait
+                try:
+                    loop.call_soon_threadsafe(loop.call_later, wait, self.retry_grants)
+                except RuntimeError:
+                    self._grant_retry_at = None
+            if wait != 0.0:
+                return
+            self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(self._grant, waiter)
+            except RuntimeError:
+                # The waiter's loop is closed
+                self.in_flight -= 1
+                self.counters["requests"] -= 1
+
+    def retry_grants(self):
+        with self._condition:
+            self._grant_retry_at = None
+            self.grant_async_waiters()
+
+    def _grant(self, waiter):
+        # Runs on the waiter's loop; a waiter that timed out in the meantime hands its slot back
+        if waiter.done():
+            self.give_back()
+        else:
+            waiter.set_result(None)
+
+    def give_back(self):
+        """Returns a slot that was taken but never used, without counting it as a call."""
+        with self._condition:
+            self.in_flight = max(0, self.in_flight - 1)
+            self.counters["requests"] -= 1
+            self._condition.notify_all()
+            self.grant_async_waiters()
+
+    def release(self, throttled=False, retry_after=None):
+        with self._condition:
+            self.in_flight = max(0, self.in_flight - 1)
+            if throttled:
+                self.counters["throttled"] += 1
+                self.consecutive_throttles += 1
+                # Multiplicative decrease on a throttle
+                self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit * self.decrease_factor)
+                if retry_after is None:
+                    backoff = min(self.max_backoff, self.base_backoff * (2 ** (self.consecutive_throttles - 1)))
+                    retry_after = random.uniform(backoff / 2, backoff)
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            else:
+                self.consecutive_throttles = 0
+                # Additive increase: about one extra slot per window of successful calls
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + self.increase / max(self.concurrency_limit, 1.0))
+            self._condition.notify_all()
+            self.grant_async_waiters()
+
+    def call(self, func, tokens=0, max_retries=5, label=''):
+        """Runs func() inside a slot, retrying while it raises ThrottledError."""
+        for attempt in range(max_retries + 1):
+            self.acquire(tokens)
+            try:
+                result = func()
+            except ThrottledError as e:
+                self.release(throttled=True, retry_after=e.retry_after)
+                if attempt == max_retries:
+                    raise
+                print(f"{label} throttled ({e}), attempt {attempt + 1} of {max_retries + 1}")
+                continue
+            except Exception:
+                self.release()
+                raise
+            self.release()
+            return result
+
+    async def acall(self, coroutine_func, tokens=0, max_retries=5, label=''):
+        for attempt in range(max_retries + 1):
+            await self.aacquire(tokens)
+            try:
+                result = await coroutine_func()
+            except ThrottledError as e:
+                self.release(throttled=True, retry_after=e.retry_after)
+                if attempt == max_retries:
+                    raise
+                print(f"{label} throttled ({e}), attempt {attempt + 1} of {max_retries + 1}")
+                continue
+            except Exception:
+                self.release()
+                raise
+            self.release()
+            return result
+
+    def stats(self):
+        with self._condition:
+            return dict(self.counters, concurrency_limit=round(self.concurrency_limit, 2), in_flight=self.in_flight)
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiterRegistry:
+    """One AdaptiveLimiter per (provider, model); limits are configured per model ID or per provider."""
+
+    def __init__(self, limits=None, default_limits=None, max_retries=5):
+        self.limits = limits or {}
+        self.default_limits = default_limits or {}
+        self.max_retries = max_retries
+        self.limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, provider, model_id):
+        key = (provider, model_id)
+        with self._lock:
+            if key not in self.limiters:
+                settings = self.limits.get(model_id) or self.limits.get(provider) or self.default_limits
+                self.limiters[key] = AdaptiveLimiter(**settings)
+            return self.limiters[key]
+
+    def stats(self):
+        with self._lock:
+            return {f"{provider}:{model_id}": limiter.stats() for (provider, model_id), limiter in self.limiters.items()}
+
+
+_default_rate_limiter = None
+_default_rate_limiter_lock = threading.Lock()
+
+def get_default_rate_limiter():
+    global _default_rate_limiter
+    with _default_rate_limiter_lock:
+        if _default_rate_limiter is None:
+            _default_rate_limiter = RateLimiterRegistry()
+        return _default_rate_limiter
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from LLMs.Serialization import dumps, loads
+
+class ResponseCache:
+    """Persistent SQLite cache of model invocations keyed by a hash of (model_id, call mode, final request body).
+
+    The mode keeps streamed answers cut at the first sentence apart from full invoke_model answers to the same body.
+    """
+
+    def __init__(self, path='.cache/responses.sqlite', ttl=None, max_entries=100000, bypass=False):
+        self.path = path
+        self.ttl = ttl  # seconds; None keeps entries until evicted by size
+        self.max_entries = max_entries
+        # Sampling runs that need fresh randomness skip lookups but still refresh stored entries
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model_id TEXT, value TEXT, created_at REAL, accessed_at REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def make_key(self, model_id, body, mode=None):
+        # Always the json module, so keys do not change with the installed serializer
+        canonical = json.dumps(body, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+        # invoke_model keys (mode None) stay as they were, so existing caches keep their entries
+        prefix = model_id if mode is None else f"{model_id}\0{mode}"
+        return hashlib.sha256(f"{prefix}\0{canonical}".encode('utf-8')).hexdigest()
+
+    def get(self, model_id, body, mode=None):
+        """Returns the stored (extracted_text, request_body, full_response, duration) tuple, or None."""
+        if self.bypass:
+            return None
+        key = self.make_key(model_id, body, mode)
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._entries -= 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+
+        value = loads(row[0])
+        full_response = value['full_response']
+        if isinstance(full_response, dict):
+            full_response['cacheHit'] = True
+        return value['extracted'], value['body'], full_response, value['duration']
+
+    def set(self, model_id, body, extracted_text, full_response, duration, mode=None):
+        if isinstance(full_response, dict):
+            # Streaming bodies (Bedrock) are already consumed and cannot be stored
+            full_response = {k: v for k, v in full_response.items() if k not in ('body', 'cacheHit')}
+        value = dumps({'extracted': extracted_text, 'body': body, 'full_response': full_response, 'duration': duration})
+        key = self.make_key(model_id, body, mode)
+        now = time.time()
+        with self._lock:
+            existed = self.connection.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is not None
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model_id, value, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, model_id, value, now, now)
+            )
+            if not existed:
+                self._entries += 1
+            if self.max_entries is not None and self._entries > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # Drop the least recently used tenth at once so eviction does not run on every insert
+        excess = self._entries - self.max_entries + max(1, self.max_entries // 10)
+        self.connection.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)", (excess,)
+        )
+        self.evictions += excess
+        self._entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def purge_expired(self):
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            deleted = self.connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+            self._entries -= deleted
+        return deleted
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM responses")
+            self._entries = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self._entries,
+            "evictions": self.evictions
+        }
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
@@ -0,0 +1,45 @@
+import functools
+import json
+import operator
+
+# orjson is optional; it serializes to bytes several times faster than the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumpb(value):
+    """Serializes to UTF-8 JSON bytes, the form request bodies are sent in."""
+    if orjson is not None:
+        return orjson.dumps(value, default=str)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+
+def dumps(value):
+    """Serializes to a JSON string, for attributes stored as text."""
+    if orjson is not None:
+        return orjson.dumps(value, default=str).decode('utf-8')
+    return json.dumps(value, default=str)
+
+def loads(data):
+    """Parses JSON from bytes or str without decoding bytes first."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def compile_path(path):
+    """Compiles a response path such as ['choices', 0, 'message', 'content'] into a getter.
+
+    The returned extract(document) gives the value at the path, or None when the document has another shape.
+    """
+    keys = tuple(path)
+    if not all(isinstance(key, (str, int)) for key in keys):
+        raise ValueError(f"Response path keys must be strings or integers: {path}")
+
+    def extract(document):
+        try:
+            return functools.reduce(operator.getitem, keys, document)
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    extract.path = keys
+    return extract
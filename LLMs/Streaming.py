@@ -0,0 +1,61 @@
+import re
+import time
+
+# A sentence ends at . ! or ? (plus closing quotes/brackets) followed by whitespace or the end of the text so far
+SENTENCE_END = re.compile(r'[.!?]+["\'”’)\]]*(?=\s|$)')
+
+def cache_mode(stop_at_sentence):
+    """ResponseCache mode of a streamed call; an answer cut at the first sentence must never replay as a full one."""
+    return 'stream:first_sentence' if stop_at_sentence else 'stream'
+
+
+def build_from_path(path, text):
+    """Nests text under a response path, so streamed output reads like the non-streaming response body."""
+    value = text
+    for key in reversed(path):
+        value = [value] if isinstance(key, int) else {key: value}
+    return value
+
+
+class SentenceCollector:
+    """Accumulates streamed text, records time to first token and reports when the first sentence is complete."""
+
+    def __init__(self, start_time, stop_at_sentence=True, min_chars=20):
+        self.start_time = start_time
+        self.stop_at_sentence = stop_at_sentence
+        self.min_chars = min_chars
+        self.parts = []
+        self.ttft = None
+        self.chunks = 0
+        self.stopped_early = False
+        self._text = None
+
+    def add(self, piece):
+        """Adds one streamed piece; returns True once the caller should stop reading."""
+        if not piece:
+            return False
+        if self.ttft is None:
+            self.ttft = time.time() - self.start_time
+        self.chunks += 1
+        self.parts.append(piece)
+        if not self.stop_at_sentence:
+            return False
+
+        text = "".join(self.parts)
+        # Skip short lead-ins such as "Sure!" before looking for the end of the sentence
+        start = len(text) - len(text.lstrip()) + self.min_chars
+        match = SENTENCE_END.search(text, start)
+        if match is None:
+            return False
+        self._text = text[:match.end()]
+        self.stopped_early = True
+        return True
+
+    @property
+    def text(self):
+        if self._text is not None:
+            return self._text
+        return "".join(self.parts)
+
+    def summary(self, duration):
+        return {"ttft": self.ttft, "chunks": self.chunks, "stoppedEarly": self.stopped_early, "duration": duration}
@@ -0,0 +1,100 @@
+import functools
+import math
+import re
+import threading
+
+WORD_PATTERN = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+def approximate_token_count(text):
+    """Offline estimate for BPE/SentencePiece vocabularies: about one token per four characters of a word, one per symbol."""
+    count = 0
+    for piece in WORD_PATTERN.findall(text):
+        count += max(1, math.ceil(len(piece) / 4))
+    return count
+
+def tiktoken_tokenizer(model_name):
+    # tiktoken is optional; without it GPT models fall back to the approximation
+    try:
+        import tiktoken
+    except ImportError:
+        return approximate_token_count
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except Exception as e:
+        # The BPE files are downloaded on first use, which fails on offline machines
+        print(f"tiktoken encoding for {model_name} unavailable ({e}), using the approximate count")
+        return approximate_token_count
+    return lambda text: len(encoding.encode(text))
+
+class TokenCounter:
+    def __init__(self, cache_size=8192, use_provider_usage=True):
+        self.use_provider_usage = use_provider_usage
+        # Model IDs are matched by prefix to the tokenizer family that counts them
+        self.model_families = {
+            'gpt-': 'openai',
+            'gemini-': 'gemini',
+            'anthropic.': 'anthropic',
+            'ai21.': 'ai21',
+            'amazon.titan': 'titan',
+            'meta.llama': 'llama'
+        }
+        self.tokenizers = {'openai': tiktoken_tokenizer('gpt-4')}
+        self.default_tokenizer = approximate_token_count
+        self._lock = threading.Lock()
+        # The same prompt is counted once per model, so memoize on (family, text)
+        self._count_cached = functools.lru_cache(maxsize=cache_size)(self._count)
+
+    def register_tokenizer(self, family, tokenizer):
+        with self._lock:
+            self.tokenizers[family] = tokenizer
+        self._count_cached.cache_clear()
+
+    def family_for(self, model_id):
+        for prefix, family in self.model_families.items():
+            if model_id.startswith(prefix):
+                return family
+        return model_id
+
+    def _count(self, family, text):
+        return self.tokenizers.get(family, self.default_tokenizer)(text)
+
+    def count(self, model_id, text):
+        if not isinstance(text, str):
+            return 0
+        return self._count_cached(self.family_for(model_id), text)
+
+    def usage_counts(self, full_response):
+        """Returns (input, output) token counts from the provider's own usage block, or (None, None)."""
+        if not isinstance(full_response, dict):
+            return None, None
+        usage = full_response.get('usage')  # OpenAI chat completions
+        if isinstance(usage, dict) and 'prompt_tokens' in usage:
+            return usage.get('prompt_tokens'), usage.get('completion_tokens')
+        usage = full_response.get('usageMetadata')  # Gemini generateContent
+        if isinstance(usage, dict) and 'promptTokenCount' in usage:
+            return usage.get('promptTokenCount'), usage.get('candidatesTokenCount', 0)
+        return None, None
+
+    def count_invocation(self, model_id, prompt, output_text, full_response):
+        input_count, output_count = None, None
+        if self.use_provider_usage:
+            input_count, output_count = self.usage_counts(full_response)
+        if input_count is None:
+            input_count = self.count(model_id, prompt)
+        if output_count is None:
+            output_count = self.count(model_id, output_text)
+        return input_count, output_count
+
+    def cache_info(self):
+        return self._count_cached.cache_info()
+
+
+_default_token_counter = None
+_default_token_counter_lock = threading.Lock()
+
+def get_default_token_counter():
+    global _default_token_counter
+    with _default_token_counter_lock:
+        if _default_token_counter is None:
+            _default_token_counter = TokenCounter()
+        return _default_token_counter
@@ -1,52 +1,131 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import asyncio
+import functools
 import random
 import json
+import time
+
+from LLMs.Metrics import get_default_metrics
+from PlanPacker import PlanPacker, parse_packed_response
+
+# Outcome of a row that was handled but deliberately not stored (a near-duplicate or a sentiment mismatch), told apart from True (stored) and False (failed)
+DROPPED = 'dropped'
 
 class ModelPromptProcessor:
-    def __init__(self, categories, brt_client, db_instance, content_generators):
+    bedrock_models = ["ai21.j2-ultra-v1", "amazon.titan-text-express-v1", "meta.llama2-70b-chat-v1", "anthropic.claude-v2"]
+    # Output budget parameter per model, raised for packed prompts so K sentences fit
+    output_token_parameters = {
+        "ai21.j2-ultra-v1": "maxTokens",
+        "amazon.titan-text-express-v1": "maxTokenCount",
+        "meta.llama2-70b-chat-v1": "max_gen_len",
+        "anthropic.claude-v2": "max_tokens_to_sample",
+        "gpt-4": "max_tokens"
+    }
+    tokens_per_packed_sentence = 64
+    sentiments = ("positive", "negative")
+
+    def __init__(self, categories, brt_client, db_instance, content_generators, planner=None, stream=False, metrics=None, dedup=None, verifier=None):
         self.categories = categories
         self.brt_client = brt_client
         self.db = db_instance
         self.content_generators = content_generators  # Dictionary of ContentGenerator instances
+        # Optional PromptPlanner: batch plan i is planner.plan(i), so runs are seeded, unique and resumable
+        self.planner = planner
+        # Stream completions and stop reading at the end of the first sentence
+        self.stream = stream
+        # Per-model row latency and plan timings; clients and DBInference record their own stages
+        self.metrics = metrics or get_default_metrics()
+        # Optional DedupFilter: responses near-identical to an earlier one are dropped before the sink
+        self.dedup = dedup
+        # Optional SentimentVerifier: responses are scored for the requested sentiment and mismatches tagged or dropped
+        self.verifier = verifier
         print("ModelPromptProcessor initialized.")  # Confirm initialization
 
-    def generate_prompt_with_sentiment(self):
-        print("Generating prompt with sentiment")
-
-        sentiment = random.choice(["positive", "negative"])
-        categories_list = self.categories['data']
-        selected_categories = random.sample(categories_list, 3)
-        
-        category_topic_pairs = {}
-        for category in selected_categories:
-            topic = random.choice(category["topics"])
-            category_topic_pairs[category['category']] = topic
-        
-        json_prompt = json.dumps(category_topic_pairs, ensure_ascii=False)
-        topics_list = "\n".join(f"- {cat['category']}: {random.choice(cat['topics'])}" for cat in selected_categories)
+    def build_prompt(self, sentiment, category_topic_pairs):
+        topics_list = "\n".join(f"- {category}: {topic}" for category, topic in category_topic_pairs.items())
         
         prompt = f"""Human:
 You are tasked with creating a single sentence that encapsulates a specific sentiment, given topics from specified categories. 
 The sentiment is {sentiment}, with the topics:
 {topics_list}
 The output should be concise and limited to this sentence alone, with no additional explanations, comments, or queries following it. 
-The response must reflect a positive outlook or outcome despite the context of tiredness.
+The sentence must clearly convey a {sentiment} sentiment.
 
 Here's a sentence that fits the criteria you've described:
 Assistant:
 """        
+        return prompt
+
+    def build_packed_prompt(self, plans):
+        """One prompt asking for a numbered sentence per (sentiment, {category: topic}) plan."""
+        items = []
+        for number, (sentiment, category_topic_pairs) in enumerate(plans, start=1):
+            topics = "; ".join(f"{category}: {topic}" for category, topic in category_topic_pairs.items())
+            items.append(f"{number}. Sentiment: {sentiment}. Topics: {topics}")
+        items_list = "\n".join(items)
+        count = len(plans)
+
+        prompt = f"""Human:
+You are tasked with writing {count} separate sentences. Each sentence must encapsulate the sentiment of its item and mention the topics from the specified categories of that item.
+{items_list}
+Answer with exactly {count} lines numbered 1 to {count} in the same order as the items, each in the form "<number>. <sentence>".
+Write one sentence per line, with no additional explanations, comments, or queries before or after the list.
+
+Assistant:
+"""
+        return prompt
+
+    def packed_parameters(self, model_id, pack_size):
+        budget = self.tokens_per_packed_sentence * pack_size + 32
+        if model_id == "gemini-pro":
+            return {"generationConfig": {"maxOutputTokens": budget}}
+        parameter = self.output_token_parameters.get(model_id)
+        return {parameter: budget} if parameter else {}
+
+    def generate_prompt_with_sentiment(self, plan=None):
+        print("Generating prompt with sentiment")
+
+        if plan is not None:
+            sentiment, category_topic_pairs = plan
+        else:
+            sentiment = random.choice(self.sentiments)
+            categories_list = self.categories['data']
+            selected_categories = random.sample(categories_list, 3)
+            
+            category_topic_pairs = {}
+            for category in selected_categories:
+                topic = random.choice(category["topics"])
+                category_topic_pairs[category['category']] = topic
+        
+        # The stored categories JSON and the prompt are built from the same draw
+        json_prompt = json.dumps(category_topic_pairs, ensure_ascii=False)
+        prompt = self.build_prompt(sentiment, category_topic_pairs)
         print(f"Generated prompt")
 
         return prompt, sentiment, json_prompt
 
-    def process_and_save_results(self, model, sentiment, categories_json, prompt, extracted_text, request_body, full_response, duration):
+    def process_and_save_results(self, model, sentiment, categories_json, prompt, extracted_text, request_body, full_response, duration, on_written=None):
+        """Returns True once the row is stored (or buffered), DROPPED when it is filtered out and False on a failure."""
         print(f"Processing results for model: {model}")
         if isinstance(full_response, dict):
             response_for_storage = {k: v for k, v in full_response.items() if k != 'body'}
         else:
             response_for_storage = {"error": "Unexpected response format"}
+        if self.verifier is not None and 'error' not in response_for_storage:
+            verdict = self.verifier.verify(model, sentiment, extracted_text)
+            if verdict is not None and not verdict["match"] and self.verifier.action == 'drop':
+                print(f"Dropped response from {model} that reads {verdict['label']} instead of {sentiment}")
+                return DROPPED
+            if verdict is not None:
+                response_for_storage = dict(response_for_storage, verification=verdict)
+        dedup_key = None
+        if self.dedup is not None and 'error' not in response_for_storage:
+            duplicate, dedup_key = self.dedup.check(model, extracted_text)
+            if duplicate:
+                print(f"Dropped near-duplicate response from {model}")
+                return DROPPED
         try:
-            self.db.write_item(
+            stored = self.db.write_item(
                 model=model,
                 sentiment=sentiment,
                 categories=categories_json,
@@ -54,18 +133,61 @@ Assistant:
                 run_time=duration,
                 response=extracted_text, 
                 request_body=request_body,
-                full_response=response_for_storage
-            )
+                full_response=response_for_storage,
+                ttft=response_for_storage.get('ttft'),
+                on_written=on_written
+            ) is not False
         except Exception as e:
             print(f"Error saving item for {model}: {e}")
+            return False
+        # Only a sentence the sink accepted counts as seen, so a failed write can be retried
+        if stored and dedup_key is not None:
+            self.dedup.remember(model, dedup_key)
+        return stored
+
+    def invoke_model_and_process(self, invoke_func, model_id, prompt, sentiment, categories_json, on_written=None):
+        try:
+            with self.metrics.span('row', model_id):
+                # invoke_func is either self.brt_client.invoke_model or generator.invoke_model
+                extracted_text, request_body, full_response, duration = invoke_func(model_id=model_id, prompt=prompt)
+                ok = self.process_and_save_results(model_id, sentiment, categories_json, prompt, extracted_text, request_body, full_response, duration, on_written)
+        except Exception as e:
+            print(f"Error invoking model {model_id}: {e}")
+            ok = False
+        self.metrics.increment(outcome_counter(ok), model_id)
+        return ok
 
-    def invoke_model_and_process(self, invoke_func, model_id, prompt, sentiment, categories_json):
+    async def ainvoke_model_and_process(self, model_id, prompt, sentiment, categories_json, on_written=None):
         try:
-            # invoke_func is either self.brt_client.invoke_model or generator.invoke_model
-            extracted_text, request_body, full_response, duration = invoke_func(model_id=model_id, prompt=prompt)
-            self.process_and_save_results(model_id, sentiment, categories_json, prompt, extracted_text, request_body, full_response, duration)
+            with self.metrics.span('row', model_id):
+                extracted_text, request_body, full_response, duration = await self.get_async_invoke_func(model_id)(model_id=model_id, prompt=prompt)
+                # DBInference is synchronous, keep its round trip off the event loop
+                ok = await asyncio.to_thread(self.process_and_save_results, model_id, sentiment, categories_json, prompt, extracted_text, request_body, full_response, duration, on_written)
         except Exception as e:
             print(f"Error invoking model {model_id}: {e}")
+            ok = False
+        self.metrics.increment(outcome_counter(ok), model_id)
+        return ok
+
+    def get_invoke_func(self, model_id):
+        client = self.content_generators.get(model_id, self.brt_client)
+        return client.invoke_model_stream if self.stream else client.invoke_model
+
+    def get_async_invoke_func(self, model_id):
+        client = self.content_generators.get(model_id, self.brt_client)
+        return client.ainvoke_model_stream if self.stream else client.ainvoke_model
+
+    def get_pack_invoke_func(self, model_id):
+        # Packs need the whole numbered list, so they never stop at the first sentence
+        return self.content_generators.get(model_id, self.brt_client).invoke_model
+
+    def get_async_pack_invoke_func(self, model_id):
+        return self.content_generators.get(model_id, self.brt_client).ainvoke_model
+
+    def get_provider(self, model_id):
+        if model_id in self.content_generators:
+            return self.content_generators[model_id].providers.get(model_id, model_id)
+        return "bedrock"
 
     def invoke_models_and_save(self, prompt, sentiment, categories_json):
         print("Invoking models and preparing to save concurrently...")
@@ -79,7 +201,7 @@ Assistant:
         # Initialize ThreadPoolExecutor
         with ThreadPoolExecutor() as executor:
             # Schedule built-in model tasks
-            for model in ["ai21.j2-ultra-v1", "amazon.titan-text-express-v1", "meta.llama2-70b-chat-v1", "anthropic.claude-v2"]:
+            for model in self.bedrock_models:
                 # Note: We're passing a lambda or partial to submit to correctly bind the current loop variable's value
                 futures.append(executor.submit(self.invoke_model_and_process, self.brt_client.invoke_model, model, prompt, sentiment, categories_json))
 
@@ -93,10 +215,426 @@ Assistant:
                 # For example, future.result() will re-raise any exception caught during execution
                 try:
                     result = future.result()
-                    success_count += 1
-                    # Process result (if needed)
+                    if result is True:
+                        success_count += 1
+                    elif result is False:
+                        error_count += 1
                 except Exception as e:
                     # Handle exception
                     error_count += 1
                     print(f"Task raised an exception: {e}")
         return success_count, error_count
+
+    def flush_db(self):
+        """Flushes write-behind sinks; returns {model: rows} they accepted but failed to store."""
+        # Write-behind sinks buffer rows; count a batch as done only once its rows are stored
+        flush = getattr(self.db, 'flush', None)
+        if flush is not None:
+            flush()
+        # The dedup index is saved with the rows it covers, so a later crash does not lose it
+        if self.dedup is not None:
+            self.dedup.save()
+        take_failed_rows = getattr(self.db, 'take_failed_rows', None)
+        return take_failed_rows() if take_failed_rows is not None else {}
+
+    def count_failed_writes(self, stats, failed):
+        # Buffered rows were counted as stored when the sink accepted them; the ones it never stored become errors
+        for model, rows in failed.items():
+            if model in stats:
+                stats[model]["success"] -= rows
+                stats[model]["error"] += rows
+            self.metrics.increment('rows', model, -rows)
+            self.metrics.increment('errors', model, rows)
+        return sum(failed.values())
+
+    def get_batch_models(self, models=None):
+        if models is None:
+            return self.bedrock_models + list(self.content_generators)
+        return list(models)
+
+    def iter_batch_tasks(self, n_prompts, models, journal=None, job_id=None, first_plan_id=0):
+        if journal is not None:
+            # Finish the pairs an earlier run planned but never confirmed before planning new prompts
+            yield from journal.iter_outstanding(job_id, models)
+            first_plan_id = journal.planned_count(job_id)
+
+        # Prompts are generated lazily so only the in-flight window is held in memory
+        for plan_id in range(first_plan_id, n_prompts):
+            with self.metrics.span('plan'):
+                plan = self.planner.plan(plan_id) if self.planner is not None else None
+                prompt, sentiment, categories_json = self.generate_prompt_with_sentiment(plan)
+            if journal is not None:
+                journal.record_plan(job_id, plan_id, prompt, sentiment, categories_json)
+            for model in models:
+                yield model, prompt, sentiment, categories_json, plan_id
+
+    def journal_dispatch(self, journal, job_id, model, plan_id):
+        """Returns (skip, on_written) for one (plan, model) pair of a journaled job."""
+        if journal is None:
+            return False, None
+        # A confirmed write or drop is never repeated, which keeps resumed runs idempotent
+        if journal.is_handled(job_id, plan_id, model):
+            return True, None
+        journal.record_dispatch(job_id, plan_id, model)
+        return False, lambda: journal.record_written(job_id, plan_id, model)
+
+    def journal_outcome(self, journal, job_id, model, plan_id, ok):
+        # Stored rows confirm themselves through on_written once the sink has them
+        if journal is None or ok is True:
+            return
+        if ok == DROPPED:
+            journal.record_dropped(job_id, plan_id, model)
+        else:
+            journal.record_failed(job_id, plan_id, model)
+
+    def run_task(self, model, prompt, sentiment, categories_json, plan_id, journal=None, job_id=None):
+        skip, on_written = self.journal_dispatch(journal, job_id, model, plan_id)
+        if skip:
+            return True
+        ok = self.invoke_model_and_process(self.get_invoke_func(model), model, prompt, sentiment, categories_json, on_written)
+        self.journal_outcome(journal, job_id, model, plan_id, ok)
+        return ok
+
+    async def arun_task(self, model, prompt, sentiment, categories_json, plan_id, journal=None, job_id=None):
+        skip, on_written = self.journal_dispatch(journal, job_id, model, plan_id)
+        if skip:
+            return True
+        ok = await self.ainvoke_model_and_process(model, prompt, sentiment, categories_json, on_written)
+        await asyncio.to_thread(self.journal_outcome, journal, job_id, model, plan_id, ok)
+        return ok
+
+    def prepare_pack(self, entries, journal, job_id):
+        """Drops plans already written by an earlier run; returns (pending entries, on_written callbacks, skipped)."""
+        pending, callbacks = [], []
+        for entry in entries:
+            model, _, _, _, plan_id = entry[0]
+            skip, on_written = self.journal_dispatch(journal, job_id, model, plan_id)
+            if not skip:
+                pending.append(entry)
+                callbacks.append(on_written)
+        return pending, callbacks, len(entries) - len(pending)
+
+    def save_pack(self, packer, model, entries, callbacks, prompt, result, journal=None, job_id=None):
+        """Stores one row per parsed sentence and re-queues the plans that got none; returns (rows, abandoned plans, dropped rows)."""
+        sentences = {}
+        if result is not None:
+            extracted_text, request_body, full_response, duration = result
+            sentences = parse_packed_response(extracted_text, len(entries))
+
+        written, dropped, missing = 0, 0, []
+        for number, (entry, on_written) in enumerate(zip(entries, callbacks), start=1):
+            _, _, sentiment, categories_json, plan_id = entry[0]
+            sentence = sentences.get(number)
+            if sentence is not None:
+                row_response = dict(full_response, pack={"index": number, "size": len(entries)}) if isinstance(full_response, dict) else full_response
+                ok = self.process_and_save_results(model, sentiment, categories_json, prompt, sentence, request_body, row_response, duration, on_written)
+                if ok == DROPPED:
+                    dropped += 1
+                    self.journal_outcome(journal, job_id, model, plan_id, ok)
+                    continue
+                if ok:
+                    written += 1
+                    continue
+            missing.append(entry)
+
+        abandoned = packer.requeue(model, missing)
+        for (_, _, _, _, plan_id), _ in abandoned:
+            if journal is not None:
+                journal.record_failed(job_id, plan_id, model)
+        self.metrics.increment('rows', model, written)
+        self.metrics.increment('errors', model, len(abandoned))
+        self.metrics.increment('dropped', model, dropped)
+        print(f"Pack for {model}: {written}/{len(entries)} rows, {dropped} dropped, {len(missing) - len(abandoned)} re-queued, {len(abandoned)} abandoned")
+        return written, len(abandoned), dropped
+
+    def run_pack(self, packer, model, entries, journal=None, job_id=None):
+        entries, callbacks, skipped = self.prepare_pack(entries, journal, job_id)
+        if not entries:
+            return skipped, 0, 0
+        plans = [(sentiment, json.loads(categories_json)) for (_, _, sentiment, categories_json, _), _ in entries]
+        prompt = self.build_packed_prompt(plans)
+        result = None
+        try:
+            with self.metrics.span('pack', model):
+                result = self.get_pack_invoke_func(model)(model_id=model, prompt=prompt, custom_parameters=self.packed_parameters(model, len(plans)))
+        except Exception as e:
+            print(f"Error invoking model {model}: {e}")
+        written, abandoned, dropped = self.save_pack(packer, model, entries, callbacks, prompt, result, journal, job_id)
+        return written + skipped, abandoned, dropped
+
+    async def arun_pack(self, packer, model, entries, journal=None, job_id=None):
+        entries, callbacks, skipped = await asyncio.to_thread(self.prepare_pack, entries, journal, job_id)
+        if not entries:
+            return skipped, 0, 0
+        plans = [(sentiment, json.loads(categories_json)) for (_, _, sentiment, categories_json, _), _ in entries]
+        prompt = self.build_packed_prompt(plans)
+        result = None
+        try:
+            with self.metrics.span('pack', model):
+                result = await self.get_async_pack_invoke_func(model)(model_id=model, prompt=prompt, custom_parameters=self.packed_parameters(model, len(plans)))
+        except Exception as e:
+            print(f"Error invoking model {model}: {e}")
+        written, abandoned, dropped = await asyncio.to_thread(self.save_pack, packer, model, entries, callbacks, prompt, result, journal, job_id)
+        return written + skipped, abandoned, dropped
+
+    def batch_calls(self, tasks, pack_size, use_async, journal, job_id, stop=None):
+        """Returns next_call() -> (model, call) or None; call() runs one task, or one pack when pack_size > 1.
+
+        Once the stop event is set no new calls are handed out, so the batch ends when those in flight finish.
+        """
+        next_call = self.task_calls(tasks, pack_size, use_async, journal, job_id)
+        if stop is None:
+            return next_call
+        return lambda: None if stop.is_set() else next_call()
+
+    def task_calls(self, tasks, pack_size, use_async, journal, job_id):
+        if pack_size <= 1:
+            run = self.arun_task if use_async else self.run_task
+
+            def next_call():
+                task = next(tasks, None)
+                if task is None:
+                    return None
+                return task[0], functools.partial(run, *task, journal=journal, job_id=job_id)
+            return next_call
+
+        packer = PlanPacker(tasks, pack_size)
+        run = self.arun_pack if use_async else self.run_pack
+
+        def next_call():
+            pack = packer.next()
+            if pack is None:
+                return None
+            return pack[0], functools.partial(run, packer, *pack, journal=journal, job_id=job_id)
+        return next_call
+
+    def count_result(self, stats, model, result):
+        # Single tasks return True, False or DROPPED; packs return (rows written, plans abandoned, rows dropped)
+        if isinstance(result, tuple):
+            stats[model]["success"] += result[0]
+            stats[model]["error"] += result[1]
+            stats[model]["dropped"] += result[2]
+        elif result == DROPPED:
+            stats[model]["dropped"] += 1
+        else:
+            stats[model]["success" if result else "error"] += 1
+
+    def start_job(self, n_prompts, models, journal, job_id):
+        if self.planner is not None and n_prompts > len(self.planner):
+            raise ValueError(f"Requested {n_prompts} prompts but the planner only has {len(self.planner)} unique plans")
+        if journal is not None and job_id is None:
+            job_id = journal.create_job(n_prompts, models)
+        return job_id
+
+    def summarize_batch(self, stats, start_time, failed):
+        """failed is flush_db()'s {model: rows}; those rows were counted as stored and are moved to the errors."""
+        failed_writes = self.count_failed_writes(stats, failed)
+        elapsed = time.time() - start_time
+        # Only stored rows count; dropped ones are reported on their own
+        rows = sum(model_stats["success"] for model_stats in stats.values())
+        dropped = sum(model_stats["dropped"] for model_stats in stats.values())
+        rows_per_sec = rows / elapsed if elapsed > 0 else 0.0
+        print(f"Batch finished: {rows} rows in {elapsed:.2f}s ({rows_per_sec:.2f} rows/sec), {dropped} dropped, {failed_writes} failed writes")
+
+        return {"models": stats, "rows": rows, "dropped": dropped, "failed_writes": failed_writes, "elapsed": elapsed, "rows_per_sec": rows_per_sec}
+
+    def drive(self, next_call, stats, max_in_flight):
+        """Keeps up to max_in_flight calls of next_call() running on threads until it returns None with none in flight."""
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            def submit_next():
+                call = next_call()
+                if call is None:
+                    return False
+                model, run = call
+                in_flight[executor.submit(run)] = model
+                return True
+
+            # Fill the pipeline, then top it up as calls finish
+            while len(in_flight) < max_in_flight and submit_next():
+                pass
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    model = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"Task raised an exception: {e}")
+                        result = False
+                    self.count_result(stats, model, result)
+                # A scheduler may have held calls back until these results were in
+                while len(in_flight) < max_in_flight and submit_next():
+                    pass
+
+    def run_batch(self, n_prompts, models=None, max_in_flight=16, journal=None, job_id=None, pack_size=1, first_plan_id=0, stop=None):
+        """Generates n_prompts prompts and keeps up to max_in_flight (prompt, model) calls running across them.
+
+        With a JobJournal every plan, dispatch and confirmed write is recorded under job_id (created if None),
+        and passing an existing job_id resumes it. With pack_size > 1 each call asks one model for pack_size
+        numbered sentences, one per plan, and plans missing from the answer are re-queued. Without a journal,
+        first_plan_id runs only plans first_plan_id..n_prompts - 1, which is how shard workers split a run.
+        Setting the stop event (a threading.Event) ends the batch early once the calls in flight finish.
+        """
+        models = self.get_batch_models(models)
+        job_id = self.start_job(n_prompts, models, journal, job_id)
+        print(f"Running batch of {n_prompts - first_plan_id} prompts over {len(models)} models with {max_in_flight} calls in flight...")
+
+        stats = {model: {"success": 0, "error": 0, "dropped": 0} for model in models}
+        tasks = self.iter_batch_tasks(n_prompts, models, journal, job_id, first_plan_id)
+        start_time = time.time()
+        self.drive(self.batch_calls(tasks, pack_size, False, journal, job_id, stop), stats, max_in_flight)
+
+        failed = self.flush_db()
+        summary = self.summarize_batch(stats, start_time, failed)
+        if journal is not None:
+            summary["job"] = journal.progress(job_id)
+        return summary
+
+    def resume(self, journal, job_id, max_in_flight=16, pack_size=1):
+        """Re-dispatches only the (prompt, model) pairs of job_id without a confirmed write, then plans the rest."""
+        manifest = journal.get_manifest(job_id)
+        print(f"Resuming job {job_id}: {journal.progress(job_id)}")
+        return self.run_batch(manifest['n_prompts'], models=manifest['models'], max_in_flight=max_in_flight, journal=journal, job_id=job_id, pack_size=pack_size)
+
+    async def ainvoke_models_and_save(self, prompt, sentiment, categories_json):
+        print("Invoking models asynchronously and preparing to save...")
+        results = await asyncio.gather(*(
+            self.ainvoke_model_and_process(model, prompt, sentiment, categories_json)
+            for model in self.get_batch_models()
+        ))
+        success_count = sum(1 for ok in results if ok is True)
+        return success_count, sum(1 for ok in results if ok is False)
+
+    def provider_semaphores(self, models, max_in_flight, provider_limits=None):
+        provider_limits = provider_limits or {}
+        semaphores = {}
+        for model in models:
+            provider = self.get_provider(model)
+            if provider not in semaphores:
+                semaphores[provider] = asyncio.Semaphore(provider_limits.get(provider, max_in_flight))
+        return semaphores
+
+    async def adrive(self, next_call, stats, max_in_flight, semaphores):
+        """Async drive: one event loop holds up to max_in_flight calls, each also holding its provider's semaphore."""
+        async def run_call(model, run):
+            async with semaphores[self.get_provider(model)]:
+                return await run()
+
+        in_flight = {}
+
+        def submit_next():
+            call = next_call()
+            if call is None:
+                return False
+            model, run = call
+            in_flight[asyncio.ensure_future(run_call(model, run))] = model
+            return True
+
+        while len(in_flight) < max_in_flight and submit_next():
+            pass
+
+        while in_flight:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                model = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Task raised an exception: {e}")
+                    result = False
+                self.count_result(stats, model, result)
+            while len(in_flight) < max_in_flight and submit_next():
+                pass
+
+    async def arun_batch(self, n_prompts, models=None, max_in_flight=256, provider_limits=None, journal=None, job_id=None, pack_size=1, first_plan_id=0, stop=None):
+        """Async run_batch: one event loop holds up to max_in_flight calls, capped per provider by provider_limits."""
+        models = self.get_batch_models(models)
+        job_id = self.start_job(n_prompts, models, journal, job_id)
+        print(f"Running async batch of {n_prompts - first_plan_id} prompts over {len(models)} models with {max_in_flight} calls in flight...")
+
+        stats = {model: {"success": 0, "error": 0, "dropped": 0} for model in models}
+        tasks = self.iter_batch_tasks(n_prompts, models, journal, job_id, first_plan_id)
+        start_time = time.time()
+        await self.adrive(self.batch_calls(tasks, pack_size, True, journal, job_id, stop), stats, max_in_flight, self.provider_semaphores(models, max_in_flight, provider_limits))
+
+        failed = await asyncio.to_thread(self.flush_db)
+        summary = self.summarize_batch(stats, start_time, failed)
+        if journal is not None:
+            summary["job"] = journal.progress(job_id)
+        return summary
+
+    def draw_plan(self, plan_id):
+        with self.metrics.span('plan'):
+            return self.generate_prompt_with_sentiment(self.planner.plan(plan_id) if self.planner is not None else None)
+
+    def run_scheduled_task(self, scheduler, model, plan_id, prompt, sentiment, categories_json):
+        start = time.perf_counter()
+        ok = False
+        try:
+            ok = self.run_task(model, prompt, sentiment, categories_json, plan_id)
+        finally:
+            # Only a stored row counts toward the quota; a dropped one is scheduled again like a failure
+            scheduler.done(model, sentiment, ok is True, time.perf_counter() - start, dropped=ok == DROPPED)
+        return ok
+
+    async def arun_scheduled_task(self, scheduler, model, plan_id, prompt, sentiment, categories_json):
+        start = time.perf_counter()
+        ok = False
+        try:
+            ok = await self.arun_task(model, prompt, sentiment, categories_json, plan_id)
+        finally:
+            # Only a stored row counts toward the quota; a dropped one is scheduled again like a failure
+            scheduler.done(model, sentiment, ok is True, time.perf_counter() - start, dropped=ok == DROPPED)
+        return ok
+
+    def scheduled_calls(self, scheduler, use_async):
+        run = self.arun_scheduled_task if use_async else self.run_scheduled_task
+
+        def next_call():
+            pair = scheduler.next()
+            if pair is None:
+                return None
+            return pair[0], functools.partial(run, scheduler, *pair)
+        return next_call
+
+    def start_schedule(self, scheduler, models, max_in_flight, max_plans):
+        models = self.get_batch_models(models)
+        sentiments = self.planner.sentiments if self.planner is not None else self.sentiments
+        if max_plans is None and self.planner is not None:
+            max_plans = len(self.planner)
+        scheduler.start(models, sentiments, self.draw_plan, max_plans=max_plans, max_in_flight=max_in_flight)
+        print(f"Running scheduled batch of {scheduler.target_rows} rows over {len(scheduler.quotas)} models with {max_in_flight} calls in flight...")
+        return {model: {"success": 0, "error": 0, "dropped": 0} for model in scheduler.quotas}
+
+    def run_scheduled(self, scheduler, models=None, max_in_flight=16, max_plans=None):
+        """Generates scheduler.target_rows rows in the scheduler's model and sentiment mix instead of every prompt for every model.
+
+        Each prompt goes only to the models that still need rows of its sentiment, and the scheduler sends more calls
+        to slow models and fewer to ones already on track. Plans are not journaled; max_plans caps the plans drawn
+        (default: every plan of the planner).
+        """
+        stats = self.start_schedule(scheduler, models, max_in_flight, max_plans)
+        start_time = time.time()
+        self.drive(self.scheduled_calls(scheduler, False), stats, max_in_flight)
+        failed = self.flush_db()
+        summary = self.summarize_batch(stats, start_time, failed)
+        summary["schedule"] = scheduler.stats()
+        return summary
+
+    async def arun_scheduled(self, scheduler, models=None, max_in_flight=256, provider_limits=None, max_plans=None):
+        stats = self.start_schedule(scheduler, models, max_in_flight, max_plans)
+        start_time = time.time()
+        await self.adrive(self.scheduled_calls(scheduler, True), stats, max_in_flight, self.provider_semaphores(scheduler.quotas, max_in_flight, provider_limits))
+        failed = await asyncio.to_thread(self.flush_db)
+        summary = self.summarize_batch(stats, start_time, failed)
+        summary["schedule"] = scheduler.stats()
+        return summary
+
+
+def outcome_counter(ok):
+    # Metrics counter of one row outcome: stored rows, dropped rows or errors
+    if ok == DROPPED:
+        return 'dropped'
+    return 'rows' if ok else 'errors'
@@ -0,0 +1,180 @@
+import threading
+import time
+
+class ModelScheduler:
+    """Decides which (plan, model) pair to dispatch next so a run reaches a target row mix in the least wall-clock time.
+
+    Each (model, sentiment) gets a quota of target_rows * model share * sentiment share. The run ends when the slowest
+    model meets its quota, so in-flight slots go to models in proportion to their remaining work: rows still missing
+    times the observed seconds per row (latency over the share of calls that stored a row, both moving averages).
+    A model with enough rows written or in flight gets no more calls. Only stored rows count toward a quota: failed
+    rows and rows dropped before storage (near-duplicates, sentiment mismatches) are simply scheduled again, and a
+    model with max_consecutive_errors such calls in a row is given up on instead of holding the run back.
+
+    Plans are drawn once and shared: every model walks the same list of plans of each sentiment, so the models still
+    answer the same prompts when their mixes are alike.
+    """
+
+    def __init__(self, target_rows, model_mix=None, sentiment_mix=None, prior_latency=1.0, smoothing=0.2, max_consecutive_errors=25):
+        """model_mix and sentiment_mix map names to shares (normalized); None splits evenly over the run's models and sentiments."""
+        self.target_rows = target_rows
+        self.model_mix = model_mix
+        self.sentiment_mix = sentiment_mix
+        self.prior_latency = prior_latency
+        self.smoothing = smoothing
+        self.max_consecutive_errors = max_consecutive_errors
+        self._lock = threading.Lock()
+
+    def start(self, models, sentiments, draw_plan, max_plans=None, max_in_flight=16):
+        """draw_plan(plan_id) returns (prompt, sentiment, categories_json); at most max_plans plans are drawn."""
+        model_mix = normalize(self.model_mix or dict.fromkeys(models, 1.0))
+        sentiment_mix = normalize(self.sentiment_mix or dict.fromkeys(sentiments, 1.0))
+        unknown = set(model_mix) - set(models)
+        if unknown:
+            raise ValueError(f"Model mix names models this run has no client for: {sorted(unknown)}")
+        self.quotas = {model: allocate(rows, sentiment_mix) for model, rows in allocate(self.target_rows, model_mix).items() if rows > 0}
+        self.draw_plan = draw_plan
+        self.max_plans = max_plans
+        self.max_in_flight = max_in_flight
+        self.next_plan_id = 0
+        # Drawn plans per sentiment; plans[sentiment][i - offsets[sentiment]] is the i-th plan of that sentiment
+        self.plans = {sentiment: [] for sentiment in sentiment_mix}
+        self.offsets = dict.fromkeys(sentiment_mix, 0)
+        self.cursors = {model: dict.fromkeys(sentiment_mix, 0) for model in self.quotas}
+        self.written = {model: dict.fromkeys(sentiment_mix, 0) for model in self.quotas}
+        self.in_flight = {model: dict.fromkeys(sentiment_mix, 0) for model in self.quotas}
+        self.estimates = {model: {"latency": None, "error_rate": 0.0, "failed": 0, "dropped": 0, "consecutive_errors": 0} for model in self.quotas}
+        self.given_up = set()
+        self.out_of_plans = set()
+        self.start_time = time.time()
+
+    def remaining(self, model):
+        return sum(max(0, quota - self.written[model][sentiment]) for sentiment, quota in self.quotas[model].items())
+
+    def seconds_per_row(self, model):
+        estimate = self.estimates[model]
+        latency = estimate["latency"] if estimate["latency"] is not None else self.prior_latency
+        return latency / max(1.0 - estimate["error_rate"], 0.05)
+
+    def open_sentiments(self, model):
+        """Sentiments of model with rows left to dispatch, most behind their quota first."""
+        open_ = []
+        for sentiment, quota in self.quotas[model].items():
+            missing = quota - self.written[model][sentiment] - self.in_flight[model][sentiment]
+            if missing > 0 and (model, sentiment) not in self.out_of_plans:
+                open_.append((missing / quota, sentiment))
+        return [sentiment for _, sentiment in sorted(open_, reverse=True)]
+
+    def take_plan(self, model, sentiment):
+        """The model's next plan of sentiment, drawing new plans as needed; None once max_plans are used up."""
+        # A model that fell behind the dropped plans (it met its quota, then a row failed) skips ahead to the oldest kept plan
+        self.cursors[model][sentiment] = max(self.cursors[model][sentiment], self.offsets[sentiment])
+        index = self.cursors[model][sentiment] - self.offsets[sentiment]
+        while index >= len(self.plans[sentiment]):
+            if self.max_plans is not None and self.next_plan_id >= self.max_plans:
+                print(f"No plans left for {model} ({sentiment}) after {self.next_plan_id} plans")
+                self.out_of_plans.add((model, sentiment))
+                return None
+            plan_id = self.next_plan_id
+            self.next_plan_id += 1
+            prompt, drawn_sentiment, categories_json = self.draw_plan(plan_id)
+            if drawn_sentiment in self.plans:
+                self.plans[drawn_sentiment].append((plan_id, prompt, categories_json))
+        self.cursors[model][sentiment] += 1
+        plan = self.plans[sentiment][index]
+        self.forget_used_plans(sentiment)
+        return plan
+
+    def forget_used_plans(self, sentiment):
+        # Plans every model still needing this sentiment has walked past are dropped, so memory follows the slowest model
+        cursors = [self.cursors[model][sentiment] for model in self.quotas
+                   if model not in self.given_up and self.written[model][sentiment] + self.in_flight[model][sentiment] < self.quotas[model][sentiment]]
+        used = min(cursors) - self.offsets[sentiment] if cursors else 0
+        if used >= 1024:
+            del self.plans[sentiment][:used]
+            self.offsets[sentiment] += used
+
+    def next(self):
+        """Returns (model, plan_id, prompt, sentiment, categories_json) to dispatch, or None when no model needs a call now."""
+        with self._lock:
+            candidates = []
+            total_work = 0.0
+            for model in self.quotas:
+                if model in self.given_up:
+                    continue
+                work = self.remaining(model) * self.seconds_per_row(model)
+                total_work += work
+                if self.open_sentiments(model):
+                    candidates.append((model, work))
+            if not candidates:
+                return None
+
+            busy = sum(sum(in_flight.values()) for in_flight in self.in_flight.values())
+            slots = max(self.max_in_flight, busy + 1)
+            # Furthest below its fair share of slots first, the most remaining work on ties
+            model = max(candidates, key=lambda candidate: (slots * candidate[1] / total_work - sum(self.in_flight[candidate[0]].values()), candidate[1]))[0]
+            for sentiment in self.open_sentiments(model):
+                plan = self.take_plan(model, sentiment)
+                if plan is not None:
+                    self.in_flight[model][sentiment] += 1
+                    plan_id, prompt, categories_json = plan
+                    return model, plan_id, prompt, sentiment, categories_json
+        # That model is out of plans; another one may still have some
+        return self.next()
+
+    def done(self, model, sentiment, stored, seconds, dropped=False):
+        """Records the outcome of one dispatched pair: stored when its row was written, dropped when it was filtered out.
+
+        seconds is its wall time including the write. error_rate is the share of calls that stored no row.
+        """
+        with self._lock:
+            self.in_flight[model][sentiment] -= 1
+            estimate = self.estimates[model]
+            estimate["latency"] = seconds if estimate["latency"] is None else estimate["latency"] + self.smoothing * (seconds - estimate["latency"])
+            estimate["error_rate"] += self.smoothing * ((0.0 if stored else 1.0) - estimate["error_rate"])
+            if stored:
+                self.written[model][sentiment] += 1
+                estimate["consecutive_errors"] = 0
+                return
+            estimate["dropped" if dropped else "failed"] += 1
+            estimate["consecutive_errors"] += 1
+            if estimate["consecutive_errors"] >= self.max_consecutive_errors and model not in self.given_up:
+                self.given_up.add(model)
+                print(f"Giving up on {model} after {estimate['consecutive_errors']} calls in a row without a stored row")
+
+    def stats(self):
+        with self._lock:
+            elapsed = time.time() - self.start_time
+            models = {}
+            for model, quotas in self.quotas.items():
+                written = sum(self.written[model].values())
+                estimate = self.estimates[model]
+                models[model] = {
+                    "quota": sum(quotas.values()),
+                    "written": written,
+                    "failed": estimate["failed"],
+                    "dropped": estimate["dropped"],
+                    "sentiments": {sentiment: f"{self.written[model][sentiment]}/{quota}" for sentiment, quota in quotas.items()},
+                    "latency": round(estimate["latency"], 4) if estimate["latency"] is not None else None,
+                    "error_rate": round(estimate["error_rate"], 4),
+                    "rows_per_sec": round(written / elapsed, 2) if elapsed > 0 else 0.0,
+                    "given_up": model in self.given_up
+                }
+            return {"target_rows": self.target_rows, "plans_drawn": self.next_plan_id, "quotas_met": all(self.remaining(model) == 0 for model in self.quotas),
+                    "models": models}
+
+
+def normalize(mix):
+    total = sum(mix.values())
+    if total <= 0:
+        raise ValueError(f"Mix {mix} has no positive share")
+    return {name: share / total for name, share in mix.items()}
+
+
+def allocate(rows, shares):
+    """Splits rows over shares by largest remainder, so the parts add up to rows exactly."""
+    exact = {name: rows * share for name, share in shares.items()}
+    parts = {name: int(value) for name, value in exact.items()}
+    for name in sorted(exact, key=lambda name: exact[name] - parts[name], reverse=True)[:rows - sum(parts.values())]:
+        parts[name] += 1
+    return parts
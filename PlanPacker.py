@@ -0,0 +1,90 @@
+from collections import deque
+import re
+import threading
+
+# "3. text", "3) text", "(3) text", "**3.** text" or "3: text"
+PACKED_LINE = re.compile(r'^\s*(?:[-*]\s*)?(?:\*\*)?\(?(\d{1,3})[.):\]](?:\*\*)?\s+(.+?)\s*$')
+MIN_WORDS = 3
+
+def parse_packed_response(text, pack_size):
+    """Maps item number (1..pack_size) to its sentence; missing, repeated or malformed items are left out."""
+    sentences = {}
+    if not isinstance(text, str):
+        return sentences
+    for line in text.splitlines():
+        match = PACKED_LINE.match(line)
+        if match is None:
+            continue
+        index = int(match.group(1))
+        sentence = match.group(2).strip().strip('"“”').strip()
+        # The first answer for a number wins; later ones are usually the model restarting its list
+        if 1 <= index <= pack_size and index not in sentences and len(sentence.split()) >= MIN_WORDS:
+            sentences[index] = sentence
+    return sentences
+
+
+class PlanPacker:
+    """Groups single-plan batch tasks per model into packs of pack_size and re-queues plans a pack did not produce.
+
+    Tasks are the (model, prompt, sentiment, categories_json, plan_id) tuples of ModelPromptProcessor.iter_batch_tasks;
+    pack entries are (task, attempt) pairs.
+    """
+
+    def __init__(self, tasks, pack_size, max_attempts=3):
+        self.tasks = tasks
+        self.pack_size = pack_size
+        self.max_attempts = max_attempts
+        self.buffers = {}
+        self.requeued = {}
+        self.exhausted = False
+        self.counters = {"packs": 0, "requeued": 0, "abandoned": 0}
+        self._lock = threading.Lock()
+
+    def take(self, queue):
+        return [queue.popleft() for _ in range(min(self.pack_size, len(queue)))]
+
+    def next(self):
+        """Returns (model, entries) for the next pack, or None when nothing is left to send right now."""
+        with self._lock:
+            pack = self._next()
+            if pack is not None:
+                self.counters["packs"] += 1
+            return pack
+
+    def _next(self):
+        for model, queue in self.requeued.items():
+            if len(queue) >= self.pack_size:
+                return model, self.take(queue)
+
+        while not self.exhausted:
+            task = next(self.tasks, None)
+            if task is None:
+                self.exhausted = True
+                break
+            model = task[0]
+            buffer = self.buffers.setdefault(model, [])
+            buffer.append((task, 1))
+            if len(buffer) >= self.pack_size:
+                return model, self.buffers.pop(model)
+
+        # Everything is planned: send partial packs, then whatever is waiting for a retry
+        for model in list(self.buffers):
+            return model, self.buffers.pop(model)
+        for model, queue in self.requeued.items():
+            if queue:
+                return model, self.take(queue)
+        return None
+
+    def requeue(self, model, entries):
+        """Queues entries for another attempt; returns the ones that ran out of attempts."""
+        abandoned = []
+        with self._lock:
+            queue = self.requeued.setdefault(model, deque())
+            for task, attempt in entries:
+                if attempt >= self.max_attempts:
+                    abandoned.append((task, attempt))
+                else:
+                    queue.append((task, attempt + 1))
+            self.counters["requeued"] += len(entries) - len(abandoned)
+            self.counters["abandoned"] += len(abandoned)
+        return abandoned
@@ -0,0 +1,77 @@
+import itertools
+import numpy as np
+
+class PromptPlanner:
+    """Seeded enumeration of every (categories, topics, sentiment) plan in topics.json, handed out without replacement.
+
+    The space is split into strata, one per (category combination, sentiment). Plans are ordered so every
+    stratum is visited in proportion to its size: with equally sized categories each consecutive block of
+    n_strata plans holds exactly one plan per category combination and sentiment.
+    """
+
+    def __init__(self, categories, n_categories=3, sentiments=("positive", "negative"), seed=0):
+        data = categories['data']
+        self.category_names = [category['category'] for category in data]
+        self.topics = [category['topics'] for category in data]
+        self.sentiments = list(sentiments)
+        self.seed = seed
+
+        topic_counts = np.array([len(topics) for topics in self.topics], dtype=np.int64)
+        self.combos = np.array(list(itertools.combinations(range(len(data)), n_categories)), dtype=np.int64)
+        combo_sizes = topic_counts[self.combos].prod(axis=1)
+        # Mixed-radix digits of a plan's index inside its combination are its topic indices
+        self.combo_radices = topic_counts[self.combos]
+
+        n_sentiments = len(self.sentiments)
+        strata_sizes = np.repeat(combo_sizes, n_sentiments)
+        self.n_strata = len(strata_sizes)
+        self.strata_offsets = np.concatenate(([0], np.cumsum(strata_sizes)[:-1]))
+        self.size = int(strata_sizes.sum())
+
+        rng = np.random.default_rng(seed)
+        stratum_of = np.repeat(np.arange(self.n_strata, dtype=np.int64), strata_sizes)
+        # Random rank of every plan inside its stratum
+        shuffled = np.lexsort((rng.random(self.size), stratum_of))
+        rank = np.empty(self.size, dtype=np.int64)
+        rank[shuffled] = np.arange(self.size, dtype=np.int64) - self.strata_offsets[stratum_of[shuffled]]
+        # Interleave strata proportionally to their size; the per-stratum phase shuffles the order within a round
+        phase = rng.random(self.n_strata)
+        key = (rank + phase[stratum_of]) / strata_sizes[stratum_of]
+        self.order = np.argsort(key, kind='stable')
+        self.stratum_of = stratum_of
+
+    def __len__(self):
+        return self.size
+
+    def plan(self, index):
+        """Returns (sentiment, {category: topic}) for the index-th plan; O(1) per call."""
+        if not 0 <= index < self.size:
+            raise IndexError(f"Plan {index} is outside the {self.size} unique plans of this planner")
+        element = int(self.order[index])
+        stratum = int(self.stratum_of[element])
+        combo, sentiment = divmod(stratum, len(self.sentiments))
+        local_index = element - int(self.strata_offsets[stratum])
+
+        category_topic_pairs = {}
+        for category, radix in zip(self.combos[combo], self.combo_radices[combo]):
+            local_index, topic_index = divmod(local_index, int(radix))
+            category_topic_pairs[self.category_names[category]] = self.topics[category][topic_index]
+        return self.sentiments[sentiment], category_topic_pairs
+
+    def plans(self, n, start=0):
+        if start + n > self.size:
+            raise ValueError(f"Requested {n} plans from {start} but only {self.size} unique plans exist")
+        for index in range(start, start + n):
+            yield self.plan(index)
+
+    def coverage(self, n):
+        """Counts of the first n plans per sentiment and per category, to check the balance of a run."""
+        elements = self.order[:n]
+        strata = self.stratum_of[elements]
+        sentiments = np.bincount(strata % len(self.sentiments), minlength=len(self.sentiments))
+        combo_counts = np.bincount(strata // len(self.sentiments), minlength=len(self.combos))
+        category_counts = np.bincount(self.combos.ravel(), weights=np.repeat(combo_counts, self.combos.shape[1]), minlength=len(self.category_names))
+        return {
+            "sentiments": dict(zip(self.sentiments, sentiments.tolist())),
+            "categories": dict(zip(self.category_names, category_counts.astype(int).tolist()))
+        }
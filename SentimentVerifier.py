@@ -0,0 +1,256 @@
+from concurrent.futures import Future
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from LLMs.Metrics import get_default_metrics
+
+# Label order of the classifier scripts/train.py fits on DatasetExporter output (DatasetExporter.LABELS)
+LABELS = ('negative', 'positive')
+CONFIG_NAME = 'verifier.json'
+
+def export_verifier(model_dir, output_dir, backend='onnx', labels=LABELS, max_length=64):
+    """Exports the classifier saved by scripts/train.py to an int8 model for CPU inference in output_dir.
+
+    backend='onnx' exports to ONNX and quantizes the weights with onnxruntime's dynamic quantization; backend='torch'
+    applies torch dynamic quantization to the Linear layers and saves TorchScript, for hosts without onnxruntime.
+    """
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir).eval()
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer.save_pretrained(output_dir)
+
+    sample = tokenizer(["A short sample sentence.", "Another one."], padding=True, return_tensors='pt')
+    input_names = list(sample.keys())
+
+    class Logits(torch.nn.Module):
+        # Positional inputs in input_names order, so the exported graph does not depend on the model's forward signature
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs)), return_dict=False)[0]
+
+    inputs = tuple(sample[name] for name in input_names)
+    if backend == 'onnx':
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        float_path = os.path.join(output_dir, 'model.onnx')
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+        dynamic_axes['logits'] = {0: 'batch'}
+        torch.onnx.export(Logits(), inputs, float_path, input_names=input_names, output_names=['logits'], dynamic_axes=dynamic_axes, opset_version=17)
+        model_file = 'model.int8.onnx'
+        quantize_dynamic(float_path, os.path.join(output_dir, model_file), weight_type=QuantType.QInt8)
+        os.remove(float_path)
+    elif backend == 'torch':
+        quantized = torch.ao.quantization.quantize_dynamic(Logits(), {torch.nn.Linear}, dtype=torch.qint8)
+        model_file = 'model.int8.pt'
+        with torch.inference_mode():
+            torch.jit.save(torch.jit.trace(quantized, inputs, strict=False), os.path.join(output_dir, model_file))
+    else:
+        raise ValueError(f"Unknown verifier backend {backend}")
+
+    config = {"backend": backend, "model_file": model_file, "input_names": input_names, "labels": list(labels), "max_length": max_length}
+    with open(os.path.join(output_dir, CONFIG_NAME), 'w', encoding='utf-8') as file:
+        json.dump(config, file, indent=2)
+    print(f"Exported {backend} int8 verifier to {output_dir}")
+    return config
+
+
+class SentimentVerifier:
+    """Checks that generated sentences carry the sentiment they were asked for, with the int8 classifier of export_verifier.
+
+    Concurrent verify() calls are queued and scored together: a background thread takes up to batch_size sentences,
+    waiting at most max_wait seconds for a batch to fill. A sentence mismatches when the classifier picks another
+    label with at least min_confidence; action='tag' stores the verdict with the row, action='drop' skips the row.
+    """
+
+    def __init__(self, path, action='tag', min_confidence=0.5, batch_size=64, max_wait=0.005, threads=None, metrics=None):
+        if action not in ('tag', 'drop'):
+            raise ValueError(f"Unknown verifier action {action}")
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(path, CONFIG_NAME), 'r', encoding='utf-8') as file:
+            self.config = json.load(file)
+        self.path = path
+        self.action = action
+        self.min_confidence = min_confidence
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.labels = self.config["labels"]
+        self.input_names = self.config["input_names"]
+        self.metrics = metrics or get_default_metrics()
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        self.run_model = self.load_model(threads or os.cpu_count())
+        self.counters = {"checked": 0, "mismatched": 0, "dropped": 0, "batches": 0}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._batch_loop, name="SentimentVerifier", daemon=True)
+        self._worker.start()
+
+    def load_model(self, threads):
+        """Returns run(inputs) -> logits for a dict of int64 arrays named like input_names."""
+        model_path = os.path.join(self.path, self.config["model_file"])
+        if self.config["backend"] == 'onnx':
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = threads
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+            return lambda inputs: session.run(['logits'], inputs)[0]
+
+        import torch
+        torch.set_num_threads(threads)
+        module = torch.jit.load(model_path)
+
+        def run(inputs):
+            with torch.inference_mode():
+                return module(*(torch.from_numpy(inputs[name]) for name in self.input_names)).numpy()
+        return run
+
+    def predict(self, texts):
+        """Returns (label index, confidence) arrays for texts, padded to the longest text of the batch."""
+        encoded = self.tokenizer(texts, padding=True, truncation=True, max_length=self.config["max_length"], return_tensors='np')
+        logits = self.run_model({name: encoded[name].astype(np.int64) for name in self.input_names})
+        logits = logits - logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        return probabilities.argmax(axis=1), probabilities.max(axis=1)
+
+    def score(self, texts):
+        """Scores a list of sentences in length-sorted batches, for bulk checks of stored rows; returns [(label, confidence)]."""
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        results = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            chunk = order[start:start + self.batch_size]
+            labels, confidences = self.predict([texts[i] for i in chunk])
+            for i, label, confidence in zip(chunk, labels, confidences):
+                results[i] = (self.labels[label], float(confidence))
+        return results
+
+    def _batch_loop(self):
+        stopping = False
+        while not stopping:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            batch = [entry]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self._queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+
+            try:
+                with self.metrics.span('verify'):
+                    labels, confidences = self.predict([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self._lock:
+                self.counters["batches"] += 1
+            for (_, future), label, confidence in zip(batch, labels, confidences):
+                future.set_result((self.labels[label], float(confidence)))
+
+    def submit(self, text):
+        future = Future()
+        # Checked under the lock close() takes, so nothing is queued behind the stop sentinel
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("SentimentVerifier is closed")
+            self._queue.put((text, future))
+        return future
+
+    def verify(self, model, sentiment, text):
+        """Returns {"label", "confidence", "match"} for text, or None when there is nothing to check."""
+        if not isinstance(text, str) or not text.strip() or sentiment not in self.labels:
+            return None
+        label, confidence = self.submit(text).result()
+        match = label == sentiment or confidence < self.min_confidence
+        with self._lock:
+            self.counters["checked"] += 1
+            if not match:
+                self.counters["mismatched"] += 1
+                if self.action == 'drop':
+                    self.counters["dropped"] += 1
+        if not match:
+            self.metrics.increment('mismatches', model)
+        return {"label": label, "confidence": round(confidence, 4), "match": match}
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, action=self.action, backend=self.config["backend"])
+
+    def close(self):
+        """Scores the sentences already queued, then fails any verify() still waiting; later calls raise RuntimeError."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._worker.join()
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is not None:
+                entry[1].set_exception(RuntimeError("SentimentVerifier closed before scoring the sentence"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exports the scripts/train.py classifier to int8 and measures its CPU throughput.")
+    parser.add_argument("command", choices=["export", "bench"])
+    parser.add_argument("--model_dir", type=str, help="export: the model directory trainer.save_model wrote")
+    parser.add_argument("--path", type=str, default=".cache/verifier", help="exported verifier directory")
+    parser.add_argument("--backend", type=str, choices=["onnx", "torch"], default="onnx")
+    parser.add_argument("--max_length", type=int, default=64)
+    parser.add_argument("--sentences", type=int, default=10000, help="bench: sentences to score")
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--clients", type=int, default=32, help="bench: threads calling verify() at once")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        export_verifier(args.model_dir, args.path, backend=args.backend, max_length=args.max_length)
+        return
+
+    verifier = SentimentVerifier(args.path, batch_size=args.batch_size)
+    words = "the day felt long but the team still found a reason to smile about the results".split()
+    rng = np.random.default_rng(0)
+    texts = [" ".join(rng.choice(words, size=rng.integers(8, 24))).capitalize() + "." for _ in range(args.sentences)]
+
+    start = time.perf_counter()
+    verifier.score(texts)
+    bulk = time.perf_counter() - start
+
+    from concurrent.futures import ThreadPoolExecutor
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        list(executor.map(lambda text: verifier.verify("bench", "positive", text), texts))
+    queued = time.perf_counter() - start
+    verifier.close()
+    print(json.dumps({
+        "backend": verifier.config["backend"],
+        "bulk_sentences_per_sec": round(len(texts) / bulk, 1),
+        "queued_sentences_per_sec": round(len(texts) / queued, 1),
+        "mean_batch": round(len(texts) / max(verifier.counters["batches"], 1), 1)
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
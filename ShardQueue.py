@@ -0,0 +1,279 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hmac
+import ipaddress
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Shared secret a served queue requires from every caller; also read from the SHARD_QUEUE_TOKEN environment variable
+TOKEN_HEADER = 'X-Shard-Queue-Token'
+
+class ShardQueue:
+    """SQLite lease queue splitting a run's prompt plans into shards of plan IDs [first_plan, end_plan).
+
+    A worker claims a shard, renews its lease while working and completes or releases it. A shard whose lease
+    ran out (its worker died or hung) is handed to the next worker that asks, up to max_attempts claims.
+    Rows are written at least once: a reclaimed shard is run again from its first plan.
+    """
+
+    def __init__(self, path='.cache/shards.sqlite', lease_seconds=60.0, max_attempts=3):
+        """lease_seconds is recorded in the manifest of runs created here and applies to every claim on them."""
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._leases = {}
+        # Every worker process opens its own connection; the busy timeout covers claims racing on the write lock
+        self.connection = sqlite3.connect(path, timeout=30.0, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY, created_at REAL, manifest TEXT
+            );
+            CREATE TABLE IF NOT EXISTS shards (
+                run_id TEXT, shard_id INTEGER, first_plan INTEGER, end_plan INTEGER,
+                status TEXT, worker TEXT, lease_until REAL, attempts INTEGER DEFAULT 0,
+                rows INTEGER DEFAULT 0, errors INTEGER DEFAULT 0, started_at REAL, updated_at REAL,
+                PRIMARY KEY (run_id, shard_id)
+            );
+            CREATE INDEX IF NOT EXISTS shards_by_status ON shards (run_id, status, lease_until);
+        """)
+
+    def transaction(self, func):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never claim the same shard
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self.connection)
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            return result
+
+    def create_run(self, n_prompts, shard_size, run_id=None, **settings):
+        """Splits plans 0..n_prompts - 1 into shards of shard_size; settings (models, seed, ...) go into the manifest."""
+        run_id = run_id or uuid.uuid4().hex[:12]
+        manifest = dict(settings, n_prompts=n_prompts, shard_size=shard_size, lease_seconds=self.lease_seconds)
+        now = time.time()
+        shards = [(run_id, shard_id, first_plan, min(first_plan + shard_size, n_prompts), 'pending', now)
+                  for shard_id, first_plan in enumerate(range(0, n_prompts, shard_size))]
+
+        def insert(connection):
+            connection.execute("INSERT INTO runs (run_id, created_at, manifest) VALUES (?, ?, ?)", (run_id, now, json.dumps(manifest)))
+            connection.executemany("INSERT INTO shards (run_id, shard_id, first_plan, end_plan, status, updated_at) VALUES (?, ?, ?, ?, ?, ?)", shards)
+
+        self.transaction(insert)
+        print(f"Created run {run_id}: {n_prompts} prompts in {len(shards)} shards of {shard_size}")
+        return run_id
+
+    def get_manifest(self, run_id):
+        with self._lock:
+            row = self.connection.execute("SELECT manifest FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"Run {run_id} not found in {self.path}")
+        return json.loads(row[0])
+
+    def lease_for(self, run_id):
+        # The run's own lease length, so every process sharing the queue expires leases alike
+        if run_id not in self._leases:
+            self._leases[run_id] = self.get_manifest(run_id).get('lease_seconds', self.lease_seconds)
+        return self._leases[run_id]
+
+    def claim(self, run_id, worker):
+        """Leases the next pending or expired shard to worker; returns it as a dict, or None when nothing is claimable."""
+        lease_seconds = self.lease_for(run_id)
+
+        def claim_shard(connection):
+            now = time.time()
+            # Shards that used up their attempts are given up on instead of being reclaimed forever
+            connection.execute(
+                "UPDATE shards SET status = 'failed', updated_at = ? WHERE run_id = ? AND status = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, run_id, now, self.max_attempts)
+            )
+            row = connection.execute(
+                "SELECT shard_id, first_plan, end_plan, attempts FROM shards WHERE run_id = ? "
+                "AND (status = 'pending' OR (status = 'leased' AND lease_until < ?)) ORDER BY shard_id LIMIT 1",
+                (run_id, now)
+            ).fetchone()
+            if row is None:
+                return None
+            shard_id, first_plan, end_plan, attempts = row
+            connection.execute(
+                "UPDATE shards SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                "rows = 0, errors = 0, started_at = ?, updated_at = ? WHERE run_id = ? AND shard_id = ?",
+                (worker, now + lease_seconds, now, now, run_id, shard_id)
+            )
+            return {"run_id": run_id, "shard_id": shard_id, "first_plan": first_plan, "end_plan": end_plan, "attempt": attempts + 1}
+
+        return self.transaction(claim_shard)
+
+    def update(self, run_id, shard_id, worker, status, lease_until, rows=None, errors=None):
+        def update_shard(connection):
+            cursor = connection.execute(
+                "UPDATE shards SET status = ?, lease_until = ?, rows = COALESCE(?, rows), errors = COALESCE(?, errors), updated_at = ? "
+                "WHERE run_id = ? AND shard_id = ? AND worker = ? AND status = 'leased'",
+                (status, lease_until, rows, errors, time.time(), run_id, shard_id, worker)
+            )
+            return cursor.rowcount == 1
+
+        return self.transaction(update_shard)
+
+    def renew(self, run_id, shard_id, worker, rows=None, errors=None):
+        """Extends the lease; False means the shard was reclaimed by another worker and this one should stop."""
+        return self.update(run_id, shard_id, worker, 'leased', time.time() + self.lease_for(run_id), rows, errors)
+
+    def complete(self, run_id, shard_id, worker, rows, errors):
+        return self.update(run_id, shard_id, worker, 'done', None, rows, errors)
+
+    def release(self, run_id, shard_id, worker):
+        """Hands the shard back without using up an attempt, e.g. when a worker shuts down cleanly."""
+        def release_shard(connection):
+            cursor = connection.execute(
+                "UPDATE shards SET status = 'pending', worker = NULL, lease_until = NULL, attempts = attempts - 1, updated_at = ? "
+                "WHERE run_id = ? AND shard_id = ? AND worker = ? AND status = 'leased'",
+                (time.time(), run_id, shard_id, worker)
+            )
+            return cursor.rowcount == 1
+
+        return self.transaction(release_shard)
+
+    def progress(self, run_id):
+        manifest = self.get_manifest(run_id)
+        now = time.time()
+        with self._lock:
+            statuses = dict(self.connection.execute(
+                "SELECT CASE WHEN status = 'leased' AND lease_until < ? THEN 'expired' ELSE status END, COUNT(*) "
+                "FROM shards WHERE run_id = ? GROUP BY 1", (now, run_id)
+            ).fetchall())
+            rows, errors, reclaimed, started_at = self.connection.execute(
+                "SELECT COALESCE(SUM(rows), 0), COALESCE(SUM(errors), 0), COALESCE(SUM(attempts > 1), 0), MIN(started_at) FROM shards WHERE run_id = ?",
+                (run_id,)
+            ).fetchone()
+            workers = self.connection.execute(
+                "SELECT COUNT(DISTINCT worker) FROM shards WHERE run_id = ? AND status = 'leased' AND lease_until >= ?", (run_id, now)
+            ).fetchone()[0]
+        elapsed = now - started_at if started_at else 0.0
+        return {
+            "run_id": run_id,
+            "shards": {status: statuses.get(status, 0) for status in ('pending', 'leased', 'expired', 'done', 'failed')},
+            "shards_total": sum(statuses.values()),
+            "shards_reclaimed": reclaimed,
+            "active_workers": workers,
+            "pairs_total": manifest['n_prompts'] * len(manifest.get('models') or []),
+            "rows": rows,
+            "errors": errors,
+            "rows_per_sec": round(rows / elapsed, 2) if elapsed > 0 else 0.0
+        }
+
+    def finished(self, run_id):
+        shards = self.progress(run_id)["shards"]
+        return shards['pending'] + shards['leased'] + shards['expired'] == 0
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+class ShardQueueHandler(BaseHTTPRequestHandler):
+    # POST /<method> with the keyword arguments as a JSON object
+    methods = ('create_run', 'get_manifest', 'claim', 'renew', 'complete', 'release', 'progress', 'finished')
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        method = self.path.strip('/')
+        try:
+            if self.server.token is not None and not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ''), self.server.token):
+                raise PermissionError("Missing or wrong shard queue token")
+            if method not in self.methods:
+                raise KeyError(f"Unknown method {method}")
+            arguments = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            status, payload = 200, {"result": getattr(self.server.queue, method)(**arguments)}
+        except PermissionError as e:
+            status, payload = 401, {"error": str(e)}
+        except KeyError as e:
+            status, payload = 404, {"error": str(e)}
+        except Exception as e:
+            status, payload = 500, {"error": str(e)}
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def serve_queue(queue, host='127.0.0.1', port=8765, token=None):
+    """Serves queue over HTTP so workers on other hosts can share it; blocks until interrupted.
+
+    Anyone who can reach the endpoint can claim, complete and fail shards, so it listens on loopback by default and
+    binding any other host requires a token that callers send in the TOKEN_HEADER header.
+    """
+    token = token or os.getenv("SHARD_QUEUE_TOKEN")
+    if not token and not is_loopback(host):
+        raise ValueError(f"Serving the shard queue on {host} requires a token (--token or SHARD_QUEUE_TOKEN)")
+    server = ThreadingHTTPServer((host, port), ShardQueueHandler)
+    server.queue = queue
+    server.token = token or None
+    print(f"Shard queue {queue.path} served on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class RemoteShardQueue:
+    """ShardQueue methods called on a serve_queue endpoint."""
+
+    def __init__(self, url, timeout=30.0, token=None):
+        import requests
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        token = token or os.getenv("SHARD_QUEUE_TOKEN")
+        if token:
+            self.session.headers[TOKEN_HEADER] = token
+
+    def call(self, method, **arguments):
+        response = self.session.post(f"{self.url}/{method}", json=arguments, timeout=self.timeout)
+        payload = response.json()
+        if response.status_code == 404:
+            raise KeyError(payload["error"])
+        if response.status_code == 401:
+            raise PermissionError(payload["error"])
+        if response.status_code != 200:
+            raise RuntimeError(f"Shard queue {method} failed: {payload.get('error')}")
+        return payload["result"]
+
+    def __getattr__(self, method):
+        if method not in ShardQueueHandler.methods:
+            raise AttributeError(method)
+        return lambda **arguments: self.call(method, **arguments)
+
+    def close(self):
+        self.session.close()
+
+
+def open_queue(location, token=None, **settings):
+    """A local ShardQueue for a file path, a RemoteShardQueue for an http(s) URL sending token (default: SHARD_QUEUE_TOKEN)."""
+    if location.startswith(('http://', 'https://')):
+        return RemoteShardQueue(location, token=token)
+    return ShardQueue(location, **settings)
@@ -0,0 +1,196 @@
+from dotenv import load_dotenv
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from LLMs.ApiRuntimeClient import ContentGenerator
+from LLMs.BedrockRuntimeClient import BedrockRuntimeClient
+from LLMs.ConnectionPool import ConnectionPool
+from LLMs.Metrics import Metrics
+from LLMs.RateLimiter import RateLimiterRegistry
+from DBInference import DBInference
+from ModelPromotProcessor import ModelPromptProcessor
+from PromptPlanner import PromptPlanner
+from ShardQueue import open_queue, serve_queue
+from StorageBackends import open_storage
+
+def build_processor(manifest, metrics):
+    """Default worker wiring, configured from the environment like main.py; returns (processor, close).
+
+    RATE_LIMITS apply per worker process, so divide the provider quotas by the number of workers.
+    """
+    load_dotenv()
+    pool = ConnectionPool(max_connections=manifest['max_in_flight'])
+    rate_limiter = RateLimiterRegistry(limits=json.loads(os.getenv("RATE_LIMITS", "{}")))
+    storage = os.getenv("STORAGE", "dynamodb")
+    if storage == "dynamodb":
+        db_instance = DBInference(pool=pool, write_behind=True, metrics=metrics, layout=os.getenv("DB_LAYOUT", "flat"))
+    else:
+        db_instance = open_storage(storage, os.getenv("STORAGE_PATH"), metrics=metrics)
+    brt_client = BedrockRuntimeClient(pool=pool, rate_limiter=rate_limiter, metrics=metrics, region_name=os.getenv("BEDROCK_REGION"))
+    content_generators = {
+        "gemini-pro": ContentGenerator(os.getenv("GEMINI_API_KEY"), pool=pool, rate_limiter=rate_limiter, metrics=metrics),
+        "gpt-4": ContentGenerator(os.getenv("OPENAI_API_KEY"), pool=pool, rate_limiter=rate_limiter, metrics=metrics)
+    }
+    with open(manifest['topics'], 'r', encoding='utf-8') as file:
+        categories = json.load(file)
+    processor = ModelPromptProcessor(categories, brt_client, db_instance, content_generators,
+                                     planner=PromptPlanner(categories, seed=manifest['seed']), metrics=metrics)
+    return processor, db_instance.close
+
+
+class ShardWorker:
+    """Claims shards of a run until none are left, running each one as a batch over its plan range."""
+
+    def __init__(self, queue, run_id, build=build_processor, worker_id=None, poll_interval=2.0):
+        self.queue = queue
+        self.run_id = run_id
+        self.build = build
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_interval = poll_interval
+        self.totals = {"shards": 0, "rows": 0, "errors": 0, "lost_leases": 0}
+
+    def rows_so_far(self, metrics):
+        counters = metrics.snapshot()["counters"]
+        return sum(counters.get("rows", {}).values()), sum(counters.get("errors", {}).values())
+
+    def heartbeat(self, shard, metrics, start_counts, stop, lost, lease_seconds):
+        # Renews well before the lease runs out and reports the shard's progress so far
+        while not stop.wait(lease_seconds / 3):
+            rows, errors = self.rows_so_far(metrics)
+            if not self.queue.renew(run_id=self.run_id, shard_id=shard['shard_id'], worker=self.worker_id,
+                                    rows=rows - start_counts[0], errors=errors - start_counts[1]):
+                self.totals["lost_leases"] += 1
+                print(f"Worker {self.worker_id} lost the lease on shard {shard['shard_id']}; stopping it after the calls in flight")
+                # The shard belongs to whoever reclaimed it now, so the batch stops handing out calls
+                lost.set()
+                return
+
+    def run_shard(self, processor, manifest, shard):
+        print(f"Worker {self.worker_id} running shard {shard['shard_id']} (plans {shard['first_plan']}-{shard['end_plan'] - 1}, attempt {shard['attempt']})")
+        start_counts = self.rows_so_far(processor.metrics)
+        stop, lost = threading.Event(), threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(shard, processor.metrics, start_counts, stop, lost, manifest['lease_seconds']), daemon=True)
+        heartbeat.start()
+        try:
+            summary = processor.run_batch(shard['end_plan'], models=manifest['models'], max_in_flight=manifest['max_in_flight'],
+                                          pack_size=manifest.get('pack_size', 1), first_plan_id=shard['first_plan'], stop=lost)
+        except KeyboardInterrupt:
+            # Stopped on purpose: hand the shard straight back instead of waiting for its lease to expire
+            self.queue.release(run_id=self.run_id, shard_id=shard['shard_id'], worker=self.worker_id)
+            raise
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        errors = sum(model_stats["error"] for model_stats in summary["models"].values())
+        self.totals["rows"] += summary["rows"]
+        self.totals["errors"] += errors
+        if lost.is_set():
+            # Another worker holds the shard now and completes it
+            return
+        if self.queue.complete(run_id=self.run_id, shard_id=shard['shard_id'], worker=self.worker_id, rows=summary["rows"], errors=errors):
+            self.totals["shards"] += 1
+
+    def run(self):
+        manifest = self.queue.get_manifest(run_id=self.run_id)
+        metrics = Metrics()
+        processor, close = self.build(manifest, metrics)
+        try:
+            while True:
+                shard = self.queue.claim(run_id=self.run_id, worker=self.worker_id)
+                if shard is not None:
+                    self.run_shard(processor, manifest, shard)
+                    continue
+                # Shards leased by other workers come back here if those workers die
+                if self.queue.finished(run_id=self.run_id):
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            close()
+        print(f"Worker {self.worker_id} finished: {self.totals}")
+        return self.totals
+
+
+def work(location, run_id, build=build_processor, token=None):
+    """Process entry point for one worker."""
+    queue = open_queue(location, token=token)
+    try:
+        ShardWorker(queue, run_id, build).run()
+    finally:
+        queue.close()
+
+
+def coordinate(queue, location, run_id, workers, build=build_processor, report_interval=10.0, max_restarts=None, token=None):
+    """Runs workers local worker processes on run_id and reports progress until every shard is done or failed.
+
+    Workers that crash are restarted while shards remain; their shards are reclaimed once the lease expires.
+    """
+    max_restarts = workers * 3 if max_restarts is None else max_restarts
+    processes, restarts = [], 0
+
+    def start_worker():
+        process = multiprocessing.Process(target=work, args=(location, run_id, build, token), daemon=False)
+        process.start()
+        processes.append(process)
+
+    for _ in range(workers):
+        start_worker()
+
+    while True:
+        for process in [process for process in processes if not process.is_alive()]:
+            processes.remove(process)
+            process.join()
+            if process.exitcode != 0 and not queue.finished(run_id=run_id) and restarts < max_restarts:
+                restarts += 1
+                print(f"Worker process {process.pid} exited with {process.exitcode}, starting another ({restarts} of {max_restarts})")
+                start_worker()
+        print("Progress:", json.dumps(queue.progress(run_id=run_id)))
+        if not processes:
+            break
+        time.sleep(report_interval)
+
+    progress = queue.progress(run_id=run_id)
+    print("Run finished:", json.dumps(progress, indent=2))
+    return progress
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded generation: a lease queue of prompt plan ranges and worker processes claiming them.")
+    parser.add_argument("command", choices=["coordinate", "work", "serve", "progress"],
+                        help="coordinate: create or continue a run with local workers; work: join a run; serve: share the queue over HTTP")
+    parser.add_argument("--queue", type=str, default=".cache/shards.sqlite", help="queue file, or the URL of a served queue")
+    parser.add_argument("--run_id", type=str, default=None)
+    parser.add_argument("--prompts", type=int, default=100)
+    parser.add_argument("--shard_size", type=int, default=50, help="prompt plans per shard")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--max_in_flight", type=int, default=16, help="calls in flight per worker")
+    parser.add_argument("--pack_size", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--topics", type=str, default="topics.json")
+    parser.add_argument("--lease_seconds", type=float, default=60.0)
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="serve: interface to listen on; any but loopback needs --token")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--token", type=str, default=None, help="shared secret of a served queue (default: SHARD_QUEUE_TOKEN)")
+    parser.add_argument("--report_interval", type=float, default=10.0)
+    args = parser.parse_args()
+
+    queue = open_queue(args.queue, token=args.token, lease_seconds=args.lease_seconds)
+    if args.command == "serve":
+        serve_queue(queue, host=args.host, port=args.port, token=args.token)
+    elif args.command == "progress":
+        print(json.dumps(queue.progress(run_id=args.run_id), indent=2))
+    elif args.command == "work":
+        work(args.queue, args.run_id, token=args.token)
+    else:
+        run_id = args.run_id
+        if run_id is None:
+            models = ModelPromptProcessor.bedrock_models + ["gemini-pro", "gpt-4"]
+            run_id = queue.create_run(n_prompts=args.prompts, shard_size=args.shard_size, models=models, seed=args.seed,
+                                      topics=args.topics, max_in_flight=args.max_in_flight, pack_size=args.pack_size)
+        coordinate(queue, args.queue, run_id, args.workers, report_interval=args.report_interval, token=args.token)
+    queue.close()
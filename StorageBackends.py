@@ -0,0 +1,355 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+import glob
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+import pytz
+
+from LLMs.Metrics import get_default_metrics
+from LLMs.Serialization import dumps
+
+# Attributes every backend stores for a generated row, in column order
+COLUMNS = ('model', 'timestamp', 'sentiment', 'categories', 'prompt', 'run_time', 'response', 'request_body', 'full_response', 'ttft')
+NUMERIC_COLUMNS = ('run_time', 'ttft')
+
+_timestamp_lock = threading.Lock()
+_last_timestamp = None
+
+def unique_timestamp():
+    """The current Asia/Jerusalem time as ISO-8601, moved a microsecond past the last one this process handed out.
+
+    Rows of one pack or of concurrent threads can share a microsecond, and (model, timestamp) is the row key.
+    """
+    global _last_timestamp
+    now = datetime.now(pytz.timezone('Asia/Jerusalem'))
+    with _timestamp_lock:
+        if _last_timestamp is not None and now <= _last_timestamp:
+            now = _last_timestamp + timedelta(microseconds=1)
+        _last_timestamp = now
+    return now.isoformat()
+
+class StorageBackend:
+    """Where generated rows go and are read back from.
+
+    DBInference (DynamoDB) and the local SQLiteBackend and ParquetBackend implement write_item, flush, close,
+    create_table, get_pages and get_segment_pages; ModelPromptProcessor and DatasetExporter only use those.
+    """
+
+    table_name = None
+
+    def __init__(self):
+        self.failed_rows = {}
+        self._failed_lock = threading.Lock()
+
+    def record_failed_rows(self, models):
+        """Counts rows of models that write_item accepted into a buffer but that were never stored."""
+        with self._failed_lock:
+            for model in models:
+                self.failed_rows[model] = self.failed_rows.get(model, 0) + 1
+
+    def take_failed_rows(self):
+        """Returns {model: rows} recorded by record_failed_rows since the last call; call it after flush()."""
+        with self._failed_lock:
+            failed, self.failed_rows = self.failed_rows, {}
+        return failed
+
+    def build_item(self, model, sentiment, categories, prompt, run_time, response, request_body, full_response, ttft=None):
+        item = {
+            'model': model,
+            'timestamp': unique_timestamp(),
+            'sentiment': sentiment,
+            'categories': categories,
+            'prompt': prompt,
+            'run_time': Decimal(str(run_time)),
+            'response': response,
+            'request_body': dumps(request_body),
+            'full_response': dumps(full_response)
+        }
+        # Time to first token, only known for streamed invocations
+        if ttft is not None:
+            item['ttft'] = Decimal(str(ttft))
+        return item
+
+    def create_table(self, gsi_attributes=()):
+        raise NotImplementedError
+
+    def write_item(self, model, sentiment, categories, prompt, run_time, response, request_body, full_response, ttft=None, on_written=None):
+        """Stores one row; on_written() is called once the row is confirmed stored. Returns False on a failed write.
+
+        Buffering backends return True once the row is buffered; rows whose later write fails are reported by take_failed_rows.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """Blocks until every buffered row has been stored."""
+
+    def close(self):
+        self.flush()
+
+    def get_pages(self, timestamp_from=None, timestamp_to=None, **kwargs):
+        raise NotImplementedError
+
+    def get_segment_pages(self, segment, total_segments, with_prompts=True, **kwargs):
+        """Pages of one of total_segments disjoint parts of the table, for parallel readers."""
+        raise NotImplementedError
+
+    def get_items(self, timestamp_from=None, timestamp_to=None, **kwargs):
+        """Lazily yields matching items; pass model (or a GSI attribute such as sentiment) to avoid a full scan."""
+        try:
+            for page in self.get_pages(timestamp_from=timestamp_from, timestamp_to=timestamp_to, **kwargs):
+                yield from page
+        except Exception as e:
+            print(f"Error retrieving items: {e}")
+
+
+def check_attributes(attributes):
+    unknown = [attribute for attribute in attributes if attribute not in COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown attributes {unknown}, expected some of {COLUMNS}")
+
+
+def to_row(item):
+    return tuple(float(item[column]) if column in NUMERIC_COLUMNS and item.get(column) is not None else item.get(column) for column in COLUMNS)
+
+
+class BufferedBackend(StorageBackend):
+    """Collects rows and stores them batch_rows at a time, or once flush_interval seconds passed since the last store.
+
+    A batch that fails to store is retried max_retries times with backoff before its rows are given up on.
+    """
+
+    def __init__(self, batch_rows, flush_interval, metrics=None, max_retries=3):
+        super().__init__()
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.metrics = metrics or get_default_metrics()
+        self.write_counters = {"written": 0, "failed": 0, "batches": 0, "retries": 0}
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        # Held while storing so batches land in the order they were taken
+        self._store_lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def store_rows(self, rows):
+        raise NotImplementedError
+
+    def write_item(self, model, sentiment, categories, prompt, run_time, response, request_body, full_response, ttft=None, on_written=None):
+        item = self.build_item(model, sentiment, categories, prompt, run_time, response, request_body, full_response, ttft)
+        with self._buffer_lock:
+            self._buffer.append((to_row(item), on_written))
+            due = len(self._buffer) >= self.batch_rows or time.monotonic() - self._flushed_at >= self.flush_interval
+        if due:
+            # A failure is counted against the whole batch through take_failed_rows, not against this row alone
+            self.flush()
+        return True
+
+    def flush(self):
+        """Stores the buffered rows; returns False when they could not be stored."""
+        with self._store_lock:
+            with self._buffer_lock:
+                batch, self._buffer = self._buffer, []
+                self._flushed_at = time.monotonic()
+            if not batch:
+                return True
+            for attempt in range(self.max_retries + 1):
+                try:
+                    with self.metrics.span('db_write'):
+                        self.store_rows([row for row, _ in batch])
+                    break
+                except Exception as e:
+                    print(f"Error saving {len(batch)} items to {self.table_name}: {e}")
+                    if attempt == self.max_retries:
+                        self.write_counters["failed"] += len(batch)
+                        self.record_failed_rows(row[0] for row, _ in batch)
+                        return False
+                    self.write_counters["retries"] += 1
+                    time.sleep(random.uniform(0, min(5.0, 0.1 * (2 ** attempt))))
+            self.write_counters["written"] += len(batch)
+            self.write_counters["batches"] += 1
+            self.metrics.increment('db_items', value=len(batch))
+
+        for _, on_written in batch:
+            if on_written is not None:
+                try:
+                    on_written()
+                except Exception as e:
+                    print(f"Error confirming write: {e}")
+        return True
+
+
+class SQLiteBackend(BufferedBackend):
+    """Rows in a local SQLite file in WAL mode, inserted in one transaction per batch."""
+
+    def __init__(self, path='.cache/rows.sqlite', table_name='ModelExecutionMetadata', batch_rows=1000, flush_interval=1.0, page_size=1000, metrics=None):
+        super().__init__(batch_rows, flush_interval, metrics)
+        if not re.fullmatch(r'\w+', table_name):
+            raise ValueError(f"Invalid table name {table_name}")
+        self.path = path
+        self.table_name = table_name
+        self.page_size = page_size
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = self.connect()
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.create_table()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def create_table(self, gsi_attributes=()):
+        """Creates the table if needed; each attribute in gsi_attributes gets an (attribute, timestamp) index like a DynamoDB GSI."""
+        check_attributes(gsi_attributes)
+        column_types = {'run_time': 'REAL', 'ttft': 'REAL'}
+        columns = ", ".join(f"{column} {column_types.get(column, 'TEXT')}" for column in COLUMNS)
+        with self._store_lock:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table_name} ({columns}, PRIMARY KEY (model, timestamp))")
+            for attribute in gsi_attributes:
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table_name}_{attribute}_timestamp ON {self.table_name} ({attribute}, timestamp)")
+
+    def store_rows(self, rows):
+        # Keys are unique per row (build_item), so a conflict is a real error and fails the batch instead of replacing a row
+        statement = f"INSERT INTO {self.table_name} ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+        self.connection.execute("BEGIN")
+        try:
+            self.connection.executemany(statement, rows)
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+        print(f"SQLiteBackend closed: {self.write_counters}")
+
+    def read_pages(self, where, parameters):
+        # A connection per reader; WAL lets it read while rows are being written
+        connection = self.connect()
+        try:
+            cursor = connection.execute(f"SELECT {', '.join(COLUMNS)} FROM {self.table_name}" + (f" WHERE {' AND '.join(where)}" if where else ""), parameters)
+            while True:
+                rows = cursor.fetchmany(self.page_size)
+                if not rows:
+                    break
+                yield [{column: value for column, value in zip(COLUMNS, row) if value is not None} for row in rows]
+        finally:
+            connection.close()
+
+    def conditions(self, timestamp_from=None, timestamp_to=None, **kwargs):
+        check_attributes(kwargs)
+        where, parameters = [], []
+        for attribute, value in kwargs.items():
+            where.append(f"{attribute} = ?")
+            parameters.append(value)
+        if timestamp_from is not None:
+            where.append("timestamp >= ?")
+            parameters.append(timestamp_from)
+        if timestamp_to is not None:
+            where.append("timestamp <= ?")
+            parameters.append(timestamp_to)
+        return where, parameters
+
+    def get_pages(self, timestamp_from=None, timestamp_to=None, **kwargs):
+        self.flush()
+        where, parameters = self.conditions(timestamp_from, timestamp_to, **kwargs)
+        return self.read_pages(where, parameters)
+
+    def get_segment_pages(self, segment, total_segments, with_prompts=True, **kwargs):
+        self.flush()
+        where, parameters = self.conditions(**kwargs)
+        return self.read_pages(where + ["rowid % ? = ?"], parameters + [total_segments, segment])
+
+
+class ParquetBackend(BufferedBackend):
+    """Append-only Parquet files under path/table_name, one row group per batch.
+
+    Each instance writes its own part file, renamed into place on close(); readers only see closed files.
+    """
+
+    def __init__(self, path='.cache/rows', table_name='ModelExecutionMetadata', batch_rows=10000, flush_interval=30.0, metrics=None):
+        super().__init__(batch_rows, flush_interval, metrics)
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa, self.pq = pa, pq
+        self.path = path
+        self.table_name = table_name
+        self.directory = os.path.join(path, table_name)
+        self.schema = pa.schema([(column, pa.float64() if column in NUMERIC_COLUMNS else pa.string()) for column in COLUMNS])
+        self.part_path = os.path.join(self.directory, f"part-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet")
+        self.writer = None
+        self.create_table()
+
+    def create_table(self, gsi_attributes=()):
+        # Parquet files carry min/max statistics per row group; there is nothing like an index to create
+        check_attributes(gsi_attributes)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def store_rows(self, rows):
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.part_path + '.tmp', self.schema)
+        columns = list(zip(*rows))
+        table = self.pa.Table.from_arrays([self.pa.array(values, type=self.schema.field(i).type) for i, values in enumerate(columns)], schema=self.schema)
+        self.writer.write_table(table, row_group_size=len(rows))
+
+    def close(self):
+        self.flush()
+        with self._store_lock:
+            if self.writer is not None:
+                self.writer.close()
+                os.replace(self.part_path + '.tmp', self.part_path)
+                self.writer = None
+        print(f"ParquetBackend closed: {self.write_counters}")
+
+    def row_groups(self):
+        for file_path in sorted(glob.glob(os.path.join(self.directory, '*.parquet'))):
+            parquet_file = self.pq.ParquetFile(file_path)
+            for row_group in range(parquet_file.num_row_groups):
+                yield parquet_file, row_group
+
+    def read_pages(self, row_groups, timestamp_from=None, timestamp_to=None, **kwargs):
+        import pyarrow.compute as pc
+        check_attributes(kwargs)
+        for parquet_file, row_group in row_groups:
+            table = parquet_file.read_row_group(row_group)
+            mask = None
+            conditions = [pc.equal(table[attribute], value) for attribute, value in kwargs.items()]
+            if timestamp_from is not None:
+                conditions.append(pc.greater_equal(table['timestamp'], timestamp_from))
+            if timestamp_to is not None:
+                conditions.append(pc.less_equal(table['timestamp'], timestamp_to))
+            for condition in conditions:
+                mask = condition if mask is None else pc.and_(mask, condition)
+            if mask is not None:
+                table = table.filter(mask)
+            if table.num_rows:
+                yield [{column: value for column, value in row.items() if value is not None} for row in table.to_pylist()]
+
+    def get_pages(self, timestamp_from=None, timestamp_to=None, **kwargs):
+        return self.read_pages(self.row_groups(), timestamp_from, timestamp_to, **kwargs)
+
+    def get_segment_pages(self, segment, total_segments, with_prompts=True, **kwargs):
+        # Row groups are dealt out round robin, so segments stay balanced however many files there are
+        row_groups = (entry for i, entry in enumerate(self.row_groups()) if i % total_segments == segment)
+        return self.read_pages(row_groups, **kwargs)
+
+
+def open_storage(backend='dynamodb', path=None, table_name='ModelExecutionMetadata', **settings):
+    """Opens the storage backend by name: dynamodb (DBInference), sqlite or parquet."""
+    if backend == 'dynamodb':
+        from DBInference import DBInference
+        return DBInference(table_name, **settings)
+    if backend == 'sqlite':
+        return SQLiteBackend(path or '.cache/rows.sqlite', table_name, **settings)
+    if backend == 'parquet':
+        return ParquetBackend(path or '.cache/rows', table_name, **settings)
+    raise ValueError(f"Unknown storage backend {backend}")
@@ -1,122 +1,383 @@
-import boto3
+"""Synthetic dataset generation command line.
+
+    python main.py generate --prompts 100      # the default command; settings come from the flags or the environment
+    python main.py generate --dry-run          # prints the settings and first prompts without building any client
+    python main.py export --output_dir data    # DatasetExporter options
+    python main.py bench --prompts 50          # Benchmark options
+    python main.py create-table --gsi sentiment
+    python main.py startup                     # import-time profile of a short invocation; exits 1 on a regression (make startup)
+
+SDKs (boto3, aiohttp, pyarrow, ...) are imported and clients built on first use, once per run, and shared.
+"""
+import argparse
+import functools
 import json
-from dotenv import load_dotenv
 import os
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+
+# Model ID of each API model and the environment variable holding its key
+API_KEYS = {"gemini-pro": "GEMINI_API_KEY", "gpt-4": "OPENAI_API_KEY"}
+# Modules a dry run or plan preview must not import
+HEAVY_MODULES = ('boto3', 'botocore', 'aiohttp', 'faker', 'pyarrow', 'torch', 'transformers')
+
+
+class Runtime:
+    """Clients and settings of one run, built from the environment on first use and shared by everything that needs them."""
+
+    def __init__(self, max_in_flight=16, topics='topics.json'):
+        self.max_in_flight = max_in_flight
+        self.topics = topics
+
+    @functools.cached_property
+    def metrics(self):
+        # Stage latencies and counters for every client, the processor and the DB writer
+        from LLMs.Metrics import Metrics
+        return Metrics()
+
+    @functools.cached_property
+    def pool(self):
+        # One connection pool sized to the in-flight calls, shared by every client and the DB writer
+        from LLMs.ConnectionPool import ConnectionPool
+        return ConnectionPool(max_connections=self.max_in_flight)
+
+    @functools.cached_property
+    def response_cache(self):
+        # RESPONSE_CACHE=<path> replays identical (model, request body) calls from disk; CACHE_BYPASS=1 forces fresh samples
+        if not os.getenv("RESPONSE_CACHE"):
+            return None
+        from LLMs.ResponseCache import ResponseCache
+        return ResponseCache(
+            os.getenv("RESPONSE_CACHE"),
+            ttl=float(os.getenv("CACHE_TTL")) if os.getenv("CACHE_TTL") else None,
+            bypass=os.getenv("CACHE_BYPASS") == "1"
+        )
+
+    @functools.cached_property
+    def rate_limiter(self):
+        # RATE_LIMITS is JSON keyed by provider or model ID, e.g. {"openai": {"requests_per_minute": 500, "tokens_per_minute": 300000}}
+        from LLMs.RateLimiter import RateLimiterRegistry
+        return RateLimiterRegistry(limits=json.loads(os.getenv("RATE_LIMITS", "{}")))
+
+    @functools.cached_property
+    def storage_settings(self):
+        # STORAGE=sqlite or STORAGE=parquet keeps rows on local disk at STORAGE_PATH instead of DynamoDB
+        # WRITE_BEHIND=1 buffers rows and stores them with BatchWriteItem from a background thread
+        # DB_LAYOUT=normalized stores each prompt once and compresses the large attributes
+        return {"storage": os.getenv("STORAGE", "dynamodb"), "path": os.getenv("STORAGE_PATH"),
+                "write_behind": os.getenv("WRITE_BEHIND") == "1", "layout": os.getenv("DB_LAYOUT", "flat")}
+
+    @functools.cached_property
+    def db(self):
+        from StorageBackends import open_storage
+        settings = self.storage_settings
+        if settings["storage"] == "dynamodb":
+            return open_storage('dynamodb', pool=self.pool, write_behind=settings["write_behind"], metrics=self.metrics, layout=settings["layout"])
+        return open_storage(settings["storage"], settings["path"], metrics=self.metrics)
+
+    @functools.cached_property
+    def hedge_settings(self):
+        # HEDGE_REGIONS=us-west-2,eu-central-1 repeats Bedrock calls slower than the observed HEDGE_PERCENTILE (default p95)
+        # in another region, and HEDGE_URLS (JSON of model ID to base URL) does the same for the API models;
+        # HEDGE_BUDGET caps the share of calls that get a hedge
+        return {"regions": [region for region in os.getenv("HEDGE_REGIONS", "").split(",") if region],
+                "urls": json.loads(os.getenv("HEDGE_URLS", "{}"))}
+
+    @functools.cached_property
+    def hedging(self):
+        if not (self.hedge_settings["regions"] or self.hedge_settings["urls"]):
+            return None
+        from LLMs.Hedging import HedgePolicy
+        return HedgePolicy(percentile=float(os.getenv("HEDGE_PERCENTILE", "0.95")), max_hedge_rate=float(os.getenv("HEDGE_BUDGET", "0.05")), metrics=self.metrics)
+
+    @functools.cached_property
+    def brt_client(self):
+        from LLMs.BedrockRuntimeClient import BedrockRuntimeClient
+        return BedrockRuntimeClient(pool=self.pool, cache=self.response_cache, rate_limiter=self.rate_limiter, metrics=self.metrics,
+                                    region_name=os.getenv("BEDROCK_REGION"), hedge_regions=self.hedge_settings["regions"], hedging=self.hedging)
+
+    @functools.cached_property
+    def content_generators(self):
+        from LLMs.ApiRuntimeClient import ContentGenerator
+        return {model_id: ContentGenerator(os.getenv(key), pool=self.pool, cache=self.response_cache, rate_limiter=self.rate_limiter, metrics=self.metrics,
+                                           hedge_urls=self.hedge_settings["urls"], hedging=self.hedging)
+                for model_id, key in API_KEYS.items()}
+
+    @functools.cached_property
+    def categories(self):
+        with open(self.topics, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    @functools.cached_property
+    def planner(self):
+        # PLAN_SEED=<int> hands out unique, balanced prompt plans in a reproducible order instead of random draws
+        if not os.getenv("PLAN_SEED"):
+            return None
+        from PromptPlanner import PromptPlanner
+        return PromptPlanner(self.categories, seed=int(os.getenv("PLAN_SEED")))
+
+    @functools.cached_property
+    def dedup(self):
+        # DEDUP_INDEX=<path> drops responses nearly identical to any earlier one; the index is kept across runs
+        if not os.getenv("DEDUP_INDEX"):
+            return None
+        from DedupFilter import DedupFilter
+        return DedupFilter(os.getenv("DEDUP_INDEX"), threshold=float(os.getenv("DEDUP_THRESHOLD", "0.8")), metrics=self.metrics)
+
+    @functools.cached_property
+    def verifier(self):
+        # VERIFIER_MODEL=<dir> checks each response's sentiment with the int8 classifier SentimentVerifier.py exported there;
+        # VERIFIER_ACTION=drop skips mismatching rows instead of tagging them (tagged rows are left out of exports)
+        if not os.getenv("VERIFIER_MODEL"):
+            return None
+        from SentimentVerifier import SentimentVerifier
+        return SentimentVerifier(os.getenv("VERIFIER_MODEL"), action=os.getenv("VERIFIER_ACTION", "tag"),
+                                 min_confidence=float(os.getenv("VERIFIER_MIN_CONFIDENCE", "0.5")), metrics=self.metrics)
+
+    @functools.cached_property
+    def journal(self):
+        # JOB_JOURNAL=<path> records the run so it can be resumed later with --resume <job id>
+        if not os.getenv("JOB_JOURNAL"):
+            return None
+        from JobJournal import JobJournal
+        return JobJournal(os.getenv("JOB_JOURNAL"))
+
+    @functools.cached_property
+    def processor(self):
+        from ModelPromotProcessor import ModelPromptProcessor
+        return ModelPromptProcessor(self.categories, self.brt_client, self.db, self.content_generators, planner=self.planner,
+                                    stream=os.getenv("STREAM") == "1", metrics=self.metrics, dedup=self.dedup,
+                                    verifier=self.verifier)
+
+    def built(self, name):
+        return name in self.__dict__
+
+    async def aclose(self):
+        if self.built('brt_client'):
+            await self.brt_client.aclose()
+        if self.built('pool'):
+            await self.pool.aclose()
+
+    def close(self):
+        """Stores buffered rows and the dedup index, and prints the stats of everything this run built."""
+        if self.built('db'):
+            self.db.close()
+        if self.built('pool'):
+            print("Connection pool:", json.dumps(self.pool.stats(), indent=2))
+        if self.built('rate_limiter'):
+            print("Rate limits:", json.dumps(self.rate_limiter.stats(), indent=2))
+        if self.built('response_cache') and self.response_cache is not None:
+            print("Response cache:", json.dumps(self.response_cache.stats(), indent=2))
+        if self.built('hedging') and self.hedging is not None:
+            self.hedging.close()
+            print("Hedging:", json.dumps(self.hedging.stats(), indent=2))
+        if self.built('verifier') and self.verifier is not None:
+            self.verifier.close()
+            print("Sentiment verifier:", json.dumps(self.verifier.stats(), indent=2))
+        if self.built('dedup') and self.dedup is not None:
+            self.dedup.save()
+            print("Near-duplicates:", json.dumps(self.dedup.stats(), indent=2))
+        if self.built('metrics'):
+            print("Latency:", self.metrics.to_json())
+            # METRICS_OUT=<path> exports the run's metrics; *.prom files are Prometheus text, anything else JSON
+            if os.getenv("METRICS_OUT"):
+                self.metrics.write(os.getenv("METRICS_OUT"))
+
+
+def batch_models():
+    from ModelPromotProcessor import ModelPromptProcessor
+    return ModelPromptProcessor.bedrock_models + list(API_KEYS)
+
+
+def dry_run(runtime, args, n_prompts):
+    """Prints what generate would do: settings, call counts, plan balance and the first prompts. Builds no client."""
+    from ModelPromotProcessor import ModelPromptProcessor
+    models = batch_models()
+    calls_per_model = -(-n_prompts // args.pack_size)
+    print(json.dumps({
+        "prompts": n_prompts,
+        "models": models,
+        "calls": args.target_rows or calls_per_model * len(models),
+        "rows": args.target_rows or n_prompts * len(models),
+        "max_in_flight": args.max_in_flight,
+        "pack_size": args.pack_size,
+        "async": args.use_async,
+        "stream": os.getenv("STREAM") == "1",
+        "storage": runtime.storage_settings,
+        "hedge": runtime.hedge_settings,
+        "plan_seed": os.getenv("PLAN_SEED"),
+        "dedup_index": os.getenv("DEDUP_INDEX"),
+        "verifier": os.getenv("VERIFIER_MODEL"),
+        "response_cache": os.getenv("RESPONSE_CACHE"),
+        "job_journal": os.getenv("JOB_JOURNAL"),
+        "resume": args.resume,
+        "target_rows": args.target_rows,
+        "model_mix": args.model_mix,
+        "sentiment_mix": args.sentiment_mix
+    }, indent=2))
+
+    planner = runtime.planner
+    if planner is not None:
+        if n_prompts > len(planner):
+            print(f"Requested {n_prompts} prompts but the planner only has {len(planner)} unique plans")
+        print("Plan coverage:", json.dumps(planner.coverage(min(n_prompts, len(planner))), indent=2))
+
+    processor = ModelPromptProcessor(runtime.categories, None, None, {}, planner=planner)
+    plans = [planner.plan(plan_id) if planner is not None else None for plan_id in range(min(args.preview, n_prompts))]
+    drawn = [processor.generate_prompt_with_sentiment(plan) for plan in plans]
+    if args.pack_size > 1:
+        print(processor.build_packed_prompt([(sentiment, json.loads(categories_json)) for _, sentiment, categories_json in drawn[:args.pack_size]]))
+        return
+    for plan_id, (prompt, sentiment, categories_json) in enumerate(drawn):
+        print(f"Plan {plan_id} ({sentiment}, {categories_json}):\n{prompt}")
+
+
+def generate(args):
+    runtime = Runtime(max_in_flight=args.max_in_flight, topics=args.topics)
+    n_prompts, models = args.prompts, None
+    if args.resume:
+        if runtime.journal is None:
+            raise SystemExit(f"--resume {args.resume} needs JOB_JOURNAL set to the journal the job was recorded in")
+        # A resumed job keeps the prompts and models it was started with
+        manifest = runtime.journal.get_manifest(args.resume)
+        n_prompts, models = manifest['n_prompts'], manifest['models']
+    if args.dry_run:
+        dry_run(runtime, args, n_prompts)
+        return
+
+    scheduler = None
+    if args.target_rows:
+        if runtime.journal is not None or args.pack_size > 1:
+            raise SystemExit("--target_rows runs are neither journaled nor packed; unset JOB_JOURNAL and --pack_size")
+        from ModelScheduler import ModelScheduler
+        scheduler = ModelScheduler(args.target_rows, model_mix=args.model_mix, sentiment_mix=args.sentiment_mix)
+
+    processor = runtime.processor
+    batch_settings = {"models": models, "max_in_flight": args.max_in_flight, "journal": runtime.journal, "job_id": args.resume, "pack_size": args.pack_size}
+
+    async def run_async_batch():
+        try:
+            if scheduler is not None:
+                return await processor.arun_scheduled(scheduler, max_in_flight=args.max_in_flight)
+            return await processor.arun_batch(n_prompts, **batch_settings)
+        finally:
+            await runtime.aclose()
+
+    try:
+        if args.use_async:
+            import asyncio
+            batch_stats = asyncio.run(run_async_batch())
+        elif scheduler is not None:
+            batch_stats = processor.run_scheduled(scheduler, max_in_flight=args.max_in_flight)
+        else:
+            batch_stats = processor.run_batch(n_prompts, **batch_settings)
+        print(json.dumps(batch_stats, indent=2))
+    finally:
+        runtime.close()
+
+
+def create_table(args):
+    runtime = Runtime()
+    db = runtime.db
+    db.create_table(gsi_attributes=args.gsi)
+    # The normalized DynamoDB layout keeps prompts in a second table
+    if getattr(db, 'layout', None) == 'normalized':
+        db.create_prompts_table()
+    db.close()
+
+
+def startup(args):
+    """Runs a command under python -X importtime and fails when it is slow or imports a heavy SDK."""
+    command = args.command_line or ['generate', '--dry-run', '--preview', '0']
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', os.path.abspath(__file__)] + command,
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    elapsed = time.perf_counter() - start
+
+    # Lines look like "import time: <self us> | <cumulative us> | <module>", nested imports indented two spaces per level
+    imports, modules = {}, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip().split('.')[0])
+        if not name.startswith('  '):
+            imports[name.strip()] = int(cumulative) / 1e6
+    heavy = sorted(modules & set(HEAVY_MODULES))
+
+    print(f"python main.py {' '.join(command)}: exit {result.returncode}, {elapsed:.3f}s wall, {sum(imports.values()):.3f}s importing")
+    for name, seconds in sorted(imports.items(), key=lambda entry: entry[1], reverse=True)[:args.top]:
+        print(f"  {seconds * 1000:8.1f} ms  {name}")
+    problems = []
+    if result.returncode != 0:
+        problems.append(f"command failed: {result.stderr.strip().splitlines()[-1] if result.stderr.strip() else result.returncode}")
+    if heavy:
+        problems.append(f"imports {', '.join(heavy)}")
+    if elapsed > args.budget:
+        problems.append(f"took {elapsed:.3f}s, over the {args.budget}s budget")
+    for problem in problems:
+        print(f"Startup check failed: {problem}")
+    if problems:
+        raise SystemExit(1)
+
+
+def main(argv=None):
+    load_dotenv()
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(description="Synthetic dataset generation.")
+    commands = parser.add_subparsers(dest="command")
+
+    generate_parser = commands.add_parser("generate", help="generate prompts, call every model and store the responses (default)")
+    # Defaults come from the environment variables the pipeline has always read
+    generate_parser.add_argument("--prompts", type=int, default=int(os.getenv("N_PROMPTS", "1")), help="prompts, each fanned out to every model")
+    generate_parser.add_argument("--max_in_flight", type=int, default=int(os.getenv("MAX_IN_FLIGHT", "16")))
+    generate_parser.add_argument("--pack_size", type=int, default=int(os.getenv("PACK_SIZE", "1")), help="numbered sentences asked for per call")
+    generate_parser.add_argument("--async", dest="use_async", action="store_true", default=os.getenv("USE_ASYNC") == "1",
+                                 help="one event loop instead of a thread per in-flight call")
+    # TARGET_ROWS=<n> lets a ModelScheduler pick the (prompt, model) pairs toward n rows in MODEL_MIX and SENTIMENT_MIX
+    generate_parser.add_argument("--target_rows", type=int, default=int(os.getenv("TARGET_ROWS", "0")) or None,
+                                 help="rows to generate in the target mix instead of --prompts prompts for every model")
+    generate_parser.add_argument("--model_mix", type=json.loads, default=json.loads(os.getenv("MODEL_MIX", "null")),
+                                 help='JSON of model ID to its share of the rows, e.g. {"gpt-4": 2, "anthropic.claude-v2": 1}; default even')
+    generate_parser.add_argument("--sentiment_mix", type=json.loads, default=json.loads(os.getenv("SENTIMENT_MIX", "null")),
+                                 help="JSON of sentiment to its share of each model's rows; default even")
+    generate_parser.add_argument("--resume", type=str, default=os.getenv("RESUME_JOB"), help="job ID of JOB_JOURNAL to resume")
+    generate_parser.add_argument("--topics", type=str, default="topics.json")
+    generate_parser.add_argument("--dry-run", dest="dry_run", action="store_true", help="print the settings and first prompts, call nothing")
+    generate_parser.add_argument("--preview", type=int, default=3, help="prompts printed by --dry-run")
+
+    # export and bench pass their options on to DatasetExporter and Benchmark
+    commands.add_parser("export", help="export stored rows as a train/test dataset", add_help=False)
+    commands.add_parser("bench", help="offline end-to-end benchmark", add_help=False)
+
+    table_parser = commands.add_parser("create-table", help="create the table of the configured STORAGE")
+    table_parser.add_argument("--gsi", nargs="*", default=[], help="attributes to index by (attribute, timestamp)")
+
+    startup_parser = commands.add_parser("startup", help="import-time profile of a short invocation")
+    startup_parser.add_argument("command_line", nargs=argparse.REMAINDER, help="main.py arguments to profile (default: generate --dry-run)")
+    startup_parser.add_argument("--budget", type=float, default=1.0, help="seconds the invocation may take")
+    startup_parser.add_argument("--top", type=int, default=10, help="slowest top-level imports to list")
+
+    if not argv or argv[0].startswith('-') and argv[0] not in ('-h', '--help'):
+        argv = ['generate'] + list(argv)
+    if argv[0] == 'export':
+        from DatasetExporter import main as export
+        return export(argv[1:])
+    if argv[0] == 'bench':
+        from Benchmark import main as bench
+        return bench(argv[1:])
+
+    args = parser.parse_args(argv)
+    if args.command == "generate":
+        generate(args)
+    elif args.command == "create-table":
+        create_table(args)
+    elif args.command == "startup":
+        startup(args)
 
-from LLMs.BedrockRuntimeClient import BedrockRuntimeClient
-from LLMs.ApiRuntimeClient import ContentGenerator
-from ModelPromotProcessor import ModelPromptProcessor
-from DBInference import DBInference
-
-# Load environment variables from .env file
-load_dotenv()
-
-prompt = "Write a story about a magical forest in a sentence."
-
-aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
-aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
-aws_default_region = os.getenv('AWS_DEFAULT_REGION')
-
-# Initialize a boto3 session
-session = boto3.Session(
-    aws_access_key_id=aws_access_key_id,
-    aws_secret_access_key=aws_secret_access_key,
-    region_name=aws_default_region
-)
-brt_client = BedrockRuntimeClient()
-
-# # Invoke a model with some custom parameters
-# extracted_response, body, full_response, duration = brt_client.invoke_model(
-#     model_id='ai21.j2-ultra-v1',
-#     prompt=prompt,
-#     custom_parameters={'temperature': 0.5, 'topP': 0.9}
-# )
-# print("AI21 J2 Model Response:", extracted_response)
-# print("Duration:", duration, "seconds\n")
-
-# Initialize environment and load API key
-# ========== Gemini ==========
-# api_key = os.getenv("GEMINI_API_KEY")  # Use OPENAI_API_KEY for GPT-4
-# generator = ContentGenerator(api_key)
-# custom_params_gemini = {
-#     "generationConfig": {
-#         "temperature": 0.8,
-#         "maxOutputTokens": 500
-#     }
-# }
-# extracted_response_gemini, body, full_response_gemini, duration_gemini = generator.invoke_model(
-#     model_id="gemini-pro",
-#     prompt=prompt,
-#     custom_parameters=custom_params_gemini
-# )
-# print("Gemini Model Response:", extracted_response_gemini)
-# print("Duration:", duration_gemini, "seconds\n")
-
-# # ========== GPT-4 ==========
-# api_key = os.getenv("OPENAI_API_KEY")  # Use OPENAI_API_KEY for GPT-4
-# generator = ContentGenerator(api_key)
-# custom_params_gpt4 = {
-#     "temperature": 0.6,
-#     "max_tokens": 256,
-#     "top_p": 1
-# }
-# extracted_response_gpt, body, full_response_gpt, duration_gpt = generator.invoke_model(
-#     model_id="gpt-4",
-#     prompt=prompt,
-#     custom_parameters=custom_params_gpt4
-# )
-# print("GPT-4 Model Response:", extracted_response_gpt)
-# print("Duration:", duration_gpt, "seconds")
-
-
-
-
-
-# categories_data = ""
-# with open('topics.json', 'r', encoding='utf-8') as file:
-#     categories_data = json.load(file)
-    
-# # Initialize the necessary components
-# brt_client = BedrockRuntimeClient()  # Make sure this client has the updated invoke methods
-# db_instance =  DBInference()  # Your database instance for saving items
-
-# # Create the processor instance with your data and components
-# processor = ModelPromptProcessor(categories_data, brt_client, db_instance)
-
-# # Generate a prompt and invoke the models to generate responses and save them
-# prompt, sentiment, categories_json = processor.generate_prompt_with_sentiment()
-
-# processor.invoke_models_and_save(prompt, sentiment, categories_json)
-
-
-
-
-
-# Assuming DBInference and BedrockRuntimeClient are already defined elsewhere
-db_instance = DBInference()  # Your database instance for saving items
-brt_client = BedrockRuntimeClient()  # Make sure this client has the updated invoke methods
-
-# Load environment variables
-load_dotenv()
-
-gemini_api_key = os.getenv("GEMINI_API_KEY")  # Use GEMINI_API_KEY for Gemini
-gpt_api_key = os.getenv("OPENAI_API_KEY")  # Use OPENAI_API_KEY for GPT-4
-
-# Assuming ContentGenerator class is defined to handle different models
-gemini_generator = ContentGenerator(gemini_api_key)
-gpt_generator = ContentGenerator(gpt_api_key)
-
-# Map of model IDs to their respective ContentGenerator instances
-content_generators = {
-    "gemini-pro": gemini_generator,
-    "gpt-4": gpt_generator
-}
-
-categories_data = ""
-with open('topics.json', 'r', encoding='utf-8') as file:
-    categories_data = json.load(file)
-
-processor = ModelPromptProcessor(categories_data, brt_client, db_instance, content_generators)
-prompt, sentiment, categories_json = processor.generate_prompt_with_sentiment()
-processor.invoke_models_and_save(prompt, sentiment, categories_json)
 
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,43 @@
-from transformers import AutoModelForSequenceClassification, Trainer, TrainingArguments, AutoTokenizer
+from transformers import AutoModelForSequenceClassification, Trainer, TrainingArguments, AutoTokenizer, DataCollatorWithPadding
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support
 from datasets import load_from_disk
+from datasets.fingerprint import Hasher
 import random
 import logging
 import sys
 import argparse
 import os
+import time
 import torch
 
+
+def tokenize_cached(dataset, tokenizer, cache_dir, max_length, num_proc, logger):
+    """Tokenizes dataset once per (data, tokenizer, max_length) and reuses the Arrow copy saved under cache_dir.
+
+    No padding here: each batch is padded to its own longest sample by the collator. The length column lets
+    group_by_length sort samples without tokenizing them again.
+    """
+    key = Hasher.hash([dataset._fingerprint, Hasher.hash(tokenizer), max_length])
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(path):
+        logger.info(f" reusing tokenized dataset {path}")
+        return load_from_disk(path)
+
+    def tokenize(batch):
+        encoded = tokenizer(batch["text"], truncation=True, max_length=max_length)
+        encoded["length"] = [len(input_ids) for input_ids in encoded["input_ids"]]
+        return encoded
+
+    start = time.time()
+    tokenized = dataset.map(tokenize, batched=True, num_proc=num_proc, remove_columns=[column for column in dataset.column_names if column != "label"])
+    # Saved under a temporary name first so an interrupted job never leaves a half-written cache entry
+    temporary = f"{path}.tmp-{os.getpid()}"
+    tokenized.save_to_disk(temporary)
+    os.replace(temporary, path)
+    logger.info(f" tokenized {len(tokenized)} samples in {time.time() - start:.1f}s with {num_proc} processes, cached at {path}")
+    return load_from_disk(path)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
@@ -19,6 +49,10 @@ if __name__ == "__main__":
     parser.add_argument("--warmup_steps", type=int, default=500)
     parser.add_argument("--model_name", type=str)
     parser.add_argument("--learning_rate", type=str, default=5e-5)
+    parser.add_argument("--max_length", type=int, default=128)
+    parser.add_argument("--preprocessing_workers", type=int, default=os.cpu_count())
+    # Length-grouped batches keep the short one-sentence samples from being padded to the longest ones
+    parser.add_argument("--group_by_length", type=lambda value: value.lower() in ("1", "true", "yes"), default=True)
 
     # Data, model, and output directories
     parser.add_argument("--output_data_dir", type=str, default=os.environ["SM_OUTPUT_DATA_DIR"])
@@ -26,6 +60,8 @@ if __name__ == "__main__":
     parser.add_argument("--n_gpus", type=str, default=os.environ["SM_NUM_GPUS"])
     parser.add_argument("--training_dir", type=str, default=os.environ["SM_CHANNEL_TRAIN"])
     parser.add_argument("--test_dir", type=str, default=os.environ["SM_CHANNEL_TEST"])
+    # Point at a persisted location (e.g. the checkpoint directory synced to S3) to reuse the tokenization across jobs
+    parser.add_argument("--cache_dir", type=str, default=os.environ.get("TOKENIZED_CACHE_DIR", "/opt/ml/checkpoints/tokenized"))
 
     args, _ = parser.parse_known_args()
 
@@ -57,6 +93,10 @@ if __name__ == "__main__":
     model = AutoModelForSequenceClassification.from_pretrained(args.model_name)
     tokenizer = AutoTokenizer.from_pretrained(args.model_name)
 
+    os.makedirs(args.cache_dir, exist_ok=True)
+    train_dataset = tokenize_cached(train_dataset, tokenizer, args.cache_dir, args.max_length, args.preprocessing_workers, logger)
+    test_dataset = tokenize_cached(test_dataset, tokenizer, args.cache_dir, args.max_length, args.preprocessing_workers, logger)
+
     # define training args
     training_args = TrainingArguments(
         output_dir=args.model_dir,
@@ -67,6 +107,8 @@ if __name__ == "__main__":
         evaluation_strategy="epoch",
         logging_dir=f"{args.output_data_dir}/logs",
         learning_rate=float(args.learning_rate),
+        group_by_length=args.group_by_length,
+        length_column_name="length",
     )
 
     # create Trainer instance
@@ -77,13 +119,16 @@ if __name__ == "__main__":
         train_dataset=train_dataset,
         eval_dataset=test_dataset,
         tokenizer=tokenizer,
+        data_collator=DataCollatorWithPadding(tokenizer),
     )
 
     # train model
-    trainer.train()
+    train_result = trainer.train()
 
     # evaluate model
     eval_result = trainer.evaluate(eval_dataset=test_dataset)
+    # train_samples_per_second and eval_samples_per_second report the throughput of both stages
+    eval_result.update({key: value for key, value in train_result.metrics.items() if key.startswith("train_")})
 
     # writes eval result to file which can be accessed later in s3 ouput
     with open(os.path.join(args.output_data_dir, "eval_results.txt"), "w") as writer: